@@ -0,0 +1,133 @@
+"""
+User cache.
+
+Lookups by Telegram ID go through two levels: an identity map per update, so repeated
+:func:`app.utils.get_user` calls while handling one update return the same instance, and
+a process wide TTL/LRU cache shared between updates. ``User.save()`` writes the saved
+values through both levels, so role and language changes are visible immediately.
+
+The process wide cache keeps its own copies and hands out new ones, so an update changing
+a user without saving it, or failing to save it, never changes what other updates see.
+
+Caches kept elsewhere(e.g. in other worker processes, see :mod:`app.sharding`) subscribe to
+:func:`changed`, which models call once a saved user or conversation is committed.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from app.config import USER_CACHE_SIZE, USER_CACHE_TTL
+
+IDENTITY_MAPS = 1024
+
+# Kinds of saved rows passed to subscribers
+ROUTE = "route"
+USER = "user"
+
+_subscribers = []
+
+
+class UserCache:
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # user_id -> (expires, user)
+        self._users: OrderedDict = OrderedDict()
+        # update_id -> {user_id: user}
+        self._identity: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.identity_hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, update_id: int = None):
+        """
+        Returns cached user or None.
+        :param user_id: Telegram ID
+        :param update_id: ID of update being handled, enables identity map
+        """
+        with self._lock:
+            if update_id is not None:
+                user = self._identity.get(update_id, {}).get(user_id)
+                if user is not None:
+                    self.identity_hits += 1
+                    return user
+            entry = self._users.get(user_id)
+            if entry is not None:
+                expires, user = entry
+                if expires > time.monotonic():
+                    self._users.move_to_end(user_id)
+                    self.hits += 1
+                    user = _copy(user)
+                    if update_id is not None:
+                        self._remember(update_id, user)
+                    return user
+                del self._users[user_id]
+            self.misses += 1
+            return None
+
+    def set(self, user, update_id: int = None) -> None:
+        """Stores copy of user loaded from database, user itself joins the identity map of the update."""
+        with self._lock:
+            self._users[user.id] = (time.monotonic() + self.ttl, _copy(user))
+            self._users.move_to_end(user.id)
+            while len(self._users) > self.maxsize:
+                self._users.popitem(last=False)
+            if update_id is not None:
+                self._remember(update_id, user)
+
+    def update(self, user) -> None:
+        """Replaces every cached copy of user with the values of saved instance."""
+        with self._lock:
+            # Following lookups of these updates get a copy of the saved values
+            for users in self._identity.values():
+                users.pop(user.id, None)
+        self.set(user)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._users.pop(user_id, None)
+            for users in self._identity.values():
+                users.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+            self._identity.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._users),
+                "hits": self.hits,
+                "identity_hits": self.identity_hits,
+                "misses": self.misses,
+            }
+
+    def _remember(self, update_id: int, user) -> None:
+        users = self._identity.get(update_id)
+        if users is None:
+            users = self._identity[update_id] = {}
+            while len(self._identity) > IDENTITY_MAPS:
+                self._identity.popitem(last=False)
+        users[user.id] = user
+
+
+def _copy(user):
+    """Instance with the same column values, related instances are loaded again on access."""
+    copy = type(user)(__no_default__=True)
+    copy.__data__ = dict(user.__data__)
+    return copy
+
+
+user_cache = UserCache()
+
+
+def subscribe(callback) -> None:
+    """Calls callback(kind, key) for every committed change of a row of kind(ROUTE or USER)."""
+    _subscribers.append(callback)
+
+
+def changed(kind: str, key: int) -> None:
+    for callback in _subscribers:
+        callback(kind, key)
@@ -0,0 +1,335 @@
+"""
+Data access layer.
+
+peewee and PyMySQL are blocking, so handlers never issue queries on the event loop directly.
+Every query goes through :func:`run_db`, which executes it on a database lane and returns
+an awaitable. A lane is a single worker thread with its own connection, used by one caller
+at a time.
+
+Handlers run in a :class:`UnitOfWork`(see :func:`unit_of_work`): the first query of an
+update takes a lane and opens a transaction, all following queries of the update run on the
+same lane and connection, and the transaction is committed once when the handler returns or
+rolled back when it raises. A handler which has to send messages after its writes may call
+:func:`commit` first, so the lane is not held while it waits for Telegram; queries made after
+it start a new transaction. Queries made outside a handler(background writes, startup)
+borrow a free lane for a single autocommit call.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+from peewee import SqliteDatabase
+from playhouse.pool import PooledDatabase
+
+from app import metrics, query_audit
+from app.config import DB_WORKERS
+from app.models import db
+from app.query_audit import QueryAudit
+
+logger = logging.getLogger(__name__)
+
+# SQLite allows a single writer, one lane with one connection never waits for a lock
+LANES = 1 if isinstance(db, SqliteDatabase) else DB_WORKERS
+_lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix="db%s" % n) for n in range(LANES)]
+_free: list[ThreadPoolExecutor] = list(_lanes)
+_waiting: deque[asyncio.Future] = deque()
+
+_unit: ContextVar["UnitOfWork | None"] = ContextVar("unit_of_work", default=None)
+# Counter of the call running on the current lane thread
+_local = threading.local()
+_totals = {"units": 0, "queries": 0, "query_seconds": 0.0, "commits": 0, "rollbacks": 0}
+
+
+class _Counter:
+    __slots__ = ("queries", "query_seconds", "audit")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        # Only updates are audited
+        self.audit = None
+
+
+_execute_sql = db.execute_sql
+
+
+def _counted_execute_sql(sql, params=None, *args, **kwargs):
+    counter = getattr(_local, "counter", None)
+    if counter is None:
+        return _execute_sql(sql, params, *args, **kwargs)
+    counter.queries += 1
+    if counter.audit is not None:
+        counter.audit.record(sql)
+    started = time.perf_counter()
+    try:
+        return _execute_sql(sql, params, *args, **kwargs)
+    finally:
+        counter.query_seconds += time.perf_counter() - started
+
+
+db.execute_sql = _counted_execute_sql
+
+
+async def _acquire() -> ThreadPoolExecutor:
+    while not _free:
+        future = asyncio.get_running_loop().create_future()
+        _waiting.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Woken up but cancelled before taking the lane, pass the wake up on
+                _wake()
+            raise
+    return _free.pop()
+
+
+def _release(lane: ThreadPoolExecutor) -> None:
+    _free.append(lane)
+    _wake()
+
+
+def _wake() -> None:
+    while _waiting:
+        future = _waiting.popleft()
+        if not future.done():
+            future.set_result(None)
+            return
+
+
+def _connect() -> None:
+    # peewee connections are thread local, each lane keeps its own one open. Pooled ones are
+    # checked out for a single call or unit of work, so idle ones get recycled by the pool
+    db.connect(reuse_if_open=True)
+
+
+def _call(counter: _Counter, func, args, kwargs):
+    _local.counter = counter
+    try:
+        if isinstance(db, PooledDatabase):
+            with db.connection_context():
+                return func(*args, **kwargs)
+        _connect()
+        return func(*args, **kwargs)
+    finally:
+        _local.counter = None
+
+
+class UnitOfWork:
+    """Database work of one update, see the module documentation."""
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.commits = 0
+        self.rollbacks = 0
+        self.finished = False
+        # Statements of the update, see app.query_audit
+        self.audit = QueryAudit() if query_audit.ENABLED else None
+        self._lane: ThreadPoolExecutor | None = None
+        self._transaction = None
+        self._rollback_callbacks: list[tuple] = []
+        self._commit_callbacks: list[tuple] = []
+
+    def after_commit(self, callback, *args) -> None:
+        """Calls callback(*args) on the lane thread once the transaction is committed."""
+        self._commit_callbacks.append((callback, args))
+
+    def on_rollback(self, callback, *args) -> None:
+        """Calls callback(*args) on the lane thread if the transaction is rolled back."""
+        self._rollback_callbacks.append((callback, args))
+
+    async def run(self, func, args, kwargs):
+        if self.audit is not None:
+            self.audit.handler = metrics.current_handler()
+        if self._lane is None:
+            self._lane = await _acquire()
+        return await asyncio.get_running_loop().run_in_executor(self._lane, self._call, func, args, kwargs)
+
+    async def commit(self) -> None:
+        """Commits the transaction opened so far and releases the lane, the next query opens a new one."""
+        await self._end_transaction(None)
+
+    async def finish(self, error: BaseException = None) -> None:
+        """Commits the transaction, or rolls it back if the handler raised error."""
+        self.finished = True
+        try:
+            await self._end_transaction(error)
+        finally:
+            _totals["units"] += 1
+            _totals["queries"] += self.queries
+            _totals["query_seconds"] += self.query_seconds
+            _totals["commits"] += self.commits
+            _totals["rollbacks"] += self.rollbacks
+            logger.debug("Unit of work: %s queries in %.1f ms, %s commits, %s rollbacks", self.queries,
+                         self.query_seconds * 1000, self.commits, self.rollbacks)
+            if self.audit is not None:
+                self.audit.report()
+
+    async def _end_transaction(self, error: BaseException | None) -> None:
+        if self._lane is None:
+            return
+        lane, self._lane = self._lane, None
+        try:
+            # Shielded, so a cancelled handler still ends its transaction before the lane is reused
+            await asyncio.shield(asyncio.get_running_loop().run_in_executor(lane, self._end, error))
+        finally:
+            _release(lane)
+
+    def _call(self, func, args, kwargs):
+        _local.counter = self
+        try:
+            if self._transaction is None:
+                _connect()
+                transaction = db.atomic()
+                transaction.__enter__()
+                self._transaction = transaction
+            return func(*args, **kwargs)
+        finally:
+            _local.counter = None
+
+    def _end(self, error: BaseException | None) -> None:
+        if self._transaction is None:
+            return
+        _local.counter = self
+        try:
+            if error is None:
+                self._transaction.__exit__(None, None, None)
+                self.commits += 1
+                for callback, args in self._commit_callbacks:
+                    callback(*args)
+            else:
+                self._transaction.__exit__(type(error), error, error.__traceback__)
+                self.rollbacks += 1
+                for callback, args in self._rollback_callbacks:
+                    callback(*args)
+        finally:
+            _local.counter = None
+            self._transaction = None
+            self._rollback_callbacks.clear()
+            self._commit_callbacks.clear()
+            if isinstance(db, PooledDatabase):
+                db.close()
+
+
+def unit_of_work(handler):
+    """
+    Runs async handler in a unit of work, handlers called from it join the same one. Latency and
+    queries of the update are recorded in app.metrics, labelled with the name of handler.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        if current_unit() is not None:
+            return await handler(*args, **kwargs)
+        unit = UnitOfWork()
+        token = _unit.set(unit)
+        started = metrics.begin(handler.__name__)
+        error = None
+        try:
+            try:
+                result = await handler(*args, **kwargs)
+            except BaseException as e:
+                await unit.finish(e)
+                raise
+            finally:
+                _unit.reset(token)
+            await unit.finish()
+            return result
+        except BaseException as e:
+            # Raised by the handler or by the commit
+            error = e
+            raise
+        finally:
+            metrics.end(started, unit.queries, unit.query_seconds, error)
+
+    return wrapper
+
+
+def on_rollback(callback, *args) -> None:
+    """
+    Calls callback(*args) if the unit of work running on the current lane thread is rolled back,
+    e.g. to drop cached copies of saved rows. Does nothing outside a unit of work.
+    """
+    unit = getattr(_local, "counter", None)
+    if isinstance(unit, UnitOfWork):
+        unit.on_rollback(callback, *args)
+
+
+def after_commit(callback, *args) -> None:
+    """
+    Calls callback(*args) once the unit of work running on the current lane thread is committed,
+    e.g. to tell other processes about saved rows. Outside a unit of work statements commit on
+    their own and callback is called right away.
+    """
+    unit = getattr(_local, "counter", None)
+    if isinstance(unit, UnitOfWork):
+        unit.after_commit(callback, *args)
+    else:
+        callback(*args)
+
+
+async def commit() -> None:
+    """
+    Commits the transaction of the running handler and releases its lane, e.g. before it waits
+    for the network. Writes made so far are kept even if the handler raises afterwards. Does
+    nothing outside a unit of work or before its first query.
+    """
+    unit = current_unit()
+    if unit is not None:
+        await unit.commit()
+
+
+def current_unit() -> UnitOfWork | None:
+    """Unit of work of the running handler, None outside handlers."""
+    unit = _unit.get()
+    return unit if unit is not None and not unit.finished else None
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Runs blocking database code on a database lane, inside the transaction of the current
+    unit of work if there is one.
+
+    Usage:
+        user = await run_db(User.get_or_none, id=1)
+        tokens = await run_db(list, Token.select().paginate(1, 5))
+
+    :param func: Callable which issues peewee queries
+    :return: Result of the callable
+    """
+    unit = current_unit()
+    if unit is not None:
+        return await unit.run(func, args, kwargs)
+    counter = _Counter()
+    lane = await _acquire()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(lane, _call, counter, func, args, kwargs)
+    finally:
+        _release(lane)
+        _totals["queries"] += counter.queries
+        _totals["query_seconds"] += counter.query_seconds
+
+
+def stats() -> dict:
+    """Finished units of work, queries, seconds spent in them, commits and rollbacks since start, and free lanes."""
+    return {**_totals, "lanes": LANES, "free_lanes": len(_free)}
+
+
+def _close() -> None:
+    if not db.is_closed():
+        db.close()
+
+
+def shutdown(wait: bool = True) -> None:
+    """Closes connections of the database lanes and stops them, closes pooled connections."""
+    for lane in _lanes:
+        lane.submit(_close)
+        lane.shutdown(wait=wait)
+    if isinstance(db, PooledDatabase):
+        db.close_all()
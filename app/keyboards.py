@@ -1,8 +1,54 @@
+"""
+Inline keyboards.
+
+Keyboards only depend on their arguments(language and conversation ID), so they are
+memoized: menus are built once per language, conversation keyboards are kept in a bounded
+LRU cache. telegram objects can not be changed once created, so cached keyboards are shared
+by all replies. :func:`clear` drops the keyboards when texts are reloaded.
+"""
+import functools
+
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 
-from app.translation import translate
+from app.translation import translate, catalog
+
+# Keyboards kept per menu(one per language) and per conversation keyboard
+MENUS = 16
+CONVERSATIONS = 1024
+
+_caches = []
+
+
+def cached(maxsize: int):
+    """Memoizes keyboard function by its arguments in an LRU cache of maxsize keyboards."""
+
+    def decorator(function):
+        function = functools.lru_cache(maxsize=maxsize)(function)
+        _caches.append(function)
+        return function
+
+    return decorator
+
+
+def clear() -> None:
+    """Drops cached keyboards."""
+    for function in _caches:
+        function.cache_clear()
 
 
+catalog.on_reload(clear)
+
+
+def stats() -> dict:
+    infos = [function.cache_info() for function in _caches]
+    return {
+        "size": sum(info.currsize for info in infos),
+        "hits": sum(info.hits for info in infos),
+        "misses": sum(info.misses for info in infos),
+    }
+
+
+@cached(MENUS)
 def conversation_start() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🦅🦅🦅🦅🦅", callback_data="lang_en"),
@@ -10,10 +56,12 @@ def conversation_start() -> InlineKeyboardMarkup:
     ])
 
 
+@cached(MENUS)
 def user_start(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[InlineKeyboardButton(translate("contact_support_b", lang), callback_data="start1")]])
 
 
+@cached(MENUS)
 def agent(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("ag_b1", lang), callback_data="ag1")],
@@ -22,12 +70,14 @@ def agent(lang: str) -> InlineKeyboardMarkup:
     ])
 
 
+@cached(MENUS)
 def authorization(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("token_b", lang), callback_data="ag_token")]
     ])
 
 
+@cached(MENUS)
 def admin(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("add_agent_b", lang), callback_data="agent_add"),
@@ -38,6 +88,7 @@ def admin(lang: str) -> InlineKeyboardMarkup:
     ])
 
 
+@cached(MENUS)
 def tokens_pagination(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("previous_page_b", lang), callback_data="tokens_previous")],
@@ -46,6 +97,7 @@ def tokens_pagination(lang: str) -> InlineKeyboardMarkup:
     ])
 
 
+@cached(CONVERSATIONS)
 def a_c_pagination(lang: str, *args) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("inspect_conv_b", lang), callback_data="inspect_id_%s" % args[0])],
@@ -55,6 +107,7 @@ def a_c_pagination(lang: str, *args) -> InlineKeyboardMarkup:
     ])
 
 
+@cached(CONVERSATIONS)
 def c_c_pagination(lang: str, *args):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("inspect_conv_b", lang), callback_data="inspect_id_%s" % args[0])],
@@ -64,6 +117,7 @@ def c_c_pagination(lang: str, *args):
     ])
 
 
+@cached(CONVERSATIONS)
 def a_j_c_pagination(lang: str, *args):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("inspect_conv_b", lang), callback_data="inspect_id_%s" % args[0])],
@@ -73,6 +127,7 @@ def a_j_c_pagination(lang: str, *args):
     ])
 
 
+@cached(MENUS)
 def agents_pagination(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("previous_page_b", lang), callback_data="agent_previous_page")],
@@ -81,12 +136,14 @@ def agents_pagination(lang: str) -> InlineKeyboardMarkup:
     ])
 
 
+@cached(MENUS)
 def admin_back_one_btn(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("return_b", lang), callback_data="cancel_admin")],
     ])
 
 
+@cached(MENUS)
 def agent_add_try_again(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("try_again_b", lang), callback_data="agent_add")],
@@ -94,6 +151,7 @@ def agent_add_try_again(lang: str) -> InlineKeyboardMarkup:
     ])
 
 
+@cached(MENUS)
 def token_try_again(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(translate("try_again_b", lang), callback_data="ag_token"),
@@ -101,12 +159,33 @@ def token_try_again(lang: str) -> InlineKeyboardMarkup:
     ])
 
 
-def inspect_messages(lang: str, *args) -> InlineKeyboardMarkup:
+def inspect_messages(lang: str, *args, attachments=()) -> InlineKeyboardMarkup:
+    """:param attachments: (message ID, attachment type) of messages on the page with an attachment"""
+    if not attachments:
+        return _inspect_messages(lang, args[0])
+    head, tail = _inspect_rows(lang, args[0])
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(text="ID: %s" % args[0], callback_data='inspect_id_%s' % args[0])],
-        [InlineKeyboardButton(text=translate("give_answer_b", lang),
-                              callback_data="join_conversation_%s" % args[0])],
-        [InlineKeyboardButton(translate("previous_page_b", lang), callback_data="inspect_previous_page")],
-        [InlineKeyboardButton(translate("return_b", lang), callback_data="cancel_agent")],
-        [InlineKeyboardButton(translate("next_page_b", lang), callback_data="inspect_next_page")]
+        *head,
+        *[[InlineKeyboardButton(text="📎 %s" % kind, callback_data="attachment_%s" % message_id)]
+          for message_id, kind in attachments],
+        *tail
     ])
+
+
+@cached(CONVERSATIONS)
+def _inspect_messages(lang: str, conv_id: int) -> InlineKeyboardMarkup:
+    head, tail = _inspect_rows(lang, conv_id)
+    return InlineKeyboardMarkup([*head, *tail])
+
+
+@cached(CONVERSATIONS)
+def _inspect_rows(lang: str, conv_id: int) -> tuple[tuple, tuple]:
+    """Button rows above and below the attachment buttons."""
+    return (
+        ((InlineKeyboardButton(text="ID: %s" % conv_id, callback_data='inspect_id_%s' % conv_id),),
+         (InlineKeyboardButton(text=translate("give_answer_b", lang),
+                               callback_data="join_conversation_%s" % conv_id),)),
+        ((InlineKeyboardButton(translate("previous_page_b", lang), callback_data="inspect_previous_page"),),
+         (InlineKeyboardButton(translate("return_b", lang), callback_data="cancel_agent"),),
+         (InlineKeyboardButton(translate("next_page_b", lang), callback_data="inspect_next_page"),))
+    )
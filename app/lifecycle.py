@@ -0,0 +1,104 @@
+"""
+Graceful shutdown.
+
+SIGTERM, SIGINT and the admin shutdown button start the same sequence: the updater stops
+accepting updates, updates already received are handled to the end, customers of open
+conversations are told that support is offline, and the application is stopped, which
+writes the persistence and write-behind queues. Draining and notifying stop waiting
+SHUTDOWN_TIMEOUT seconds after the start, updates still queued then are handled by
+Application.stop before the queues are written. The database is closed by SupportBot.run
+once the application has stopped. A second signal stops the bot without waiting.
+"""
+import asyncio
+import contextvars
+import logging
+import signal
+from typing import Callable
+
+from telegram.ext import Application
+
+from app.dal import run_db
+from app.models import User
+from app.routing import routing_index
+from app.translation import translate, catalog
+
+logger = logging.getLogger(__name__)
+
+SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+def customer_languages(user_ids: list[int]) -> dict[int, str]:
+    """Blocking, call it through :func:`app.dal.run_db`."""
+    return dict(User.select(User.id, User.language).where(User.id.in_(user_ids)).tuples())
+
+
+async def notify_customers(app: Application, owns: Callable[[int], bool] = None) -> int:
+    """
+    Tells customers of open conversations that support is offline, returns number of notified ones.
+    :param owns: Tells if customer is served by this process, see :mod:`app.sharding`. All are by default
+    """
+    chats = {route.customer_chat: route.customer_id for route in routing_index.routes()
+             if owns is None or owns(route.customer_id)}
+    if not chats:
+        return 0
+    languages = await run_db(customer_languages, list(set(chats.values())))
+    await asyncio.to_thread(catalog.preload, set(languages.values()))
+    results = await asyncio.gather(
+        *(app.bot.send_message(chat_id, translate("support_offline", languages.get(customer_id, "lang_en")))
+          for chat_id, customer_id in chats.items()),
+        return_exceptions=True)
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        logger.warning("Failed to notify %s customers about shutdown, e.g. %s", len(failed), failed[0])
+    return len(results) - len(failed)
+
+
+class GracefulShutdown:
+    def __init__(self, app: Application, timeout: float, owns: Callable[[int], bool] = None):
+        """
+        :param app: Application started with run_polling or run_webhook and stop_signals=None
+        :param timeout: Seconds to wait for updates and notifications
+        :param owns: Tells if customer is served by this process, see :func:`notify_customers`
+        """
+        self.app = app
+        self.timeout = timeout
+        self.owns = owns
+        self._task: asyncio.Task | None = None
+
+    def install_signal_handlers(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in SIGNALS:
+            try:
+                loop.add_signal_handler(sig, self.request)
+            except NotImplementedError:
+                # Windows, the default handler of SIGINT still stops the bot without draining
+                logger.warning("Graceful shutdown on %s is not supported by the event loop", sig.name)
+
+    def request(self) -> None:
+        """Starts the shutdown sequence, stops the bot immediately if it is already running."""
+        if self._task is not None:
+            logger.warning("Shutdown requested again, stopping without waiting")
+            self.app.stop_running()
+            return
+        # Fresh context, so a shutdown requested by a handler does not run in its unit of work
+        self._task = asyncio.get_running_loop().create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        logger.info("Shutting down, handling received updates for up to %s s", self.timeout)
+        try:
+            if self.app.updater and self.app.updater.running:
+                await asyncio.wait_for(self.app.updater.stop(), max(0.0, deadline - loop.time()))
+            await asyncio.wait_for(self.app.update_queue.join(), max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            logger.warning("Shutdown deadline reached, %s queued updates are handled while stopping",
+                           self.app.update_queue.qsize())
+        try:
+            notified = await asyncio.wait_for(notify_customers(self.app, self.owns), max(0.0, deadline - loop.time()))
+            logger.info("%s customers notified about shutdown", notified)
+        except asyncio.TimeoutError:
+            logger.warning("Shutdown deadline reached while notifying customers")
+        except Exception as e:
+            logger.error("Failed to notify customers about shutdown: %s", e)
+        self.app.stop_running()
@@ -1,18 +1,37 @@
+import asyncio
 import logging
 import os
 import re
-import sys
 from datetime import datetime
 
+from app import metrics, query_audit
+from app.cache import user_cache
+from app.dal import run_db, unit_of_work, commit, shutdown as shutdown_db, stats as db_stats
 from app.utils import (
-    generate_token, get_user, get_pages, check_callback_data, clear_context, paginate_closed_conversations,
-    paginate_joined_conversations, paginate_active_conversations, paginate_tokens, paginate_inspect, paginate_agent_list
+    generate_token, get_user, get_pages, clear_context, paginate_closed_conversations,
+    paginate_joined_conversations, paginate_active_conversations, paginate_tokens, paginate_inspect, paginate_agent_list,
+    add_message, used_languages
 )
 import app.keyboards as kb
 from app.models import db, User, FutureAgent, Token, Conversation, Message
+from app.router import CallbackRouter, Route, AGENT, ADMIN
+from app.session import get_session, TOKEN_REPLY, USERNAME_REPLY
 import telegram
 
-from app.config import TOKEN
+from app.config import (
+    TOKEN, SHUTDOWN_TIMEOUT, WORKERS, WRITE_BEHIND, WRITE_BEHIND_INTERVAL_MS, WRITE_BEHIND_MAX_ROWS, PERSISTENCE_INTERVAL, CONCURRENT_UPDATES,
+    TELEGRAM_API_URL, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS,
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, LOCALES_RELOAD_INTERVAL,
+    METRICS_PORT, METRICS_LISTEN
+)
+from app.persistence import DatabasePersistence
+from app.processor import KeyedUpdateProcessor
+from app.lifecycle import GracefulShutdown
+from app.media import ATTACHMENTS, attachment_of, relay, send_attachment
+from app.ratelimit import OutboundRateLimiter, request_priority, LOW
+from app.routing import routing_index
+from app.sharding import Shard, ShardUpdater, CountingQueue, Supervisor, broadcast, TEXTS
+from app.write_behind import MessageWriter
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -22,28 +41,95 @@ from telegram.ext import (
     filters,
     CallbackQueryHandler, ConversationHandler
 )
-from app.translation import translate
+from app.translation import translate, catalog, watch, ensure_loaded
 
 
 class SupportBot:
-    def __init__(self, db_handler, token, logger=True):
+    def __init__(self, db_handler, token, logger=True, shard: Shard = None):
+        """
+        :param shard: Set in worker processes, which get updates from the supervisor, see app.sharding
+        """
         self.db: db = db_handler
-
-        self.app = Application.builder().token(token).build()
-        self.app.add_handler(CommandHandler("start", self.start))
-        self.app.add_handler(CommandHandler("agent", self.agent))
-        self.app.add_handler(CommandHandler("admin", self.admin))
-        self.app.add_handler(CallbackQueryHandler(self.query))
-        self.app.add_handler(CommandHandler("end", self.end_conv))
-        self.app.add_handler(CommandHandler("inspect", self.inspect))
-
-        message_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_reply)
+        self.shard = shard
+        self.texts_watcher: asyncio.Task | None = None
+        self.metrics_server = None
+        self.message_writer = MessageWriter(WRITE_BEHIND_INTERVAL_MS, WRITE_BEHIND_MAX_ROWS) if WRITE_BEHIND else None
+        # Workers share the global limit of the bot
+        global_rate = OUTBOUND_GLOBAL_RATE / shard.workers if shard else OUTBOUND_GLOBAL_RATE
+        limiter = OutboundRateLimiter(global_rate, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+
+        builder = (Application.builder().token(token)
+                   .base_url(TELEGRAM_API_URL)
+                   .rate_limiter(limiter)
+                   .persistence(DatabasePersistence(PERSISTENCE_INTERVAL))
+                   .post_init(self.post_init)
+                   .post_shutdown(self.post_shutdown))
+        if CONCURRENT_UPDATES > 1:
+            builder.concurrent_updates(KeyedUpdateProcessor(CONCURRENT_UPDATES))
+        if shard:
+            builder.updater(None).update_queue(CountingQueue())
+        self.app = builder.build()
+        self.shutdown = GracefulShutdown(self.app, SHUTDOWN_TIMEOUT, shard.owns if shard else None)
+        if shard:
+            self.app.updater = ShardUpdater(self.app.bot, self.app.update_queue, shard, self.shutdown.request)
+        # Every handler runs in a unit of work: one transaction per update, see app.dal
+        self.app.add_handler(CommandHandler("start", unit_of_work(self.start)))
+        self.app.add_handler(CommandHandler("agent", unit_of_work(self.agent)))
+        self.app.add_handler(CommandHandler("admin", unit_of_work(self.admin)))
+        self.router = self.routes()
+        self.app.add_handler(CallbackQueryHandler(unit_of_work(self.query)))
+        self.app.add_handler(CommandHandler("end", unit_of_work(self.end_conv)))
+        self.app.add_handler(CommandHandler("inspect", unit_of_work(self.inspect)))
+        self.app.add_handler(CommandHandler("reload", unit_of_work(self.reload_texts)))
+
+        message_handler = MessageHandler((filters.TEXT | ATTACHMENTS) & ~filters.COMMAND,
+                                         unit_of_work(self.handle_reply))
         self.app.add_handler(message_handler)
         if logger:
             self.logger = self.logger_setup()
+        # Served as gauges by app.metrics
+        metrics.register("user_cache", user_cache.stats)
+        metrics.register("routing", routing_index.stats)
+        metrics.register("keyboards", kb.stats)
+        metrics.register("db", db_stats)
+        metrics.register("outbound", limiter.stats)
+        if hasattr(self.db, "pool_stats"):
+            metrics.register("db_pool", self.db.pool_stats)
+        if query_audit.ENABLED:
+            metrics.register("query_audit", query_audit.stats)
+
+    async def post_init(self, _app: Application):
+        # Workers are stopped by the supervisor
+        if not self.shard:
+            self.shutdown.install_signal_handlers()
+        await run_db(routing_index.warm)
+        # Lookups never read files on the event loop, languages in use are read here
+        await asyncio.to_thread(catalog.preload, await run_db(used_languages))
+        if self.message_writer:
+            await self.message_writer.start()
+        if LOCALES_RELOAD_INTERVAL > 0:
+            self.texts_watcher = asyncio.create_task(watch(LOCALES_RELOAD_INTERVAL))
+        # Metrics of workers are served by the supervisor
+        if METRICS_PORT and not self.shard:
+            self.metrics_server = metrics.serve(METRICS_LISTEN, METRICS_PORT, metrics.render)
+
+    async def post_shutdown(self, _app: Application):
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.texts_watcher:
+            self.texts_watcher.cancel()
+        if self.message_writer:
+            await self.message_writer.stop()
+
+    async def store_message(self, conv_id: int, user: User, text: str, attachment: tuple[str, str] = None) -> None:
+        """Stores message directly or through the write-behind stage."""
+        if self.message_writer:
+            self.message_writer.add(conv_id, user.id, text, attachment)
+            return
+        await run_db(add_message, conv_id, user, text, attachment)
 
     async def inspect(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        lang = self.get_lang(update, context)
+        lang = await self.get_lang(update, context)
         if len(context.args) == 1:
             try:
                 await self.query(update, context, data="inspect_id_" + context.args[0])
@@ -52,14 +138,23 @@ class SupportBot:
                 await update.message.reply_text(translate("wrong_type_1", lang=lang))
                 return
 
+    @query_audit.budget(5)
     async def end_conv(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        lang = self.get_lang(update, context)
-        conv: Conversation = context.user_data.get("conversation_context")
+        lang = await self.get_lang(update, context)
+        session = get_session(context)
+        if self.message_writer and session.conversation_id:
+            # Queued messages are stored before the conversation is closed and read with its summary
+            try:
+                await self.message_writer.flush()
+            except Exception as e:
+                # Retried by the background task, the conversation is closed anyway
+                if self.logger:
+                    self.logger.error("Failed to write queued messages: %s" % e)
+        conv = await session.conversation()
         if conv:
             conv.is_closed = True
-            conv.save()
-            self.db.logged_commit()
-            del context.user_data["conversation_context"]
+            await run_db(conv.save)
+            session.conversation_id = None
             await update.message.get_bot().send_message(text=translate("conv_closed_2", lang),
                                                         chat_id=conv.customer_chat)
             await update.message.reply_text(translate("conv_closed_1", lang) % conv.id)
@@ -84,176 +179,216 @@ class SupportBot:
         logger.addHandler(file_handler)
         return logger
 
+    def routes(self) -> CallbackRouter:
+        """Callback query routes, see :mod:`app.router`."""
+        router = CallbackRouter()
+        router.add(("lang_en", "lang_uk"), self.set_language, needs_user=False)
+        router.add("start1", self.start_conversation)
+        router.add("ag_token", self.ask_token)
+        router.add("cancel", self.cancel, needs_user=False)
+        router.add("cancel_agent", self.cancel_agent, needs_user=False)
+        router.add("cancel_admin", self.cancel_admin, needs_user=False)
+        router.add("agent_add", self.ask_agent_username, roles=(ADMIN,), denied=self.start)
+        # List views are sent after replies to customers when the bot is throttled
+        router.add(("ag1", "a_c_previous", "a_c_next"), self.active_conversations, roles=(AGENT, ADMIN),
+                   denied=self.start, priority=LOW)
+        router.add(("ag2", "a_j_c_previous", "a_j_c_next"), self.joined_conversations, roles=(AGENT, ADMIN),
+                   denied=self.start, priority=LOW)
+        router.add(("ag3", "c_c_previous", "c_c_next"), self.closed_conversations, roles=(AGENT, ADMIN),
+                   denied=self.start, priority=LOW)
+        router.add("token_gen", self.create_token, roles=(ADMIN,), denied=self.unauthorized)
+        router.add(("token_list", "tokens_previous", "tokens_next"), self.token_list, roles=(ADMIN,),
+                   denied=self.unauthorized, priority=LOW)
+        router.add(("inspect_list", "inspect_previous_page", "inspect_next_page"), self.inspect_messages,
+                   roles=(AGENT, ADMIN), denied=self.unauthorized, priority=LOW)
+        router.add("inspect_id_", self.inspect_messages, prefix=True, roles=(AGENT, ADMIN), denied=self.unauthorized,
+                   priority=LOW)
+        router.add("attachment_", self.show_attachment, prefix=True, roles=(AGENT, ADMIN), denied=self.unauthorized,
+                   priority=LOW)
+        router.add(("agent_list", "agent_previous_page", "agent_next_page"), self.agent_list, roles=(ADMIN,),
+                   denied=self.start, priority=LOW)
+        router.add("bot_shutdown", self.bot_shutdown, roles=(ADMIN,), denied=self.start)
+        router.add("join_conversation_", self.join_conversation, prefix=True, roles=(AGENT, ADMIN))
+        return router
+
     async def query(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data=None, ):
-        self.db.logged_commit()
         query = update.callback_query
         cd = query.data if query else data
         try:
-            if cd in ("lang_en", "lang_uk"):
-                tg_user = get_user(update, return_tg_data=True)
-
-                user = get_user(update)
-                if user:
-                    if user.language != cd:
-                        user.language = cd
-                        user.save()
-                else:
-                    User.create(id=tg_user.id, tg_name=tg_user.first_name, tg_username=tg_user.username,
-                                language=cd)
-                context.user_data["lang"] = cd
-                await self.welcome(update, context)
+            route = self.router.resolve(cd)
+            if route is None:
                 return
-            if check_callback_data(cd, ("page", "previous", "next")) and context.user_data.get("user_context"):
-                user = context.user_data.get("user_context")
-            else:
-                user = get_user(update)
-                context.user_data.setdefault("user_context", user)
+            metrics.label(route.handler.__name__)
+            priority = request_priority.set(route.priority)
+            try:
+                await self.dispatch(update, context, route, cd)
+            finally:
+                request_priority.reset(priority)
+        finally:
+            if not data:
+                await query.answer()
 
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE, route: Route, cd: str):
+        """Checks user and roles required by route and calls its handler."""
+        user = None
+        if route.needs_user:
+            user = await get_session(context).user(update)
             if not user:
                 await self.start(update, context)
                 return
-            lang = user.language
-
-            if cd == "start1":
-                conversation: Conversation = Conversation.create(customer=user,
-                                                                 customer_chat=update.callback_query.message.chat_id)
-                await update.callback_query.message.edit_text(translate("conversation_start_1", lang))
-                context.user_data.setdefault("conversation_created", True)
-                context.user_data.setdefault("customer_conversation_context", conversation)
-                return
-
-            elif cd == "ag_token":
-                context.user_data['waiting_for_token_reply'] = True
-                kwargs = {
-                    "text": translate("send_token", lang)
-                }
-                await update.callback_query.message.edit_text(**kwargs)
-                return
-
-            elif cd == "cancel":
-                clear_context(context)
-                await self.welcome(update, context)
-                return
-
-            elif cd == "agent_add":
-                if not user.is_admin:
-                    await self.start(update, context)
-                    return
-
-                context.user_data["waiting_for_username_reply"] = True
-                await update.callback_query.message.edit_text(translate("future_agent_add", lang),
-                                                              reply_markup=kb.admin_back_one_btn(lang))
-                return
-
-            elif cd in ("ag1", "a_c_previous", "a_c_next"):
-                if not user.is_agent or not user.is_admin:
-                    await self.start(update, context)
-                    return
-                await paginate_active_conversations(update, context, user, lang)
-                return
-
-            elif cd in ("ag2", "a_j_c_previous", "a_j_c_next"):
-                if not user.is_agent or not user.is_admin:
-                    await self.start(update, context)
-                    return
-                await paginate_joined_conversations(update, context, user, lang)
-                return
-            elif cd in ("ag3", "c_c_previous", "c_c_next"):
-                if not user.is_agent or not user.is_admin:
-                    await self.start(update, context)
-                    return
-                await paginate_closed_conversations(update, context, user, lang)
-
-                return
-            elif cd == "cancel_agent":
-                clear_context(context)
-                await self.authorized(update, context, is_agent=True)
-                return
-
-            elif cd == "cancel_admin":
-                clear_context(context)
-                await self.admin(update, context)
+            if not self.router.allowed(route, user):
+                if route.denied:
+                    await route.denied(update, context)
                 return
+        await route.handler(update, context, user, cd)
 
-            elif cd == "token_gen":
-                if not user.is_admin:
-                    await self.unauthorized(update, context)
-                    return
+    @query_audit.budget(4)
+    async def set_language(self, update: Update, context: ContextTypes.DEFAULT_TYPE, _user: None, cd: str):
+        tg_user = get_user(update, return_tg_data=True)
 
-                token = Token.create(token=generate_token())
-                if self.logger:
-                    self.logger.info("Token with ID %s created by: %s" % (token.id, user.id))
-                await update.callback_query.message.edit_text(f"OTP Token:\n```{token.token}```",
-                                                              parse_mode='MarkdownV2',
-                                                              reply_markup=kb.admin_back_one_btn(lang))
-                return
-
-            elif cd in ("token_list", "tokens_previous", "tokens_next"):
-                if not user.is_admin:
-                    await self.unauthorized(update, context)
-                    return
-                await paginate_tokens(update, context, user, lang)
-                return
-            elif check_callback_data(cd, ("inspect_list", "inspect_previous_page",
-                                          "inspect_next_page", "inspect_id_")):
-                if not user.is_agent or not user.is_admin:
-                    await self.unauthorized(update, context)
-                    return
-                await paginate_inspect(update, context, user, lang, data)
-                return
-
-            elif cd in ("agent_list", "agent_previous_page", "agent_next_page"):
-                if not user.is_admin:
-                    await self.start(update, context)
-                    return
-                await paginate_agent_list(update, context, user, lang)
-                return
+        user = await run_db(get_user, update)
+        if user:
+            if user.language != cd:
+                user.language = cd
+                await run_db(user.save)
+        else:
+            await run_db(User.create, id=tg_user.id, tg_name=tg_user.first_name,
+                         tg_username=tg_user.username, language=cd)
+        await ensure_loaded(cd)
+        get_session(context).lang = cd
+        await self.welcome(update, context)
+
+    async def start_conversation(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        conversation: Conversation = await run_db(Conversation.create, customer=user, customer_name=user.tg_name,
+                                                  customer_chat=update.callback_query.message.chat_id)
+        await update.callback_query.message.edit_text(translate("conversation_start_1", user.language))
+        session = get_session(context)
+        session.conversation_created = True
+        session.customer_conversation_id = conversation.id
+
+    async def ask_token(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        get_session(context).waiting_for = TOKEN_REPLY
+        kwargs = {
+            "text": translate("send_token", user.language)
+        }
+        await update.callback_query.message.edit_text(**kwargs)
 
-            elif cd == "bot_shutdown":
-                if not user.is_admin:
-                    await self.start(update, context)
-                    return
-                await query.answer()
-                self.app.stop_running()
-                # await self.app.stop()
-                try:
-                    sys.exit()
-                except SystemExit:
-                    pass
+    async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE, _user: None, _cd: str):
+        clear_context(context)
+        await self.welcome(update, context)
+
+    async def cancel_agent(self, update: Update, context: ContextTypes.DEFAULT_TYPE, _user: None, _cd: str):
+        clear_context(context)
+        await self.authorized(update, context, is_agent=True)
+
+    async def cancel_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE, _user: None, _cd: str):
+        clear_context(context)
+        await self.admin(update, context)
+
+    async def ask_agent_username(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        get_session(context).waiting_for = USERNAME_REPLY
+        await update.callback_query.message.edit_text(translate("future_agent_add", user.language),
+                                                      reply_markup=kb.admin_back_one_btn(user.language))
+
+    @query_audit.budget(4)
+    async def active_conversations(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        await paginate_active_conversations(update, context, user, user.language)
+
+    @query_audit.budget(4)
+    async def joined_conversations(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        await paginate_joined_conversations(update, context, user, user.language)
+
+    @query_audit.budget(4)
+    async def closed_conversations(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        await paginate_closed_conversations(update, context, user, user.language)
+
+    async def create_token(self, update: Update, _context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        token = await run_db(Token.create, token=generate_token())
+        if self.logger:
+            self.logger.info("Token with ID %s created by: %s" % (token.id, user.id))
+        await update.callback_query.message.edit_text(f"OTP Token:\n```{token.token}```",
+                                                      parse_mode='MarkdownV2',
+                                                      reply_markup=kb.admin_back_one_btn(user.language))
+
+    async def token_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        await paginate_tokens(update, context, user, user.language)
+
+    @query_audit.budget(5)
+    async def inspect_messages(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, cd: str):
+        # Data is passed directly only by the /inspect command
+        await paginate_inspect(update, context, user, user.language, None if update.callback_query else cd)
+
+    async def show_attachment(self, update: Update, _context: ContextTypes.DEFAULT_TYPE, _user: User, cd: str):
+        message: Message = await run_db(Message.get_or_none, id=int(cd.split("_")[-1]))
+        if message and message.attachment_type:
+            await send_attachment(update.get_bot(), update.callback_query.message.chat_id, message.attachment_type,
+                                  message.file_id, message.body)
+
+    async def agent_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        await paginate_agent_list(update, context, user, user.language)
+
+    async def bot_shutdown(self, update: Update, _context: ContextTypes.DEFAULT_TYPE, user: User, _cd: str):
+        if self.logger:
+            self.logger.info("Shutdown requested by admin %s" % user.id)
+        if self.shard:
+            self.shard.request_shutdown()
+        else:
+            self.shutdown.request()
+
+    @query_audit.budget(5)
+    async def join_conversation(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, cd: str):
+        session = get_session(context)
+        lang = user.language
+        conv_id = session.listed_conversation_id
+        if conv_id:
+            session.listed_conversation_id = None
+        else:
+            conv_id = int(cd.split("_")[-1])
+        conv: Conversation = await run_db(Conversation.get_or_none, id=conv_id)
+        session.conversation_id = conv.id
+        first_agent = not conv.agent_id
+        await run_db(conv.join_conv, user, update.callback_query.message.chat_id)
+        # Joined before the messages are sent, the lane is not held while Telegram answers
+        await commit()
 
-            elif check_callback_data(cd, ("join_conversation",)):
+        await update.callback_query.edit_message_text(text=update.callback_query.message.text)
+        if first_agent:
+            await update.callback_query.get_bot().send_message(text=translate("ag_joined_2", lang),
+                                                               chat_id=conv.customer_chat)
 
-                if not user.is_admin or not user.is_agent:
-                    return
-                conv_id = context.user_data.get("conversation_id")
-                if conv_id:
-                    del context.user_data["conversation_id"]
-                else:
-                    if check_callback_data(cd, ("join_conversation",)):
-                        conv_id = int(cd.split("_")[-1])
-                    else:
-                        pattern = re.compile(r'ID: (\d+)')
-                        conv_id = pattern.search(update.callback_query.message.text).group(1)
-                await update.callback_query.edit_message_text(text=update.callback_query.message.text)
-                conv: Conversation = Conversation.get_or_none(id=conv_id)
-                context.user_data["conversation_context"] = conv
-                if not conv.agent:
-                    await update.callback_query.get_bot().send_message(text=translate("ag_joined_2", lang),
-                                                                       chat_id=conv.customer_chat)
-
-                conv.join_conv(user, update.callback_query.message.chat_id)
-
-                await update.callback_query.message.reply_text(translate("ag_joined_1", lang) % conv_id)
-                return
+        await update.callback_query.message.reply_text(translate("ag_joined_1", lang) % conv_id)
 
-        finally:
-            if not data:
-                await query.answer()
+    @staticmethod
+    def webhook_options() -> dict:
+        """
+        Arguments of Application.run_webhook and Updater.start_webhook from app.config.
+        The webhook server answers 200 as soon as the update is queued, before it is handled.
+        """
+        return {
+            "listen": WEBHOOK_LISTEN,
+            "port": WEBHOOK_PORT,
+            "url_path": WEBHOOK_PATH,
+            "webhook_url": WEBHOOK_URL,
+            "secret_token": WEBHOOK_SECRET,
+            "max_connections": WEBHOOK_MAX_CONNECTIONS,
+        }
 
     def run(self):
-        self.app.run_polling()
+        if WORKERS > 1 and not self.shard:
+            # This process only receives updates, see app.sharding
+            supervisor = Supervisor(self.app.updater, WORKERS, SHUTDOWN_TIMEOUT,
+                                    (METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None)
+            supervisor.run(self.webhook_options() if WEBHOOK_URL else None)
+            return
+        # Stop signals are handled by self.shutdown, see app.lifecycle. Workers read updates from the
+        # supervisor with ShardUpdater.start_polling
+        if WEBHOOK_URL and not self.shard:
+            self.app.run_webhook(**self.webhook_options(), stop_signals=None)
+        else:
+            self.app.run_polling(stop_signals=None)
+        shutdown_db()
 
-    def get_lang(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    async def get_lang(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
         """
         Retrieves the user's language from the context or the database.
 
@@ -265,15 +400,15 @@ class SupportBot:
         :return: The user's language code.
         :rtype: str
         """
-        lang = context.user_data.get("lang")
-        if not lang:
-            self.db.logged_commit()
-            user = get_user(update)
+        session = get_session(context)
+        if not session.lang:
+            user = await session.user(update)
             if user:
-                context.user_data["lang"] = user.language
+                await ensure_loaded(user.language)
+                session.lang = user.language
             else:
-                context.user_data["lang"] = "lang_en"
-        return lang
+                session.lang = "lang_en"
+        return session.lang
 
     @staticmethod
     async def start(update: Update, _context: ContextTypes.DEFAULT_TYPE):
@@ -292,7 +427,7 @@ class SupportBot:
 
     async def welcome(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Starting message with Contact Support button"""
-        lang = self.get_lang(update, context)
+        lang = await self.get_lang(update, context)
         user = get_user(update, return_tg_data=True)
 
         kwargs = {
@@ -303,11 +438,11 @@ class SupportBot:
 
     async def authorized(self, update: Update, context: ContextTypes.DEFAULT_TYPE, is_agent=False, is_admin=False):
         """Creates menu for agent or admin"""
-        if not context.user_data.get("lang"):
-            self.get_lang(update, context)
+        if not get_session(context).lang:
+            await self.get_lang(update, context)
             await self.authorized(update, context, is_agent, is_admin)
             return
-        lang = self.get_lang(update, context)
+        lang = await self.get_lang(update, context)
 
         if is_agent:
             kwargs = {
@@ -332,38 +467,54 @@ class SupportBot:
 
     async def admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Check if is admin and create admin menu"""
-        found = context.user_data.get("user_context") if context.user_data.get("user_context") else get_user(update)
+        session = get_session(context)
+        found = await session.user(update)
         if not found:
             await self.start(update, context)
             return
-        if found and found.is_admin:
+        if session.is_admin:
             await self.authorized(update, context, is_admin=True)
             return
         else:
             await self.unauthorized(update, context)
             return
 
+    async def reload_texts(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Reload texts from locale files, admins only"""
+        session = get_session(context)
+        user = await session.user(update)
+        if not user or not session.is_admin:
+            await self.unauthorized(update, context)
+            return
+        languages = await asyncio.to_thread(catalog.reload)
+        # Every worker reads the files itself
+        broadcast(TEXTS, 0)
+        if self.logger:
+            self.logger.info("Texts reloaded by admin %s: %s" % (user.id, ", ".join(languages)))
+        await update.message.reply_text(translate("texts_reloaded", user.language) % ", ".join(languages))
+
+    @query_audit.budget(4)
     async def agent(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Check if user is agent OR user is FutureAgent(by username) and create agent menu"""
         try:
 
             user = get_user(update, return_tg_data=True)
-            found = get_user(update)
+            found = await run_db(get_user, update)
 
             if not found:
                 await self.start(update, context)
                 return
-            lang = self.get_lang(update, context)
+            lang = await self.get_lang(update, context)
             if found and (found.is_agent or found.is_admin):
                 await self.authorized(update, context, is_agent=True)
                 return
             elif found and user.username:
-                f_ag = FutureAgent.get_or_none(tg_username=user.username)
+                f_ag = await run_db(FutureAgent.get_or_none, tg_username=user.username)
                 if f_ag and not f_ag.is_added:
                     found.is_agent = True
                     f_ag.is_added = True
-                    f_ag.save()
-                    found.save()
+                    await run_db(f_ag.save)
+                    await run_db(found.save)
                     if self.logger:
                         self.logger.info("User %s authorized as agent." % found.id)
                     await self.authorized(update, context, is_agent=True)
@@ -377,143 +528,129 @@ class SupportBot:
         except Exception as e:
             if self.logger:
                 self.logger.error(f"Ab error occurred: {e}")
-        finally:
-            self.db.logged_commit()
 
+    @query_audit.budget(8)
     async def handle_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        is_commit = False
-        try:
-
-            lang = self.get_lang(update, context)
-            text_reply = update.message.text
-            if 'waiting_for_token_reply' in context.user_data:
-                if text_reply == "ADMIN_QWERTY":
-                    self.db.logged_commit()
-                    user = get_user(update)
-                    user.is_agent = True
-                    user.is_admin = True
-                    user.save()
-                    is_commit = True
-                    await self.authorized(update, context, is_agent=True)
-                    del context.user_data['waiting_for_token_reply']
-                    return
-                token = Token.get_or_none(token=text_reply)
-                if token and not token.is_activated:
-                    self.db.logged_commit()
-                    user = get_user(update)
-                    if not user:
-                        await self.start(update, context)
-                        return
-                    user.is_agent = True
-                    user.save()
-                    token.is_activated = True
-                    token.save()
-                    is_commit = True
-                    if self.logger:
-                        self.logger.info(
-                            "Agent permissions added to user with ID %s via token with ID %s" % (user.id, token.id))
-                    await self.authorized(update, context, is_agent=True)
-                    del context.user_data['waiting_for_token_reply']
+        lang = await self.get_lang(update, context)
+        session = get_session(context)
+        attachment = attachment_of(update.message)
+        text_reply = update.message.text or update.message.caption or ""
+        if session.waiting_for == TOKEN_REPLY:
+            if text_reply == "ADMIN_QWERTY":
+                user = await run_db(get_user, update)
+                user.is_agent = True
+                user.is_admin = True
+                await run_db(user.save)
+                await self.authorized(update, context, is_agent=True)
+                session.waiting_for = None
+                return
+            token = await run_db(Token.get_or_none, token=text_reply)
+            if token and not token.is_activated:
+                user = await run_db(get_user, update)
+                if not user:
+                    await self.start(update, context)
                     return
-                else:
+                user.is_agent = True
+                await run_db(user.save)
+                token.is_activated = True
+                await run_db(token.save)
+                if self.logger:
+                    self.logger.info(
+                        "Agent permissions added to user with ID %s via token with ID %s" % (user.id, token.id))
+                await self.authorized(update, context, is_agent=True)
+                session.waiting_for = None
+                return
+            else:
 
-                    kwargs = {
-                        "text": translate("wrong_token", lang),
-                        "reply_markup": kb.token_try_again(lang)
-                    }
-                    if token and token.is_activated:
-                        kwargs["text"] = translate("activated_token", lang)
+                kwargs = {
+                    "text": translate("wrong_token", lang),
+                    "reply_markup": kb.token_try_again(lang)
+                }
+                if token and token.is_activated:
+                    kwargs["text"] = translate("activated_token", lang)
 
-                    await update.message.reply_text(**kwargs)
-                    return
+                await update.message.reply_text(**kwargs)
+                return
 
-            elif context.user_data.get("waiting_for_username_reply"):
-                self.db.logged_commit()
-                if len(text_reply) < 5 or "@" not in text_reply:
-                    await update.message.reply_text("Wrong username",
-                                                    reply_markup=kb.agent_add_try_again(lang))
-                    return
-                del context.user_data['waiting_for_username_reply']
-                filter = re.compile(r'@[\w_]+')
-                if filter.search(text_reply):
-                    nickname = text_reply.replace("@", "")
-                    f_agent: FutureAgent = FutureAgent.get_or_none(tg_username=nickname)
-
-                    if f_agent and not f_agent.is_added:
-                        kwargs = {
-                            "text": translate("already_added", lang, text_reply),
-                            "reply_markup": kb.agent_add_try_again(lang)
-                        }
-                        await update.message.reply_text(**kwargs)
-                        return
-                    elif f_agent and not f_agent.is_added:
-                        f_agent.is_added = False
-                        f_agent.save()
-                    elif not f_agent:
-                        FutureAgent.create(tg_username=nickname)
+        elif session.waiting_for == USERNAME_REPLY:
+            if len(text_reply) < 5 or "@" not in text_reply:
+                await update.message.reply_text("Wrong username",
+                                                reply_markup=kb.agent_add_try_again(lang))
+                return
+            session.waiting_for = None
+            filter = re.compile(r'@[\w_]+')
+            if filter.search(text_reply):
+                nickname = text_reply.replace("@", "")
+                f_agent: FutureAgent = await run_db(FutureAgent.get_or_none, tg_username=nickname)
+
+                if f_agent and not f_agent.is_added:
                     kwargs = {
-                        "text": translate("future_agent_added", lang, "@" + nickname)
+                        "text": translate("already_added", lang, text_reply),
+                        "reply_markup": kb.agent_add_try_again(lang)
                     }
-                    is_commit = True
-
                     await update.message.reply_text(**kwargs)
-
-                    await self.admin(update, context)
                     return
+                elif f_agent and not f_agent.is_added:
+                    f_agent.is_added = False
+                    await run_db(f_agent.save)
+                elif not f_agent:
+                    await run_db(FutureAgent.create, tg_username=nickname)
+                kwargs = {
+                    "text": translate("future_agent_added", lang, "@" + nickname)
+                }
 
-            elif context.user_data.get("conversation_context"):
+                await update.message.reply_text(**kwargs)
 
-                if context.user_data.get("user_context"):
-                    user = context.user_data.get("user_context")
-                else:
-                    user = get_user(update)
-                conv: Conversation = Conversation.get_or_none(id=context.user_data.get("conversation_context").id)
-                msg = Message.create(author=user, body=text_reply)
-                conv.messages.add(msg)
-
-                await update.get_bot().send_message(chat_id=conv.customer_chat, text=text_reply)
-            elif (context.user_data.get("customer_conversation_context")
-                  or (context.user_data.get("customer_conversation_context")
-                      and context.user_data.get("conversation_created"))):
-                self.db.logged_commit()
-                if context.user_data.get("user_context"):
-                    user = context.user_data.get("user_context")
-                else:
-                    user = get_user(update)
-                    context.user_data.setdefault("user_context", user)
-                conv: Conversation = context.user_data.get("customer_conversation_context")
-                if conv.is_closed:
-                    context.user_data.pop("customer_conversation_context", None)
-                    return
-                elif not conv:
-                    await self.start(update, context)
-                    return
-                conv = Conversation.get_or_none(conv.id)
-                conv.messages.add(Message.create(author=user, body=text_reply))
-                conv.save()
-                user.last_conversation = conv
-                user.save()
-                is_commit = True
-                if context.user_data.setdefault("conversation_created"):
-                    await update.message.reply_text(translate("conversation_start_2", lang))
-                    context.user_data.pop("conversation_created", None)
-
-                if conv.agent_chat:
-                    text_reply = f"{conv.customer.tg_name}\n#id{conv.customer.id}\n\n{text_reply}"
-                    await update.message.get_bot().send_message(text=text_reply, chat_id=conv.agent_chat)
+                await self.admin(update, context)
+                return
 
+        elif session.conversation_id:
+            user = await session.user(update)
+            route = await session.route()
+            if not route:
+                session.conversation_id = None
+                await self.start(update, context)
                 return
+            await self.store_message(route.conversation_id, user, text_reply, attachment)
+            # Stored before it is relayed, the lane is not held while Telegram answers
+            await commit()
 
-        finally:
-            if is_commit:
-                self.db.logged_commit()
+            if attachment:
+                await relay(update.message, route.customer_chat)
+            else:
+                await update.get_bot().send_message(chat_id=route.customer_chat, text=text_reply)
+        elif session.customer_conversation_id:
+            user = await session.user(update)
+            route = await session.customer_route()
+            if not route:
+                session.customer_conversation_id = None
+                await self.start(update, context)
+                return
+            elif route.is_closed:
+                session.customer_conversation_id = None
+                return
+            await self.store_message(route.conversation_id, user, text_reply, attachment)
+            if user.last_conversation_id != route.conversation_id:
+                user.last_conversation = route.conversation_id
+                await run_db(user.save)
+            await commit()
+            if session.conversation_created:
+                await update.message.reply_text(translate("conversation_start_2", lang))
+                session.conversation_created = False
+
+            if route.agent_chat:
+                header = f"{route.customer_name}\n#id{route.customer_id}"
+                if attachment:
+                    await relay(update.message, route.agent_chat, header)
+                else:
+                    await update.message.get_bot().send_message(text=f"{header}\n\n{text_reply}",
+                                                                chat_id=route.agent_chat)
 
     async def unauthorized(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        lang = self.get_lang(update, context)
+        lang = await self.get_lang(update, context)
         await update.message.reply_text(translate("unauthorized_ad", lang))
 
 
 if __name__ == "__main__":
     bot = SupportBot(db_handler=db, token=TOKEN)
-    with db as Connection:
-        bot.run()
+    bot.run()
@@ -0,0 +1,120 @@
+"""
+Data maintenance commands.
+
+Usage:
+    python -m app.maintenance backfill-messages [--batch-size N] [--pause SECONDS]
+    python -m app.maintenance repair-summaries [--batch-size N] [--pause SECONDS]
+"""
+import argparse
+import logging
+import sys
+import time
+
+from peewee import fn
+
+from app.models import db, User, Conversation, Message, ConversationThrough, PREVIEW_LENGTH
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_message_conversation(batch_size=1000, pause=0.0) -> int:
+    """
+    Links messages stored through the former many-to-many table to their conversation.
+
+    Messages are updated in short transactions over ranges of batch_size IDs, so the bot can
+    keep running. Only rows with empty Message.conversation are touched, an interrupted run
+    can be restarted.
+
+    :param batch_size: Number of message IDs updated per transaction
+    :param pause: Seconds to sleep between batches
+    :return: Number of linked messages
+    """
+    if not ConversationThrough.table_exists():
+        return 0
+    last_id = Message.select(fn.MIN(Message.id)).where(Message.conversation.is_null()).scalar()
+    max_id = Message.select(fn.MAX(Message.id)).where(Message.conversation.is_null()).scalar()
+    if last_id is None:
+        return 0
+    last_id -= 1
+
+    linked = 0
+    while last_id < max_id:
+        upper = last_id + batch_size
+        conversation = (ConversationThrough
+                        .select(ConversationThrough.conversation)
+                        .where(ConversationThrough.message == Message.id)
+                        .limit(1))
+        with db.atomic():
+            linked += (Message
+                       .update(conversation=conversation)
+                       .where(Message.id > last_id, Message.id <= upper, Message.conversation.is_null())
+                       .execute())
+        logger.info("Backfilled messages up to ID %s of %s", min(upper, max_id), max_id)
+        last_id = upper
+        if pause:
+            time.sleep(pause)
+    return linked
+
+
+def repair_conversation_summaries(batch_size=500, pause=0.0) -> int:
+    """
+    Recomputes summary columns of conversations from their messages and customer.
+
+    Every batch is a single UPDATE over a range of conversation IDs.
+
+    :param batch_size: Number of conversation IDs updated per transaction
+    :param pause: Seconds to sleep between batches
+    :return: Number of updated conversations
+    """
+    messages = Message.select().where(Message.conversation == Conversation.id)
+    # Same as app.write_behind.preview
+    first_message = (messages.select(fn.SUBSTR(fn.COALESCE(fn.NULLIF(Message.body, ""), Message.attachment_type, ""),
+                                               1, PREVIEW_LENGTH))
+                     .order_by(Message.created_at, Message.id)
+                     .limit(1))
+    summary = {
+        Conversation.customer_name: User.select(User.tg_name).where(User.id == Conversation.customer),
+        Conversation.first_message_preview: first_message,
+        Conversation.message_count: messages.select(fn.COUNT(Message.id)),
+        Conversation.last_message_at: messages.select(fn.MAX(Message.created_at)),
+    }
+
+    max_id = Conversation.select(fn.MAX(Conversation.id)).scalar() or 0
+    last_id = 0
+    updated = 0
+    while last_id < max_id:
+        upper = last_id + batch_size
+        with db.atomic():
+            updated += (Conversation
+                        .update(summary)
+                        .where(Conversation.id > last_id, Conversation.id <= upper)
+                        .execute())
+        logger.info("Repaired conversations up to ID %s of %s", min(upper, max_id), max_id)
+        last_id = upper
+        if pause:
+            time.sleep(pause)
+    return updated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Data maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill = commands.add_parser("backfill-messages", help="link messages to conversations")
+    backfill.add_argument("--batch-size", type=int, default=1000)
+    backfill.add_argument("--pause", type=float, default=0.0, help="seconds between batches")
+    repair = commands.add_parser("repair-summaries", help="recompute conversation summary columns")
+    repair.add_argument("--batch-size", type=int, default=500)
+    repair.add_argument("--pause", type=float, default=0.0, help="seconds between batches")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    with db.connection_context():
+        if args.command == "backfill-messages":
+            print("Linked %s messages" % backfill_message_conversation(args.batch_size, args.pause))
+        elif args.command == "repair-summaries":
+            print("Repaired %s conversations" % repair_conversation_summaries(args.batch_size, args.pause))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""
+Media relay.
+
+Attachments are relayed with ``copy_message`` and shown from /inspect by ``file_id``, so
+the bot never downloads or uploads file contents and relaying a large video costs the same
+single request as a sticker. Messages only store the attachment type and ``file_id``, the
+caption is stored as the message body.
+"""
+from telegram import Message, MessageEntity
+from telegram.ext import filters
+
+# Attachment type -> Bot method sending it by file_id. Types are telegram.Message attributes,
+# animations also carry a document, so they are checked first
+SENDERS = {
+    "animation": "send_animation",
+    "photo": "send_photo",
+    "document": "send_document",
+    "video": "send_video",
+    "audio": "send_audio",
+    "voice": "send_voice",
+    "video_note": "send_video_note",
+    "sticker": "send_sticker",
+}
+# Attachments without a caption, the header is sent as a separate message
+NO_CAPTION = ("video_note", "sticker")
+# Counted in UTF-16 code units, like entity offsets
+CAPTION_LENGTH = 1024
+
+ATTACHMENTS = (filters.ANIMATION | filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.AUDIO
+               | filters.VOICE | filters.VIDEO_NOTE | filters.Sticker.ALL)
+
+
+def attachment_of(message: Message) -> tuple[str, str] | None:
+    """Returns (type, file_id) of message attachment, None for text messages."""
+    for kind in SENDERS:
+        attachment = getattr(message, kind)
+        if attachment:
+            # Photos come in several sizes, the largest one is last
+            return kind, (attachment[-1] if kind == "photo" else attachment).file_id
+    return None
+
+
+def _utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+async def relay(message: Message, chat_id: int, header: str = None) -> None:
+    """
+    Copies message with attachment to chat.
+    :param message: Received message
+    :param chat_id: Chat on the other end of the conversation
+    :param header: Text put in front of the caption
+    """
+    if header is None:
+        await message.copy(chat_id)
+        return
+    kind, _file_id = attachment_of(message)
+    caption = message.caption or ""
+    if kind in NO_CAPTION or _utf16_length(header) + _utf16_length(caption) + 2 > CAPTION_LENGTH:
+        await message.get_bot().send_message(chat_id, header)
+        await message.copy(chat_id)
+        return
+    if not caption:
+        await message.copy(chat_id, caption=header)
+        return
+    # Entities of the caption are moved behind the header, offsets are in UTF-16 code units
+    shift = _utf16_length(header) + 2
+    entities = [MessageEntity(entity.type, entity.offset + shift, entity.length, entity.url, entity.user,
+                              entity.language, entity.custom_emoji_id)
+                for entity in message.caption_entities]
+    await message.copy(chat_id, caption=f"{header}\n\n{caption}", caption_entities=entities)
+
+
+async def send_attachment(bot, chat_id: int, kind: str, file_id: str, caption: str = None) -> None:
+    """Sends stored attachment by its file_id."""
+    kwargs = {} if kind in NO_CAPTION or not caption else {"caption": caption[:CAPTION_LENGTH]}
+    await getattr(bot, SENDERS[kind])(chat_id, file_id, **kwargs)
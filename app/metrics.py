@@ -0,0 +1,215 @@
+"""
+Metrics.
+
+Handlers, database queries and Bot API requests are measured in process and served as
+Prometheus text on ``http://METRICS_LISTEN:METRICS_PORT/metrics``:
+
+- ``helpy_update_seconds{handler}``: time to handle an update, recorded by
+  :func:`app.dal.unit_of_work`. Callback queries are labelled with the handler of their
+  route, see :func:`label`
+- ``helpy_update_queries{handler}``, ``helpy_update_db_seconds{handler}``: queries issued by
+  an update and time spent executing them
+- ``helpy_call_seconds{call}``: functions decorated with :func:`timed`, e.g. the paginators
+- ``helpy_api_seconds{method}``: Bot API requests, without time waiting for the rate limiter
+- ``helpy_update_errors_total{handler, error}``, ``helpy_api_errors_total{method, error}``
+- gauges of the caches, database lanes, connection pool and rate limiter, see :func:`register`
+
+Metrics are recorded and read on the event loop thread. With WORKERS > 1 workers send a
+:func:`snapshot` to the supervisor every second, which serves the series of all workers
+labelled with ``worker``.
+"""
+import functools
+import logging
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of histogram buckets
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, label: str, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        # Label value -> [count per bucket and one above the last bucket, sum]
+        self.series: dict[str, list] = {}
+
+    def observe(self, key: str, value: float) -> None:
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+
+class Counter:
+    def __init__(self, name: str, description: str, labels: tuple[str, ...]):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # Label values -> count
+        self.values: dict[tuple, int] = {}
+
+    def inc(self, *key) -> None:
+        self.values[key] = self.values.get(key, 0) + 1
+
+
+update_seconds = Histogram("helpy_update_seconds", "Time to handle an update by handler", "handler", SECONDS)
+update_queries = Histogram("helpy_update_queries", "Database queries per update by handler", "handler", QUERIES)
+update_db_seconds = Histogram("helpy_update_db_seconds", "Time in database queries per update by handler",
+                              "handler", SECONDS)
+call_seconds = Histogram("helpy_call_seconds", "Latency of timed functions", "call", SECONDS)
+api_seconds = Histogram("helpy_api_seconds", "Bot API request latency by method, without rate limiter waits",
+                        "method", SECONDS)
+update_errors = Counter("helpy_update_errors_total", "Exceptions raised by handlers", ("handler", "error"))
+api_errors = Counter("helpy_api_errors_total", "Failed Bot API requests", ("method", "error"))
+
+HISTOGRAMS = (update_seconds, update_queries, update_db_seconds, call_seconds, api_seconds)
+COUNTERS = (update_errors, api_errors)
+
+# Prefix -> stats() of a component, exported as gauges
+_collectors: dict[str, Callable[[], dict]] = {}
+# Handler of the current update
+_handler: ContextVar[str] = ContextVar("metrics_handler", default="")
+
+
+def register(prefix: str, collect: Callable[[], dict]) -> None:
+    """Exports numeric values of collect() as helpy_<prefix>_<key> gauges."""
+    _collectors[prefix] = collect
+
+
+def label(handler: str) -> None:
+    """Labels metrics of the current update with handler, e.g. the handler of a callback route."""
+    _handler.set(handler)
+
+
+def current_handler() -> str:
+    """Handler of the current update, see :func:`label`."""
+    return _handler.get()
+
+
+def begin(handler: str) -> tuple:
+    """Starts measuring an update handled by handler, pass the result to :func:`end`."""
+    return _handler.set(handler), time.perf_counter()
+
+
+def end(started: tuple, queries: int, query_seconds: float, error: BaseException = None) -> None:
+    """Records the update started with :func:`begin`, its queries and the exception it raised."""
+    token, since = started
+    handler = _handler.get()
+    _handler.reset(token)
+    update_seconds.observe(handler, time.perf_counter() - since)
+    update_queries.observe(handler, queries)
+    update_db_seconds.observe(handler, query_seconds)
+    if isinstance(error, Exception):
+        update_errors.inc(handler, type(error).__name__)
+
+
+def timed(function):
+    """Records latency of async function in helpy_call_seconds, labelled by its name."""
+    name = function.__name__
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            call_seconds.observe(name, time.perf_counter() - started)
+
+    return wrapper
+
+
+def snapshot() -> dict:
+    """Metrics of this process as plain data, see :func:`render`."""
+    stats = {}
+    for prefix, collect in _collectors.items():
+        try:
+            stats[prefix] = collect()
+        except Exception as e:
+            logger.warning("Failed to collect %s metrics: %s", prefix, e)
+    return {
+        "histograms": {histogram.name: {key: (list(counts), total) for key, (counts, total) in histogram.series.items()}
+                       for histogram in HISTOGRAMS},
+        "counters": {counter.name: dict(counter.values) for counter in COUNTERS},
+        "stats": stats,
+    }
+
+
+def _labels(pairs) -> str:
+    escaped = ('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for name, value in pairs)
+    return "{%s}" % ",".join(escaped)
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def render(snapshots: dict[str | None, dict] = None) -> str:
+    """
+    Prometheus text exposition of snapshots.
+    :param snapshots: Worker index -> :func:`snapshot` of the worker, this process by default
+    """
+    if snapshots is None:
+        snapshots = {None: snapshot()}
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.append("# HELP %s %s" % (histogram.name, histogram.description))
+        lines.append("# TYPE %s histogram" % histogram.name)
+        bounds = [_number(bound) for bound in histogram.buckets] + ["+Inf"]
+        for worker, data in snapshots.items():
+            base = [] if worker is None else [("worker", worker)]
+            for key, (counts, total) in data["histograms"].get(histogram.name, {}).items():
+                pairs = base + [(histogram.label, key)]
+                cumulative = 0
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %s" % (histogram.name, _labels(pairs + [("le", bound)]), cumulative))
+                lines.append("%s_sum%s %s" % (histogram.name, _labels(pairs), repr(total)))
+                lines.append("%s_count%s %s" % (histogram.name, _labels(pairs), cumulative))
+    for counter in COUNTERS:
+        lines.append("# HELP %s %s" % (counter.name, counter.description))
+        lines.append("# TYPE %s counter" % counter.name)
+        for worker, data in snapshots.items():
+            base = [] if worker is None else [("worker", worker)]
+            for key, value in data["counters"].get(counter.name, {}).items():
+                lines.append("%s%s %s" % (counter.name, _labels(base + list(zip(counter.labels, key))), value))
+    gauges: dict[str, list[str]] = {}
+    for worker, data in snapshots.items():
+        labels = "" if worker is None else _labels([("worker", worker)])
+        for prefix, values in data["stats"].items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    gauges.setdefault("helpy_%s_%s" % (prefix, key), []).append(labels + " " + _number(value))
+    for name, samples in gauges.items():
+        lines.append("# TYPE %s gauge" % name)
+        lines.extend(name + sample for sample in samples)
+    return "\n".join(lines) + "\n"
+
+
+def serve(listen: str, port: int, render_text: Callable[[], str]):
+    """
+    Serves render_text() on /metrics of the running event loop.
+    :return: tornado HTTPServer, stop it on shutdown
+    """
+    # Installed with python-telegram-bot[webhooks]
+    import tornado.web
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", CONTENT_TYPE)
+            self.write(render_text())
+
+    server = tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(port, listen)
+    logger.info("Metrics served on http://%s:%s/metrics", listen, port)
+    return server
@@ -0,0 +1,279 @@
+"""
+Schema migrations.
+
+The applied schema version is stored in the ``schema_version`` table. Migrations are
+registered in order with :func:`migration` and return a list of playhouse.migrate
+operations (or raw peewee queries) to execute. A fresh database is created directly
+from the models and stamped with the latest version.
+
+Usage:
+    python -m app.migrations             apply pending migrations
+    python -m app.migrations --dry-run   print SQL of pending migrations
+    python -m app.migrations --explain   check pagination queries with EXPLAIN
+"""
+import argparse
+import logging
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+
+from peewee import (Model, IntegerField, CharField, DateTimeField, Context, Node, MySQLDatabase, SqliteDatabase,
+                    IntegrityError)
+from playhouse.migrate import SchemaMigrator, Operation
+
+from app.models import db, User, Token, FutureAgent, Message, Conversation, SessionData
+
+logger = logging.getLogger(__name__)
+
+MODELS = [User, Token, FutureAgent, Conversation, Message, SessionData]
+MIGRATIONS: list[tuple[int, str, callable]] = []
+
+
+class SchemaVersion(Model):
+    version = IntegerField(primary_key=True)
+    name = CharField()
+    applied_at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+        table_name = "schema_version"
+
+
+def migration(version: int, name: str):
+    """Registers decorated function as migration with given version."""
+
+    def decorator(func):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version, "Migrations must be registered in order"
+        MIGRATIONS.append((version, name, func))
+        return func
+
+    return decorator
+
+
+def add_index(migrator: SchemaMigrator, table: str, columns: tuple, unique=False) -> list:
+    """Index operation, skipped when index with the same columns already exists."""
+    for index in migrator.database.get_indexes(table):
+        if tuple(index.columns) == tuple(columns):
+            return []
+    return [migrator.add_index(table, columns, unique)]
+
+
+@migration(1, "pagination indexes")
+def pagination_indexes(migrator: SchemaMigrator) -> list:
+    return [
+        *add_index(migrator, "conversation", ("is_closed", "agent_id", "id")),
+        # Created by ManyToManyField in new databases, may be missing in older ones
+        *add_index(migrator, "conversation_message_through", ("conversation_id", "message_id"), unique=True),
+        *add_index(migrator, "token", ("is_activated", "id")),
+        *add_index(migrator, "user", ("is_agent", "id")),
+    ]
+
+
+@migration(2, "message conversation foreign key")
+def message_conversation(migrator: SchemaMigrator) -> list:
+    # Existing rows are linked by `python -m app.maintenance backfill-messages`
+    return [
+        migrator.add_column("message", "conversation_id", Message.conversation),
+        *add_index(migrator, "message", ("conversation_id", "created_at")),
+    ]
+
+
+@migration(3, "conversation summary")
+def conversation_summary(migrator: SchemaMigrator) -> list:
+    # Existing rows are filled by `python -m app.maintenance repair-summaries`
+    return [
+        migrator.add_column("conversation", "customer_name", Conversation.customer_name),
+        migrator.add_column("conversation", "first_message_preview", Conversation.first_message_preview),
+        migrator.add_column("conversation", "message_count", Conversation.message_count),
+        migrator.add_column("conversation", "last_message_at", Conversation.last_message_at),
+    ]
+
+
+@migration(4, "session persistence")
+def session_persistence(_migrator: SchemaMigrator) -> list:
+    return [SessionData._schema._create_table(safe=True)]
+
+
+@migration(5, "message attachments")
+def message_attachments(migrator: SchemaMigrator) -> list:
+    return [
+        migrator.add_column("message", "attachment_type", Message.attachment_type),
+        migrator.add_column("message", "file_id", Message.file_id),
+    ]
+
+
+def current_version() -> int:
+    row = SchemaVersion.select(SchemaVersion.version).order_by(SchemaVersion.version.desc()).first()
+    return row.version if row else 0
+
+
+def head() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+class _DryRunDatabase:
+    """Proxy collecting statements instead of executing them."""
+
+    def __init__(self, database):
+        self._database = database
+        self.statements = []
+
+    def __getattr__(self, item):
+        return getattr(self._database, item)
+
+    def execute(self, query, **kwargs):
+        ctx = query if isinstance(query, Context) else self._database.get_sql_context().sql(query)
+        self.statements.append(ctx.query())
+
+
+def _execute(migrator: SchemaMigrator, item) -> None:
+    if isinstance(item, Operation):
+        item.run()
+    elif isinstance(item, (Node, Context)):
+        migrator.database.execute(item)
+    else:
+        raise TypeError("Unsupported migration step: %r" % item)
+
+
+@contextmanager
+def _foreign_keys_off():
+    """
+    Stops SQLite from enforcing foreign keys. SQLite tables are rebuilt for some operations,
+    e.g. adding a NOT NULL column, and the old copy of a table other tables reference cannot
+    be dropped while they are enforced. The pragma is ignored inside a transaction.
+    """
+    if not isinstance(db, SqliteDatabase) or not db.pragma("foreign_keys"):
+        yield
+        return
+    db.pragma("foreign_keys", 0)
+    try:
+        yield
+    finally:
+        db.pragma("foreign_keys", 1)
+
+
+def _check_foreign_keys() -> None:
+    """Fails the migration if rows lost their referenced row while SQLite foreign keys were off."""
+    if not isinstance(db, SqliteDatabase):
+        return
+    violations = db.execute_sql("PRAGMA foreign_key_check").fetchall()
+    if violations:
+        raise IntegrityError("Foreign key violations after migration, e.g. %s row %s" % violations[0][:2])
+
+
+def upgrade(dry_run=False) -> list[tuple[str, list]]:
+    """
+    Creates missing schema or applies pending migrations.
+
+    :param dry_run: Only collect SQL, nothing is executed
+    :return: List of applied(or pending in dry run) migrations with their SQL statements
+    """
+    if not SchemaVersion.table_exists():
+        if dry_run:
+            logger.info("schema_version table will be created")
+        else:
+            SchemaVersion.create_table()
+
+    version = current_version() if SchemaVersion.table_exists() else 0
+    if version == 0 and not User.table_exists():
+        if not dry_run:
+            with db.atomic():
+                db.create_tables(MODELS)
+                if MIGRATIONS:
+                    SchemaVersion.create(version=head(), name=MIGRATIONS[-1][1])
+        return [("create tables", [])]
+
+    applied = []
+    for number, name, func in MIGRATIONS:
+        if number <= version:
+            continue
+        migrator = SchemaMigrator.from_database(db)
+        if dry_run:
+            migrator.database = _DryRunDatabase(db)
+        steps = func(migrator)
+        if dry_run:
+            for step in steps:
+                try:
+                    _execute(migrator, step)
+                except ValueError as exc:
+                    # SQLite rebuilds tables for some operations and introspects columns added by previous steps
+                    migrator.database.statements.append(("-- not previewable: %s" % exc, []))
+            applied.append((name, migrator.database.statements))
+            continue
+        with _foreign_keys_off(), db.atomic():
+            for step in steps:
+                _execute(migrator, step)
+            _check_foreign_keys()
+            SchemaVersion.create(version=number, name=name)
+        logger.info("Applied migration %s: %s", number, name)
+        applied.append((name, []))
+    return applied
+
+
+def pagination_queries() -> list[tuple[str, object]]:
+    """Hot queries of paginate_* helpers with placeholder values."""
+    return [
+        ("active conversations", Conversation.select().where(Conversation.is_closed == False).limit(1)),
+        ("joined conversations", Conversation.select().where(
+            (Conversation.is_closed == False) & (Conversation.agent == 0)).limit(1)),
+        ("closed conversations", Conversation.select().where(
+            (Conversation.agent == 0) & (Conversation.is_closed == True)).limit(1)),
+        ("first message", Message.select().where(
+            Message.conversation == 0).order_by(Message.created_at).limit(1)),
+        ("inspect messages", Message.select(Message, User).join(User).where(
+            Message.conversation == 0).order_by(Message.created_at).limit(5)),
+        ("tokens", Token.select().where(Token.is_activated == False).limit(5)),
+        ("agents", User.select().where(User.is_agent == True).limit(5)),
+    ]
+
+
+def explain(query) -> list[str]:
+    """
+    Runs EXPLAIN for query.
+
+    :return: List of full table scans done without any usable index
+    """
+    sql, params = query.sql()
+    if isinstance(db, MySQLDatabase):
+        cursor = db.execute_sql("EXPLAIN " + sql, params)
+        columns = [c[0] for c in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return ["%s: type=ALL" % row["table"] for row in rows
+                if row["type"] == "ALL" and not row["possible_keys"]]
+    cursor = db.execute_sql("EXPLAIN QUERY PLAN " + sql, params)
+    return [row[-1] for row in cursor.fetchall()
+            if row[-1].startswith("SCAN") and "INDEX" not in row[-1]]
+
+
+def check_pagination_queries() -> dict[str, list[str]]:
+    """Returns full scans found in pagination queries, keyed by query name."""
+    return {name: scans for name, query in pagination_queries() if (scans := explain(query))}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument("--dry-run", action="store_true", help="print SQL of pending migrations")
+    parser.add_argument("--explain", action="store_true", help="check pagination queries for full scans")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    with db.connection_context():
+        if args.explain:
+            scans = check_pagination_queries()
+            for name, found in scans.items():
+                print("%s: %s" % (name, "; ".join(found)))
+            print("OK" if not scans else "Full scans found")
+            return 1 if scans else 0
+
+        applied = upgrade(dry_run=args.dry_run)
+        if not applied:
+            print("Schema is up to date (version %s)" % current_version())
+        for name, statements in applied:
+            print("-- %s" % name)
+            for sql, params in statements:
+                print("%s; %s" % (sql, params) if params else "%s;" % sql)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,24 +1,29 @@
 from datetime import datetime
 from peewee import *
-import os
-from dotenv import load_dotenv
 
-load_dotenv()
-DB_HOST = os.environ.get("DB_HOST")
-DB_USERNAME = os.environ.get("DB_USERNAME")
-DB_PASSWORD = os.environ.get("DB_PASSWORD")
-DB_NAME = os.environ.get("DB_NAME")
-DB_PORT = int(os.environ.get("DB_PORT"))
-db = MySQLDatabase(DB_NAME, user=DB_USERNAME, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT)
+from app.cache import user_cache, changed, ROUTE, USER
+from app.database import create_database
+from app.routing import routing_index
 
+db = create_database()
 
-def logged_commit():
-    """To print line of code where commit used."""
-    # print("COMMIT: %s" % utils.get_line_number())
-    db.commit()
 
+PREVIEW_LENGTH = 255
 
-db.logged_commit = logged_commit
+
+def on_rollback(callback, *args) -> None:
+    """Calls callback(*args) if the unit of work saving a model is rolled back, see :mod:`app.dal`."""
+    # app.dal imports the database from this module
+    from app.dal import on_rollback
+
+    on_rollback(callback, *args)
+
+
+def after_commit(callback, *args) -> None:
+    """Calls callback(*args) once the unit of work saving a model is committed, see :mod:`app.dal`."""
+    from app.dal import after_commit
+
+    after_commit(callback, *args)
 
 
 class BaseModel(Model):
@@ -42,6 +47,22 @@ class User(BaseModel):
 
     class Meta:
         db_table = "user"
+        indexes = (
+            (("is_agent", "id"), False),
+        )
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        user_cache.update(self)
+        on_rollback(user_cache.invalidate, self.id)
+        after_commit(changed, USER, self.id)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        result = super().delete_instance(*args, **kwargs)
+        user_cache.invalidate(self.id)
+        after_commit(changed, USER, self.id)
+        return result
 
 
 class Token(BaseModel):
@@ -49,33 +70,52 @@ class Token(BaseModel):
     created_at = DateTimeField(default=datetime.now)
     is_activated = BooleanField(default=False)
 
+    class Meta:
+        indexes = (
+            (("is_activated", "id"), False),
+        )
+
 
 class FutureAgent(BaseModel):
     tg_username = CharField(unique=True)
     is_added = BooleanField(default=False)
 
 
-class Message(BaseModel):
-    author = ForeignKeyField(User, backref="message")
-    body = TextField()
-    created_at = DateTimeField(default=datetime.now)
-
-
 class Conversation(BaseModel):
     customer = ForeignKeyField(User, backref="conversation")
     customer_chat = BigIntegerField()
     agent = ForeignKeyField(User, null=True, backref="conversation")
     agent_chat = BigIntegerField(null=True)
-    messages = ManyToManyField(Message, backref="conversation")
     created_at = DateTimeField(default=datetime.now)
     agent_join_at = DateTimeField(null=True)
     is_closed = BooleanField(default=False)
+    # Summary for list views, maintained by app.utils.add_message, see app.maintenance to repair
+    customer_name = CharField(null=True)
+    first_message_preview = CharField(max_length=PREVIEW_LENGTH, null=True)
+    message_count = IntegerField(default=0)
+    last_message_at = DateTimeField(null=True)
 
     class Meta:
         db_table = "conversation"
+        indexes = (
+            (("is_closed", "agent", "id"), False),
+        )
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        routing_index.update(self)
+        on_rollback(routing_index.discard, self.id)
+        after_commit(changed, ROUTE, self.id)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        result = super().delete_instance(*args, **kwargs)
+        routing_index.discard(self.id)
+        after_commit(changed, ROUTE, self.id)
+        return result
 
     def join_conv(self, agent, chat):
-        if not self.agent:
+        if not self.agent_id:
             self.agent_join_at = datetime.now()
         self.agent = agent
         self.agent_chat = chat
@@ -83,23 +123,54 @@ class Conversation(BaseModel):
         self.save()
 
 
-ConversationThrough = Conversation.messages.get_through_model()
+class Message(BaseModel):
+    # Null only for messages stored before migration 2 and not yet backfilled, see app.maintenance
+    conversation = ForeignKeyField(Conversation, backref="messages", null=True, index=False)
+    author = ForeignKeyField(User, backref="message")
+    # Caption for messages with an attachment
+    body = TextField()
+    created_at = DateTimeField(default=datetime.now)
+    # Relayed and shown by file_id, see app.media
+    attachment_type = CharField(max_length=16, null=True)
+    file_id = CharField(null=True)
+
+    class Meta:
+        indexes = (
+            (("conversation", "created_at"), False),
+        )
+
+
+class ConversationThrough(BaseModel):
+    """Former Conversation.messages many-to-many table, kept to backfill Message.conversation."""
+    conversation = ForeignKeyField(Conversation)
+    message = ForeignKeyField(Message)
+
+    class Meta:
+        table_name = "conversation_message_through"
+        indexes = (
+            (("conversation", "message"), True),
+        )
+
+
+class SessionData(Model):
+    """Pickled user_data and chat_data of the bot, see app.persistence."""
+    kind = CharField(max_length=4)
+    key = BigIntegerField()
+    data = BlobField()
+    updated_at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+        table_name = "session_data"
+        primary_key = CompositeKey("kind", "key")
 
 
 def create_tables(connection=True):
+    """Creates tables in empty database or applies pending migrations, see :mod:`app.migrations`."""
+    from app.migrations import upgrade
+
     if connection:
         db.connect()
-
-    db_tables: list = db.get_tables()
-    tables = ['conversation', 'conversation_message_through', 'futureagent', 'message', 'token', 'user']
-    create = False
-    for table in tables:
-        try:
-            db_tables.index(table)
-        except ValueError:
-            create = True
-
-    if create:
-        db.create_tables([User, Token, FutureAgent, Message, Conversation, ConversationThrough])
+    upgrade()
     if connection:
         db.close()
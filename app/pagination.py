@@ -0,0 +1,108 @@
+"""
+Keyset(cursor) pagination.
+
+Instead of LIMIT/OFFSET every page is read with a range condition on the sort key, e.g.
+``WHERE (created_at, id) > (last_seen_created_at, last_seen_id)``, so late pages cost the same
+as the first one. Cursors of the current page are kept per view in a state dictionary stored
+in the user session(see :mod:`app.session`). Total number of pages is only shown to the user,
+it is counted once per ``count_ttl`` seconds and may be slightly out of date.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from peewee import Tuple
+
+FIRST = "first"
+NEXT = "next"
+PREVIOUS = "previous"
+
+
+class KeysetPaginator:
+    def __init__(self, key: tuple, per_page: int = 5, count_ttl: float = 30, max_counts: int = 1024):
+        """
+        :param key: Fields giving unique and stable order, e.g. (Message.created_at, Message.id)
+        :param per_page: Rows per page
+        :param count_ttl: Seconds to cache total number of rows
+        :param max_counts: Cached counts, least recently used ones are dropped first
+        """
+        self.key = key
+        self.per_page = per_page
+        self.count_ttl = count_ttl
+        self.max_counts = max_counts
+        # cache_key -> (expires, count)
+        self._counts: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def page(self, query, state: dict, direction: str = FIRST) -> list | None:
+        """
+        Reads page of query relative to the page stored in state.
+        Blocking, call it through :func:`app.dal.run_db`.
+
+        :param query: Filtered select query without order and limit
+        :param state: View state from the user session, updated in place when page exists
+        :param direction: FIRST, NEXT or PREVIOUS
+        :return: Rows of the page, or None if there is no such page
+        """
+        ascending = [field.asc() for field in self.key]
+        if direction == FIRST or not state.get("last"):
+            rows = list(query.order_by(*ascending).limit(self.per_page))
+            number = 1
+        elif direction == NEXT:
+            rows = list(query.where(Tuple(*self.key) > Tuple(*state["last"]))
+                        .order_by(*ascending).limit(self.per_page))
+            number = state["page"] + 1
+        else:
+            rows = list(query.where(Tuple(*self.key) < Tuple(*state["first"]))
+                        .order_by(*[field.desc() for field in self.key]).limit(self.per_page))
+            rows.reverse()
+            number = state["page"] - 1
+
+        if not rows:
+            return None
+        state.update(page=number, first=self._cursor(rows[0]), last=self._cursor(rows[-1]))
+        return rows
+
+    def pages(self, query, *cache_key) -> int:
+        """
+        Approximate number of pages, cached for count_ttl seconds.
+        Blocking, call it through :func:`app.dal.run_db`.
+
+        :param query: Same query as passed to :meth:`page`
+        :param cache_key: Values identifying the query filter, e.g. agent ID
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._counts.get(cache_key)
+            if cached and cached[0] <= now:
+                del self._counts[cache_key]
+                cached = None
+            elif cached:
+                self._counts.move_to_end(cache_key)
+        if cached:
+            count = cached[1]
+        else:
+            count = query.count()
+            with self._lock:
+                self._counts[cache_key] = (now + self.count_ttl, count)
+                self._counts.move_to_end(cache_key)
+                while len(self._counts) > self.max_counts:
+                    self._counts.popitem(last=False)
+        return math.ceil(count / self.per_page)
+
+    def invalidate(self, *cache_key) -> None:
+        """Drops cached count, all of them if no key is given."""
+        with self._lock:
+            if cache_key:
+                self._counts.pop(cache_key, None)
+            else:
+                self._counts.clear()
+
+    def _cursor(self, row) -> list:
+        return [getattr(row, field.name) for field in self.key]
+
+
+def page_label(state: dict, pages: int) -> str:
+    """Renders "X / Y", cached total is never shown lower than current page."""
+    return "%s / %s" % (state["page"], max(pages, state["page"]))
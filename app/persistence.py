@@ -0,0 +1,149 @@
+"""
+Bot persistence stored in the bot's own database.
+
+user_data and chat_data survive restarts, so agents stay joined to their conversations and
+customers keep writing into their open conversation. Nothing is read at startup: data of a
+user or chat is loaded on its first update after the start(``refresh_user_data`` and
+``refresh_chat_data`` are called by the application before every handler). The application
+hands over data changed since its previous run every PERSISTENCE_INTERVAL seconds; those
+changes are coalesced and written with a single statement.
+"""
+import asyncio
+import logging
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from app.dal import run_db
+from app.models import db, SessionData
+
+logger = logging.getLogger(__name__)
+
+USER = "user"
+CHAT = "chat"
+
+
+def load_data(kind: str, key: int) -> dict | None:
+    """
+    Returns stored data of user or chat.
+    Blocking, call it through :func:`app.dal.run_db`.
+    """
+    row = SessionData.select(SessionData.data).where(SessionData.kind == kind, SessionData.key == key).first()
+    return pickle.loads(row.data) if row else None
+
+
+def store_data(rows: dict[tuple[str, int], dict]) -> None:
+    """
+    Replaces stored data of users and chats keyed by (kind, key).
+    Blocking, call it through :func:`app.dal.run_db`.
+    """
+    with db.atomic():
+        SessionData.insert_many(
+            [{"kind": kind, "key": key, "data": pickle.dumps(data, pickle.HIGHEST_PROTOCOL)}
+             for (kind, key), data in rows.items()]
+        ).on_conflict_replace().execute()
+
+
+def drop_data(kind: str, key: int) -> None:
+    """Blocking, call it through :func:`app.dal.run_db`."""
+    SessionData.delete().where(SessionData.kind == kind, SessionData.key == key).execute()
+
+
+class DatabasePersistence(BasePersistence):
+    def __init__(self, update_interval: float = 60):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False),
+                         update_interval=update_interval)
+        # (kind, key) -> latest data not written yet
+        self._dirty: dict[tuple[str, int], dict] = {}
+        self._loaded: set[tuple[str, int]] = set()
+        # Items which have a row, data of the others is only written once it is not empty
+        self._stored: set[tuple[str, int]] = set()
+        self._write: asyncio.Task | None = None
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._mark_dirty((USER, user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._mark_dirty((CHAT, chat_id), data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: object) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._drop((USER, user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._drop((CHAT, chat_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._load((USER, user_id), user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._load((CHAT, chat_id), chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Writes pending changes, called on shutdown."""
+        if self._write:
+            await self._write
+        await self._write_dirty()
+
+    async def _load(self, item: tuple[str, int], data: dict) -> None:
+        if item in self._loaded:
+            return
+        stored = await run_db(load_data, *item)
+        self._loaded.add(item)
+        if stored is not None:
+            self._stored.add(item)
+            # Keys already set in this process take precedence
+            for key, value in stored.items():
+                data.setdefault(key, value)
+
+    def _mark_dirty(self, item: tuple[str, int], data: dict) -> None:
+        if not data and item not in self._stored:
+            return
+        self._dirty[item] = data
+        # The application hands over all changed users at once, they are written together
+        if self._write is None or self._write.done():
+            self._write = asyncio.create_task(self._write_dirty())
+
+    async def _write_dirty(self) -> None:
+        if not self._dirty:
+            return
+        rows, self._dirty = self._dirty, {}
+        try:
+            await run_db(store_data, rows)
+            self._stored.update(rows)
+        except Exception as e:
+            # Keep newer data of the same users, retry with the next run
+            self._dirty = rows | self._dirty
+            logger.error("Failed to store %s sessions: %s", len(rows), e)
+
+    async def _drop(self, item: tuple[str, int]) -> None:
+        self._dirty.pop(item, None)
+        self._loaded.discard(item)
+        self._stored.discard(item)
+        await run_db(drop_data, *item)
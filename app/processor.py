@@ -0,0 +1,85 @@
+"""
+Concurrent update processing.
+
+With CONCURRENT_UPDATES > 1 updates are handled in parallel, but updates of the same user
+keep their order: each user has an asyncio lock, created when the first update of the user
+arrives and dropped as soon as no update of the user is running or waiting. In private
+chats a user is also the chat, so customer messages reach the conversation in the order
+they were sent.
+"""
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+@dataclass(slots=True)
+class _KeyLock:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # Updates running or waiting for the lock
+    holders: int = 0
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = None):
+        """
+        :param max_concurrent_updates: Updates handled at the same time
+        :param max_pending_updates: Updates accepted at the same time, including ones waiting
+            for an earlier update of the same user. Defaults to 8 * max_concurrent_updates, so
+            a single busy user can not take all the slots
+        """
+        pending = max_pending_updates or max_concurrent_updates * 8
+        # The base class limits accepted updates with the limit it is given
+        super().__init__(pending)
+        self._concurrent = max_concurrent_updates
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: dict[int, _KeyLock] = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        # Read by the base class while it is built, it sizes its semaphore with the pending limit
+        return getattr(self, "_concurrent", self._max_concurrent_updates)
+
+    @property
+    def locks(self) -> int:
+        """Number of users with an update running or waiting."""
+        return len(self._locks)
+
+    @staticmethod
+    def key(update: object) -> int | None:
+        """Ordering key of update, None if it can run in any order."""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = _KeyLock()
+        entry.holders += 1
+        try:
+            async with entry.lock:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry.holders -= 1
+            if not entry.holders:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,152 @@
+"""
+Query audit.
+
+With QUERY_AUDIT set, every statement issued by an update is recorded with the line of the
+bot code which caused it(the innermost frame in app/ outside the data layer). Statements
+are grouped by shape, their SQL with IN lists collapsed, so rows of one page loaded one by
+one(e.g. a foreign key accessed lazily for every row) show up as one SELECT shape issued
+N_PLUS_ONE or more times. Such N+1 queries and updates issuing more statements than their
+budget(QUERY_BUDGET, or :func:`budget` of the handler) are logged once per handler and
+source line when the update is finished.
+
+QUERY_AUDIT=strict is meant for tests and development: the statement crossing the limit
+raises :class:`QueryBudgetExceeded` instead, so the handler fails and its transaction is
+rolled back. The audit walks the stack for every statement, keep it off in production.
+"""
+import logging
+import os
+import re
+import sys
+from collections import Counter
+from dataclasses import dataclass, field
+
+from app.config import QUERY_AUDIT, QUERY_BUDGET
+
+logger = logging.getLogger(__name__)
+
+# Times one SELECT shape may be issued by an update before it is reported as an N+1 query
+N_PLUS_ONE = 3
+
+ENABLED = QUERY_AUDIT in ("1", "strict")
+STRICT = QUERY_AUDIT == "strict"
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(APP_DIR)
+# Data layer, statements are attributed to the code calling into it
+_LAYER = {os.path.join(APP_DIR, name) for name in ("dal.py", "database.py", "models.py", "query_audit.py")}
+# IN lists and VALUES rows of any length, placeholders are ? for SQLite and %s for MySQL
+_ROW = r"\((?:\?|%s)(?:, (?:\?|%s))*\)"
+_LISTS = re.compile(_ROW + "(?:, " + _ROW + ")*")
+
+# Handler name -> statements allowed per update
+_budgets: dict[str, int] = {}
+# (handler, kind, shape or None, source) already logged
+_reported: set[tuple] = set()
+_totals = {"updates": 0, "n_plus_one": 0, "over_budget": 0}
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in strict mode by the statement of an update crossing a limit, see the module documentation."""
+
+
+def budget(queries: int):
+    """Allows updates handled by the decorated handler to issue up to queries statements."""
+
+    def decorator(handler):
+        _budgets[handler.__name__] = queries
+        return handler
+
+    return decorator
+
+
+def shape_of(sql: str) -> str:
+    return _LISTS.sub("(?)", sql)
+
+
+def source_of_statement() -> str:
+    """path:line of the innermost bot frame outside the data layer issuing the current statement."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR + os.sep) and filename not in _LAYER:
+            return "%s:%s" % (os.path.relpath(filename, ROOT), frame.f_lineno)
+        frame = frame.f_back
+    return "unknown"
+
+
+@dataclass(slots=True)
+class Shape:
+    sql: str
+    count: int = 0
+    # path:line -> statements issued from it
+    sources: Counter = field(default_factory=Counter)
+
+
+class QueryAudit:
+    """Statements of one update, recorded on the lane thread by app.dal."""
+
+    def __init__(self, handler: str = ""):
+        # Set by the unit of work from the metrics label, callback queries get the handler of their route
+        self.handler = handler
+        self.statements = 0
+        self.shapes: dict[str, Shape] = {}
+
+    @property
+    def budget(self) -> int:
+        return _budgets.get(self.handler, QUERY_BUDGET)
+
+    def record(self, sql: str) -> None:
+        self.statements += 1
+        shape = self.shapes.get(key := shape_of(sql))
+        if shape is None:
+            shape = self.shapes[key] = Shape(sql)
+        shape.count += 1
+        source = source_of_statement()
+        shape.sources[source] += 1
+        if not STRICT:
+            return
+        if shape.count == N_PLUS_ONE and self._is_select(shape):
+            raise QueryBudgetExceeded("N+1 query in %s: %s issued %s times, last from %s"
+                                      % (self.handler, shape.sql, shape.count, source))
+        if self.statements == self.budget + 1:
+            raise QueryBudgetExceeded("%s issued more than %s statements, last from %s: %s"
+                                      % (self.handler, self.budget, source, sql))
+
+    def n_plus_one(self) -> list[Shape]:
+        """SELECT shapes issued N_PLUS_ONE or more times."""
+        return [shape for shape in self.shapes.values() if shape.count >= N_PLUS_ONE and self._is_select(shape)]
+
+    def report(self) -> None:
+        """Logs N+1 queries and exceeded budget of the finished update, each one once per handler and source."""
+        _totals["updates"] += 1
+        for shape in self.n_plus_one():
+            _totals["n_plus_one"] += 1
+            source = shape.sources.most_common(1)[0][0]
+            if _once((self.handler, "n_plus_one", shape_of(shape.sql), source)):
+                logger.warning("N+1 query in %s: %s issued %s times, mostly from %s", self.handler, shape.sql,
+                               shape.count, source)
+        if self.statements > self.budget:
+            _totals["over_budget"] += 1
+            sources = Counter()
+            for shape in self.shapes.values():
+                sources.update(shape.sources)
+            source = sources.most_common(1)[0][0]
+            if _once((self.handler, "over_budget", None, source)):
+                logger.warning("%s issued %s statements, budget is %s, mostly from %s", self.handler,
+                               self.statements, self.budget, source)
+
+    @staticmethod
+    def _is_select(shape: Shape) -> bool:
+        return shape.sql.lstrip()[:6].upper() == "SELECT"
+
+
+def _once(key: tuple) -> bool:
+    if key in _reported:
+        return False
+    _reported.add(key)
+    return True
+
+
+def stats() -> dict:
+    """Audited updates, N+1 queries found and updates over their budget since start."""
+    return dict(_totals)
@@ -0,0 +1,208 @@
+"""
+Outbound rate limiting.
+
+Every Bot API request with a ``chat_id`` passes two token buckets before it is sent: one of
+its chat(Telegram allows about one message per second in a chat, 20 per minute in a group)
+and the global one(about 30 messages per second). Requests of one chat are sent in order.
+When the global bucket is empty, waiting requests are released by priority, so replies to
+customers go before agent and admin list views(see :data:`request_priority`). RetryAfter
+pauses all throttled requests for the time given by Telegram, then the request is retried.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Request priorities, lower is sent first
+HIGH = 0
+LOW = 10
+
+# Priority of requests made by the current handler, set by SupportBot.query from the route
+request_priority: ContextVar[int] = ContextVar("request_priority", default=HIGH)
+
+GROUP_RATE = 20 / 60
+# Idle chat buckets are dropped once more chats are tracked
+MAX_IDLE_CHATS = 1000
+# Latencies kept for percentiles
+LATENCY_SAMPLES = 1000
+
+
+@dataclass(slots=True)
+class TokenBucket:
+    rate: float
+    capacity: float
+    tokens: float = 0.0
+    updated: float = 0.0
+
+    def __post_init__(self):
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Takes a token, returns 0 on success or seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self) -> bool:
+        """True when bucket would be full, so it can be dropped and recreated later."""
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class _Chat:
+    __slots__ = ("bucket", "lock", "waiting")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+
+
+class OutboundRateLimiter(BaseRateLimiter[int]):
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_retries: int = 3):
+        """
+        :param global_rate: Requests per second to all chats
+        :param chat_rate: Requests per second to one private chat
+        :param chat_burst: Requests to one chat sent without waiting
+        :param max_retries: Retries of request after RetryAfter
+        """
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: dict[int | str, _Chat] = {}
+        # (priority, sequence, future) of requests waiting for the global bucket
+        self._queue: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._pump: asyncio.Task | None = None
+        self._paused_until = 0.0
+        self._sent = 0
+        self._retries = 0
+        self._latencies: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._pump:
+            self._pump.cancel()
+            self._pump = None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await self._send(callback, args, kwargs, endpoint)
+
+        started = time.monotonic()
+        priority = rate_limit_args if rate_limit_args is not None else request_priority.get()
+        chat = self._chat(chat_id)
+        chat.waiting += 1
+        try:
+            async with chat.lock:
+                for attempt in range(self.max_retries + 1):
+                    while delay := chat.bucket.take():
+                        await asyncio.sleep(delay)
+                    await self._acquire(priority)
+                    try:
+                        result = await self._send(callback, args, kwargs, endpoint)
+                        break
+                    except RetryAfter as e:
+                        if attempt == self.max_retries:
+                            raise
+                        self._retries += 1
+                        self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                        logger.warning("%s to chat %s hit flood limit, retrying in %s s",
+                                       endpoint, chat_id, e.retry_after)
+        finally:
+            chat.waiting -= 1
+            if not chat.waiting and len(self._chats) > MAX_IDLE_CHATS:
+                self._prune()
+        self._sent += 1
+        self._latencies.append(time.monotonic() - started)
+        return result
+
+    def stats(self) -> dict:
+        """
+        Limiter metrics.
+
+        :return: Dictionary with requests inside the limiter, requests queued for the global
+            bucket, chats tracked, sent requests, RetryAfter retries, and average / p99 / max
+            latency in milliseconds from request to response over the last requests
+        """
+        latencies = sorted(self._latencies)
+        return {
+            "pending": sum(chat.waiting for chat in self._chats.values()),
+            "queued": sum(1 for _, _, future in self._queue if not future.done()),
+            "chats": len(self._chats),
+            "sent": self._sent,
+            "retries": self._retries,
+            "latency_avg_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            "latency_p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+            "latency_max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        }
+
+    @staticmethod
+    async def _send(callback, args, kwargs, endpoint: str):
+        """Makes the request, its latency and errors are recorded in app.metrics."""
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            metrics.api_errors.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            metrics.api_seconds.observe(endpoint, time.perf_counter() - started)
+
+    def _chat(self, chat_id: int | str) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(GROUP_RATE, 1) if is_group else TokenBucket(self.chat_rate, self.chat_burst)
+            chat = self._chats[chat_id] = _Chat(bucket)
+        return chat
+
+    def _prune(self) -> None:
+        for chat_id in [chat_id for chat_id, chat in self._chats.items() if not chat.waiting and chat.bucket.idle()]:
+            del self._chats[chat_id]
+
+    async def _acquire(self, priority: int) -> None:
+        if not self._queue and self._paused_until <= time.monotonic() and not self._global.take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._release())
+        await future
+
+    async def _release(self) -> None:
+        """Hands out global tokens to queued requests, highest priority first."""
+        while self._queue:
+            if self._queue[0][2].done():
+                # Cancelled while waiting
+                heapq.heappop(self._queue)
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if delay := self._global.take():
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._queue)[2].set_result(None)
@@ -0,0 +1,75 @@
+"""
+Callback query router.
+
+Callback data is resolved with a dictionary lookup for exact names and a prefix trie for
+data carrying arguments(e.g. ``inspect_id_12``), so dispatch cost does not grow with the
+number of buttons. Every route declares the roles it requires and whether it needs the
+User row at all, routes which do not are dispatched without touching the cache or database.
+"""
+from dataclasses import dataclass
+from typing import Callable
+
+# Route roles, names of User flags
+AGENT = "is_agent"
+ADMIN = "is_admin"
+
+# Trie node key holding the route of the prefix ending at the node
+_ROUTE = ""
+
+
+@dataclass(frozen=True, slots=True)
+class Route:
+    # async handler(update, context, user, data), user is None unless needs_user is set
+    handler: Callable
+    # All of them are required
+    roles: tuple[str, ...] = ()
+    needs_user: bool = True
+    # async denied(update, context), called when user lacks a role, nothing is done if None
+    denied: Callable | None = None
+    # Priority of messages sent by the handler, see app.ratelimit
+    priority: int = 0
+
+
+class CallbackRouter:
+    def __init__(self):
+        self._exact: dict[str, Route] = {}
+        self._prefixes: dict = {}
+
+    def add(self, names: str | tuple[str, ...], handler: Callable, prefix: bool = False, roles: tuple = (),
+            needs_user: bool = True, denied: Callable = None, priority: int = 0) -> None:
+        """
+        Registers route.
+        :param names: Callback data, or data prefixes if prefix is set
+        :param handler: async handler(update, context, user, data)
+        :param prefix: Match data starting with names
+        :param roles: User flags required by the route, see AGENT and ADMIN
+        :param needs_user: Resolve User before calling handler, unknown users get the start message
+        :param denied: async denied(update, context) called when user lacks a role
+        :param priority: Priority of messages sent by the handler, see app.ratelimit
+        """
+        route = Route(handler, tuple(roles), needs_user or bool(roles), denied, priority)
+        for name in ((names,) if isinstance(names, str) else names):
+            if not prefix:
+                self._exact[name] = route
+                continue
+            node = self._prefixes
+            for char in name:
+                node = node.setdefault(char, {})
+            node[_ROUTE] = route
+
+    def resolve(self, data: str) -> Route | None:
+        """Returns route of exact name, or of the longest matching prefix."""
+        route = self._exact.get(data)
+        if route is not None:
+            return route
+        node = self._prefixes
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            route = node.get(_ROUTE, route)
+        return route
+
+    @staticmethod
+    def allowed(route: Route, user) -> bool:
+        return all(getattr(user, role) for role in route.roles)
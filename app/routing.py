@@ -0,0 +1,108 @@
+"""
+Conversation routing index.
+
+Relaying a message only needs the chats at both ends of its conversation and the name of
+the customer, so they are kept in memory for every open conversation, by conversation ID.
+``Conversation.save()`` writes through the index, so created, joined and
+closed conversations are visible immediately. The index is warmed from open conversations
+on startup, conversations missing from it(e.g. closed ones) are read from the database.
+"""
+import threading
+from dataclasses import dataclass
+
+
+@dataclass(slots=True)
+class ConversationRoute:
+    conversation_id: int
+    customer_id: int
+    customer_chat: int
+    customer_name: str | None
+    agent_chat: int | None = None
+    is_closed: bool = False
+
+
+def route_of(conv) -> ConversationRoute:
+    return ConversationRoute(conv.id, conv.customer_id, conv.customer_chat, conv.customer_name, conv.agent_chat,
+                             conv.is_closed)
+
+
+class RoutingIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conversations: dict[int, ConversationRoute] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def get(self, conv_id: int) -> ConversationRoute | None:
+        """Returns route of open conversation, None if it is not indexed."""
+        with self._lock:
+            route = self._conversations.get(conv_id)
+            if route is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return route
+
+    def routes(self) -> list[ConversationRoute]:
+        """Routes of all indexed conversations."""
+        with self._lock:
+            return list(self._conversations.values())
+
+    def update(self, conv) -> None:
+        """Indexes saved conversation, closed ones are dropped."""
+        if conv.is_closed:
+            self.discard(conv.id)
+            return
+        route = route_of(conv)
+        with self._lock:
+            self._conversations[route.conversation_id] = route
+
+    def discard(self, conv_id: int) -> None:
+        with self._lock:
+            self._conversations.pop(conv_id, None)
+
+    def load(self, conv_id: int) -> ConversationRoute | None:
+        """
+        Returns route of conversation from the database, open ones are indexed.
+        Blocking, call it through :func:`app.dal.run_db`.
+        """
+        from app.models import Conversation
+
+        conv = Conversation.get_or_none(id=conv_id)
+        if conv is None:
+            return None
+        if not conv.is_closed:
+            self.update(conv)
+        return route_of(conv)
+
+    def warm(self) -> int:
+        """
+        Indexes all open conversations, returns their number.
+        Blocking, call it through :func:`app.dal.run_db`.
+        """
+        from app.models import Conversation
+
+        conversations = (Conversation
+                         .select(Conversation.id, Conversation.customer, Conversation.customer_chat,
+                                 Conversation.customer_name, Conversation.agent_chat, Conversation.is_closed)
+                         .where(Conversation.is_closed == False))
+        for conv in conversations.iterator():
+            self.update(conv)
+        return len(self)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conversations.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "conversations": len(self._conversations),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+routing_index = RoutingIndex()
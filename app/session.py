@@ -0,0 +1,110 @@
+"""
+Per user session state.
+
+``context.user_data`` lives as long as the bot process, so only a small :class:`Session`
+record is kept there: IDs, language, role flags, pending input and pagination cursors.
+Users and conversations are resolved on demand, users through :mod:`app.cache`,
+conversations from the database, so handlers never work with stale model instances. The
+message relay only needs conversation routes, which come from :mod:`app.routing`.
+"""
+from dataclasses import dataclass, field
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from app.cache import user_cache
+from app.dal import run_db
+from app.models import User, Conversation
+from app.routing import routing_index, ConversationRoute
+
+SESSION_KEY = "session"
+
+# Values of Session.waiting_for
+TOKEN_REPLY = "token"
+USERNAME_REPLY = "username"
+
+
+def load_user(user_id: int, update_id: int = None) -> User | None:
+    """
+    Returns user from cache or database.
+    Blocking, call it through :func:`app.dal.run_db`.
+    """
+    user = user_cache.get(user_id, update_id)
+    if user is None:
+        user = User.get_or_none(id=user_id)
+        if user:
+            user_cache.set(user, update_id)
+    return user
+
+
+@dataclass(slots=True)
+class Session:
+    user_id: int | None = None
+    lang: str | None = None
+    is_agent: bool = False
+    is_admin: bool = False
+    # Conversation joined as agent
+    conversation_id: int | None = None
+    # Conversation opened as customer
+    customer_conversation_id: int | None = None
+    conversation_created: bool = False
+    # Conversation shown in the agent conversation list
+    listed_conversation_id: int | None = None
+    waiting_for: str | None = None
+    # View name -> keyset pagination state, see app.pagination
+    pages: dict[str, dict] = field(default_factory=dict)
+
+    def remember(self, user: User) -> None:
+        """Copies ID and role flags of user."""
+        self.user_id = user.id
+        self.is_agent = user.is_agent
+        self.is_admin = user.is_admin
+
+    async def user(self, update: Update) -> User | None:
+        """Resolves author of update, role flags are refreshed from the result."""
+        tg_user = update.effective_user
+        user = await run_db(load_user, tg_user.id, update.update_id)
+        if user:
+            self.remember(user)
+        return user
+
+    async def conversation(self) -> Conversation | None:
+        return await self._conversation(self.conversation_id)
+
+    async def customer_conversation(self) -> Conversation | None:
+        return await self._conversation(self.customer_conversation_id)
+
+    async def route(self) -> ConversationRoute | None:
+        return await self._route(self.conversation_id)
+
+    async def customer_route(self) -> ConversationRoute | None:
+        return await self._route(self.customer_conversation_id)
+
+    def reset_menu(self) -> None:
+        """Drops pending input and pagination state of menus."""
+        self.waiting_for = None
+        self.listed_conversation_id = None
+        self.pages.clear()
+
+    @staticmethod
+    async def _conversation(conv_id: int | None) -> Conversation | None:
+        if conv_id is None:
+            return None
+        return await run_db(Conversation.get_or_none, id=conv_id)
+
+    @staticmethod
+    async def _route(conv_id: int | None) -> ConversationRoute | None:
+        if conv_id is None:
+            return None
+        route = routing_index.get(conv_id)
+        if route is None:
+            route = await run_db(routing_index.load, conv_id)
+        return route
+
+
+def get_session(context: ContextTypes.DEFAULT_TYPE) -> Session:
+    """Returns session of the current user, created on first access."""
+    session = context.user_data.get(SESSION_KEY)
+    if session is None:
+        session = context.user_data[SESSION_KEY] = Session()
+    return session
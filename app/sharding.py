@@ -0,0 +1,455 @@
+"""
+Sharded worker processes.
+
+With WORKERS > 1 the bot runs as a supervisor process and WORKERS worker processes, so
+handlers use more than one core. The supervisor receives updates once, by webhook or long
+polling, and forwards each one over a pipe to the worker owning its user(user ID modulo
+WORKERS), so updates of a user are still handled in order by one process. Updates without
+a user go to the workers in turn. Workers run the whole handler stack with their own
+database lanes, caches and write-behind queue, and read their pipe through
+:class:`ShardUpdater` instead of polling. Conversation routes and users saved by a worker
+are dropped from the caches of the other workers once the change is committed, so they are
+read from the database on next use.
+
+Workers report handled updates every second. The supervisor logs their health and queue
+depth(updates forwarded to a worker and not handled yet) every STATUS_INTERVAL seconds and
+restarts workers which exit unexpectedly. Updates already written to the pipe of a worker
+which exits are lost, later ones are forwarded to its replacement. SIGTERM, SIGINT and the
+shutdown button in any worker stop the supervisor: it stops receiving, forwards the updates
+already received and stops the workers, which shut down like a single process bot(see
+:mod:`app.lifecycle`).
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection
+from typing import Callable
+
+from telegram import Update
+from telegram.ext import Updater
+
+from app import metrics
+from app.cache import user_cache, subscribe, ROUTE, USER
+from app.processor import KeyedUpdateProcessor
+from app.routing import routing_index
+from app.translation import catalog
+
+logger = logging.getLogger(__name__)
+
+# Kind of change broadcast on top of saved rows(ROUTE and USER): texts reloaded by an admin, the key is unused
+TEXTS = "texts"
+
+# Seconds between reports of workers
+HEARTBEAT_INTERVAL = 1
+# Seconds between status logs of the supervisor, workers silent for STALE_AFTER seconds are reported
+STATUS_INTERVAL = 60
+STALE_AFTER = 10
+# Messages written to a worker pipe at once
+BATCH_SIZE = 100
+# Seconds workers get on top of SHUTDOWN_TIMEOUT to stop before they are killed
+STOP_GRACE = 10
+
+# The supervisor writes lists of ("update", data), ("invalidate", kind, key) and ("stop",) messages,
+# workers write single ("status", counters and metrics), ("invalidate", kind, key) and ("shutdown",) messages
+
+# Set in worker processes
+_shard: "Shard | None" = None
+
+
+def broadcast(kind: str, key: int) -> None:
+    """Drops cached row of kind(ROUTE, USER or TEXTS) in the other workers, does nothing in a single process."""
+    if _shard is not None:
+        _shard.send("invalidate", kind, key)
+
+
+subscribe(broadcast)
+
+
+def invalidate(kind: str, key: int) -> None:
+    if kind == ROUTE:
+        routing_index.discard(key)
+    elif kind == USER:
+        user_cache.invalidate(key)
+    elif kind == TEXTS:
+        # Called on the event loop, files are read in a thread and lookups meanwhile get the loaded texts
+        asyncio.get_running_loop().run_in_executor(None, catalog.reload)
+
+
+class Shard:
+    """Worker end of the pipe to the supervisor."""
+
+    def __init__(self, index: int, workers: int, connection: Connection):
+        self.index = index
+        self.workers = workers
+        self.connection = connection
+        # Messages are sent from the event loop and from database lanes
+        self._lock = threading.Lock()
+
+    def owns(self, user_id: int) -> bool:
+        """Tells if updates of user are forwarded to this worker."""
+        return user_id % self.workers == self.index
+
+    def send(self, *message) -> None:
+        try:
+            with self._lock:
+                self.connection.send(message)
+        except OSError as e:
+            logger.warning("Worker %s failed to reach the supervisor: %s", self.index, e)
+
+    def request_shutdown(self) -> None:
+        """Asks the supervisor to stop all workers."""
+        self.send("shutdown")
+
+
+class CountingQueue(asyncio.Queue):
+    """Update queue of workers, counts updates marked done by the application once handled."""
+
+    def __init__(self):
+        super().__init__()
+        self.handled = 0
+
+    def task_done(self) -> None:
+        super().task_done()
+        self.handled += 1
+
+
+class ShardUpdater(Updater):
+    """
+    Updater of worker processes, puts updates forwarded by the supervisor into the update queue.
+    start_polling and stop only start and stop reading the pipe, so Application.run_polling runs
+    a worker like a single process bot.
+    """
+    __slots__ = ("shard", "on_stop", "_heartbeat")
+
+    def __init__(self, bot, update_queue: CountingQueue, shard: Shard, on_stop: Callable[[], None]):
+        """
+        :param on_stop: Starts the shutdown of the worker, called when the supervisor stops it
+        """
+        super().__init__(bot, update_queue)
+        self.shard = shard
+        self.on_stop = on_stop
+        self._heartbeat: asyncio.Task | None = None
+
+    async def start_polling(self, *_args, **_kwargs) -> asyncio.Queue:
+        if self.running:
+            raise RuntimeError("This Updater is already running!")
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.shard.connection.fileno(), self._receive)
+        if self._heartbeat is None:
+            self._heartbeat = loop.create_task(self._report())
+        self._running = True
+        return self.update_queue
+
+    async def stop(self) -> None:
+        if not self.running:
+            raise RuntimeError("This Updater is not running!")
+        self._running = False
+        asyncio.get_running_loop().remove_reader(self.shard.connection.fileno())
+
+    async def shutdown(self) -> None:
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        self._send_status()
+        await super().shutdown()
+
+    def _receive(self) -> None:
+        connection = self.shard.connection
+        try:
+            while connection.poll():
+                for message in connection.recv():
+                    self._handle(message)
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(connection.fileno())
+            logger.error("Worker %s lost the supervisor, stopping", self.shard.index)
+            self.on_stop()
+
+    def _handle(self, message: tuple) -> None:
+        kind = message[0]
+        if kind == "update":
+            self.update_queue.put_nowait(Update.de_json(message[1], self.bot))
+        elif kind == "invalidate":
+            invalidate(*message[1:])
+        elif kind == "stop":
+            self.on_stop()
+
+    async def _report(self) -> None:
+        while True:
+            self._send_status()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def _send_status(self) -> None:
+        self.shard.send("status", {"handled": self.update_queue.handled, "queued": self.update_queue.qsize(),
+                                   "metrics": metrics.snapshot()})
+
+
+def run_worker(index: int, workers: int, connection: Connection) -> None:
+    """Entry point of worker processes, runs SupportBot with updates forwarded by the supervisor."""
+    # app.main and app.lifecycle import the models, which import this module
+    from app.config import TOKEN
+    from app.lifecycle import SIGNALS
+    from app.main import SupportBot
+    from app.models import db
+
+    global _shard
+    # Workers are stopped by the supervisor, signals sent to the whole process group are ignored
+    for sig in SIGNALS:
+        signal.signal(sig, signal.SIG_IGN)
+    _shard = Shard(index, workers, connection)
+    SupportBot(db_handler=db, token=TOKEN, shard=_shard).run()
+
+
+@dataclass(slots=True)
+class WorkerProcess:
+    index: int
+    # Messages waiting to be written to the pipe, in order
+    outbox: asyncio.Queue = field(default_factory=asyncio.Queue)
+    writer: ThreadPoolExecutor | None = None
+    process: multiprocessing.Process | None = None
+    connection: Connection | None = None
+    # Updates in outbox
+    waiting: int = 0
+    # Counters of the running process, reset on restart
+    forwarded: int = 0
+    handled: int = 0
+    queued: int = 0
+    last_seen: float = 0.0
+    restarts: int = 0
+    # Last app.metrics snapshot of the running process
+    metrics: dict | None = None
+
+    @property
+    def depth(self) -> int:
+        """Updates forwarded to the worker and not handled yet."""
+        return self.waiting + self.forwarded - self.handled
+
+
+class Supervisor:
+    def __init__(self, updater: Updater, workers: int, shutdown_timeout: float,
+                 metrics_address: tuple[str, int] = None):
+        """
+        :param updater: Updater receiving updates, its bot is only used to receive them
+        :param workers: Number of worker processes
+        :param shutdown_timeout: Seconds workers get to handle their updates on shutdown
+        :param metrics_address: (host, port) serving metrics of the workers, see app.metrics
+        """
+        self.updater = updater
+        self.timeout = shutdown_timeout
+        self.metrics_address = metrics_address
+        self.workers = [WorkerProcess(index) for index in range(workers)]
+        # Workers start a fresh interpreter instead of inheriting the running event loop
+        self._context = multiprocessing.get_context("spawn")
+        # Updates without a user go to the workers in turn
+        self._turn = itertools.cycle(self.workers)
+        self._stop: asyncio.Event | None = None
+        self._stopping = False
+
+    def run(self, webhook_options: dict = None) -> None:
+        """
+        Runs the supervisor and the workers until a stop signal.
+        :param webhook_options: Arguments of Updater.start_webhook, long polling is used without them
+        """
+        asyncio.run(self._run(webhook_options))
+
+    def request_stop(self) -> None:
+        """Starts the shutdown, a second request stops the workers without waiting for their updates."""
+        if self._stop.is_set():
+            logger.warning("Shutdown requested again, stopping workers without waiting")
+            for worker in self.workers:
+                self._post(worker, ("stop",))
+            return
+        self._stop.set()
+
+    def worker_of(self, update: object) -> WorkerProcess:
+        key = KeyedUpdateProcessor.key(update)
+        if key is None:
+            return next(self._turn)
+        return self.workers[key % len(self.workers)]
+
+    def stats(self) -> list[dict]:
+        """Health and queue depth of every worker."""
+        now = time.monotonic()
+        return [{
+            "worker": worker.index,
+            "pid": worker.process.pid if worker.process else None,
+            "alive": bool(worker.process and worker.process.is_alive()),
+            "last_seen_s": now - worker.last_seen,
+            "depth": worker.depth,
+            "queued": worker.queued,
+            "forwarded": worker.forwarded,
+            "handled": worker.handled,
+            "restarts": worker.restarts,
+        } for worker in self.workers]
+
+    def render_metrics(self) -> str:
+        """Metrics last reported by the workers, with their health as helpy_worker_* gauges."""
+        snapshots = {}
+        for worker, health in zip(self.workers, self.stats()):
+            data = worker.metrics or {"histograms": {}, "counters": {}, "stats": {}}
+            health = {key: value for key, value in health.items() if key not in ("worker", "pid")}
+            snapshots[str(worker.index)] = {**data, "stats": {**data["stats"], "worker": health}}
+        return metrics.render(snapshots)
+
+    def log_status(self) -> None:
+        stats = self.stats()
+        for worker in stats:
+            if worker["last_seen_s"] > STALE_AFTER:
+                logger.warning("Worker %s has not reported for %.0f s", worker["worker"], worker["last_seen_s"])
+        logger.info("Workers: %s", ", ".join("%(worker)s(pid %(pid)s, depth %(depth)s, handled %(handled)s)" % worker
+                                             for worker in stats))
+
+    async def _run(self, webhook_options: dict | None) -> None:
+        # app.lifecycle imports the models, which import this module
+        from app.lifecycle import SIGNALS
+
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for sig in SIGNALS:
+            loop.add_signal_handler(sig, self.request_stop)
+        for worker in self.workers:
+            worker.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard%s" % worker.index)
+            self._start(worker)
+        tasks = [loop.create_task(self._write(worker)) for worker in self.workers]
+        tasks.append(loop.create_task(self._monitor()))
+        server = metrics.serve(*self.metrics_address, self.render_metrics) if self.metrics_address else None
+        await self.updater.initialize()
+        try:
+            if webhook_options:
+                await self.updater.start_webhook(**webhook_options)
+            else:
+                await self.updater.start_polling()
+            tasks.append(loop.create_task(self._forward()))
+            logger.info("Supervisor started with %s workers", len(self.workers))
+            await self._stop.wait()
+            logger.info("Shutting down, forwarding received updates to workers")
+            await self.updater.stop()
+            await self.updater.update_queue.join()
+        finally:
+            if self.updater.running:
+                await self.updater.stop()
+            await self._stop_workers()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for worker in self.workers:
+                self._close(worker)
+                worker.writer.shutdown(wait=False)
+            await self.updater.shutdown()
+            if server:
+                server.stop()
+
+    def _start(self, worker: WorkerProcess) -> None:
+        parent, child = self._context.Pipe()
+        worker.process = self._context.Process(target=run_worker, args=(worker.index, len(self.workers), child),
+                                               name="worker-%s" % worker.index, daemon=True)
+        worker.process.start()
+        # Only the worker holds the other end now, so reading fails once it exits
+        child.close()
+        worker.connection = parent
+        worker.forwarded = worker.handled = worker.queued = 0
+        worker.metrics = None
+        worker.last_seen = time.monotonic()
+        asyncio.get_running_loop().add_reader(parent.fileno(), self._receive, worker)
+
+    def _close(self, worker: WorkerProcess) -> None:
+        if worker.connection is None or worker.connection.closed:
+            return
+        asyncio.get_running_loop().remove_reader(worker.connection.fileno())
+        worker.connection.close()
+
+    def _post(self, worker: WorkerProcess, message: tuple) -> None:
+        if message[0] == "update":
+            worker.waiting += 1
+        worker.outbox.put_nowait(message)
+
+    async def _forward(self) -> None:
+        queue = self.updater.update_queue
+        while True:
+            update = await queue.get()
+            try:
+                self._post(self.worker_of(update), ("update", update.to_dict()))
+            finally:
+                queue.task_done()
+
+    async def _write(self, worker: WorkerProcess) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await worker.outbox.get()]
+            while len(batch) < BATCH_SIZE and not worker.outbox.empty():
+                batch.append(worker.outbox.get_nowait())
+            # Messages not written yet are kept for the restarted worker
+            while worker.connection.closed and not self._stopping:
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+            updates = sum(message[0] == "update" for message in batch)
+            worker.waiting -= updates
+            try:
+                # Pipe writes block while the worker is behind, each worker has its own writer thread
+                await loop.run_in_executor(worker.writer, worker.connection.send, batch)
+                worker.forwarded += updates
+            except OSError as e:
+                logger.error("Failed to forward %s updates to worker %s: %s", updates, worker.index, e)
+
+    def _receive(self, worker: WorkerProcess) -> None:
+        connection = worker.connection
+        try:
+            while connection.poll():
+                message = connection.recv()
+                worker.last_seen = time.monotonic()
+                if message[0] == "status":
+                    worker.handled = message[1]["handled"]
+                    worker.queued = message[1]["queued"]
+                    worker.metrics = message[1]["metrics"]
+                elif message[0] == "invalidate":
+                    for other in self.workers:
+                        if other is not worker:
+                            self._post(other, message)
+                elif message[0] == "shutdown":
+                    logger.info("Shutdown requested by worker %s", worker.index)
+                    self.request_stop()
+        except (EOFError, OSError):
+            # Worker exited, restarted by _monitor
+            self._close(worker)
+
+    async def _monitor(self) -> None:
+        logged = time.monotonic()
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            for worker in self.workers:
+                if self._stopping or worker.process.exitcode is None:
+                    continue
+                logger.error("Worker %s exited with code %s, restarting it, %s updates were not handled",
+                             worker.index, worker.process.exitcode, worker.forwarded - worker.handled)
+                self._close(worker)
+                worker.restarts += 1
+                self._start(worker)
+            if time.monotonic() - logged >= STATUS_INTERVAL:
+                logged = time.monotonic()
+                self.log_status()
+
+    async def _stop_workers(self) -> None:
+        self._stopping = True
+        for worker in self.workers:
+            self._post(worker, ("stop",))
+        await asyncio.gather(*(self._join(worker) for worker in self.workers))
+        logger.info("Workers stopped")
+
+    async def _join(self, worker: WorkerProcess) -> None:
+        loop = asyncio.get_running_loop()
+        process = worker.process
+        exited = loop.create_future()
+        # The sentinel becomes readable once the process exits
+        loop.add_reader(process.sentinel, lambda: exited.done() or exited.set_result(None))
+        try:
+            await asyncio.wait_for(exited, self.timeout + STOP_GRACE)
+        except asyncio.TimeoutError:
+            logger.error("Worker %s did not stop in time, killing it", worker.index)
+            process.kill()
+        finally:
+            loop.remove_reader(process.sentinel)
+        await asyncio.to_thread(process.join)
@@ -1,296 +1,220 @@
-dictionary = {
-    "lang_en": {
-        "ag_b1":
-            "⌛️ Awaiting response from agent",
-
-        "ag_b2":
-            "😴 Awaiting response from customer",
-
-        "ag_b3":
-            "✅ Completed conversations",
-
-        "token_b":
-            "🔐 Using Token",
-
-        "add_agent_b":
-            "➕ Add Support Agent",
-
-        "agent_list_b":
-            "💻 Active Support Agents",
-
-        "ot_token_b":
-            "🔐 One time Tokens",
-
-        "gen_token_b":
-            "🎲 Generate Token",
-
-        "shutdown_b":
-            "❌ Shutdown Bot",
-
-        "previous_page_b":
-            "◀️ Previous page",
-
-        "return_b":
-            "↩️ Go Back",
-
-        "next_page_b":
-            "▶️ Next page",
-
-        "try_again_b":
-            "🔁 Try Again",
-
-        "contact_support_b":
-            "Contact Support",
-
-        "something_b":
-            "Something Else",
-
-        "welcome":
-            "Hello %s! My name is HelPy. I'm your assistant bot for today :)\n\nHow can i help you?",
-
-        "authorized_ag":
-            "🔑 Authorized as Agent",
-
-        "choose_auth":
-            "Choose an authorization method:",
-
-        "send_token":
-            "Send me your Token:",
-
-        "wrong_token":
-            "Wrong Token",
-
-        "activated_token":
-            "Token has been already activated",
-
-        "authorized_ad":
-            "🔑 Authorized as Admin",
-
-        "unauthorized_ad": "Unauthorized. \nPlease contact Management to obtain access.",
-
-        "future_agent_add": "Send me username of future agent:",
-
-        "wrong_username": "Wrong username",
-
-        "already_added": "%s already added",
-
-        "future_agent_added":
-            "%s added as agent",
-
-        "pagination":
-            "Page:",
-
-        "agent_name":
-            "Agent name:",
-
-        "tg_id":
-            "TG Id:",
-
-        "last_page":
-            "Last page",
-
-        "conversation_start_1":
-            "Send me your question to start a conversation:",
-
-        "conversation_start_2":
-            "Wait for a support agent to join...",
-
-        "msg":
-            "Message:",
-
-        "name":
-            "Name:",
-
-        "give_answer_b":
-            "Join",
-
-        "no_active_conv":
-            "There are no active conversations",
-
-        "ag_joined_1":
-            "Joined to conversation with ID: %s",
-
-        "ag_joined_2":
-            "Agent joined...",
-
-        "conv_closed_1":
-            "Conversation closed with ID: %s",
-
-        "conv_closed_2":
-            "Conversation closed. Did you get an answer to your question?",
-
-        "wrong_type_1":
-            "Wrong ID",
-
-        "conv_not_exist":
-            "Conversation with ID %s doesn't exist",
-
-        "inspect_conv_b":
-            "🔎 Inspect",
-
-        "no_closed_conv":
-            "No closed conversations",
-
-        "no_active_tokens":
-            "No active tokens"
-
-    }
-    ,
-    "lang_uk": {
-        "ag_b1":
-            "⌛️ Очікують відповіді від агента",
-
-        "ag_b2":
-            "😴 Очікують відповіді від користувача",
-
-        "ag_b3":
-            "✅ Завершені діалоги",
-
-        "token_b":
-            "🔐 Використовуючи токен",
-
-        "add_agent_b":
-            "➕ Додати агента",
-
-        "agent_list_b":
-            "💻 Активні агенти",
-
-        "ot_token_b":
-            "🔐 Одноразові токени",
-
-        "gen_token_b":
-            "🎲 Згенерувати токен",
-
-        "shutdown_b":
-            "❌ Вимкнути бота",
-
-        "previous_page_b":
-            "◀️ Минула сторінка",
-
-        "return_b":
-            "↩️ Повернутись назад",
-
-        "next_page_b":
-            "▶️ Наступна сторінка",
-
-        "try_again_b":
-            "🔁 Повторити",
-
-        "contact_support_b":
-            "Зв'язатися з оператором",
-
-        "something_b":
-            "Щось ще",
-
-        "welcome":
-            "Привіт, %s! Мене звати HelPy. Сьогодні я твій помічник :) \n\nЧим я можу тобі допомогти?",
-
-        "authorized_ag":
-            "🔑 Авторизований як агент",
-
-        "choose_auth":
-            "Оберіть спосіб авторизації:",
-
-        "send_token":
-            "Надішліть мені токен:",
-
-        "wrong_token":
-            "Неправильний токен",
-
-        "activated_token":
-            "Токен вже активований",
-
-        "authorized_ad":
-            "🔑 Авторизований як адмін",
-
-        "unauthorized_ad": "Не авторизовано. \nБудь-ласка, зв'яжіться з адміністрацією для отримання доступу.",
-
-        "future_agent_add": "Надішліть мені прізвисько майбутнього агента:",
-
-        "wrong_username": "Неправильне прізвисько користувача",
-
-        "already_added": "%s вже додано",
-
-        "future_agent_added":
-            "Користувача %s додано як агента",
-
-        "pagination":
-            "Сторінка:",
-
-        "agent_name":
-            "Ім'я агента:",
-
-        "tg_id":
-            "TG Id:",
-
-        "last_page":
-            "Остання сторінка",
-
-        "conversation_start_1":
-            "Надішліть мені ваше запитання:",
-
-        "conversation_start_2":
-            "Зачекайте поки агент підтримки під'єднається...",
-
-        "msg":
-            "Повідомлення:",
-
-        "name":
-            "Ім'я:",
-
-        "give_answer_b":
-            "Приєднатися",
-
-        "no_active_conv":
-            "Немає активних діалогів",
-
-        "ag_joined_1":
-            "Приєднано до чату з ID: %s",
+"""
+Bot texts.
+
+Texts of a language are stored in ``LOCALES_DIR/<language>.json``(keyword -> text or %
+template). A language is read when it is first needed, so languages nobody uses cost nothing,
+and completed: keys missing in it and templates whose placeholders differ from the English
+ones fall back to English, problems are logged once when the file is read. Languages
+without a file use English.
+
+Files are never read on the event loop: the default language and languages of users are
+preloaded at start, :func:`ensure_loaded` reads a language in a thread before it is used, and
+a lookup of a language which is not loaded yet gets the default texts while the language is
+read in the background. Without a running loop(scripts, tests) lookups read files directly.
+
+:meth:`Catalog.reload` reads loaded languages again and swaps all tables at once, lookups
+running meanwhile get either the old or the new texts. It is called by the /reload command
+of admins and, with LOCALES_RELOAD_INTERVAL, by :func:`watch` when a file changes.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import threading
 
-        "ag_joined_2":
-            "Агента під'єднано...",
+from app.config import LOCALES_DIR
 
-        "conv_closed_1":
-            "Спілкування завершено з ID: %s",
+logger = logging.getLogger(__name__)
 
-        "conv_closed_2":
-            "Спілкування завершено. Чи ви отримали відповідь на ваше питання?",
+DEFAULT_LANGUAGE = "lang_en"
+PLACEHOLDER = re.compile(r"%.")
+# Language codes come from users and the database, only plain names are looked up as files
+LANGUAGE = re.compile(r"[a-z]{2,8}(_[a-z]{2,8})?")
 
-        "wrong_type_1":
-            "Неправильний ID",
 
-        "conv_not_exist":
-            "Розмови з ID %s не існує",
+def placeholders(template: str) -> list[str]:
+    return [field for field in PLACEHOLDER.findall(template) if field != "%%"]
 
-        "inspect_conv_b":
-            "🔎 Оглянути",
 
-        "no_closed_conv":
-            "Немає завершених розмов",
+def locale_path(lang: str) -> str:
+    return os.path.join(LOCALES_DIR, lang + ".json")
 
-        "no_active_tokens":
-            "Немає активних токенів"
 
-    },
-}
-starting_message = """
-Select the language of communication:
------------------------------------------------------------
-Оберіть мову спілкування:
-"""
+def read_texts(lang: str) -> dict[str, str] | None:
+    """Returns texts of language from its file, None if there is no such file."""
+    try:
+        with open(locale_path(lang), encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def complete_texts(lang: str, entries: dict[str, str], fallback: dict[str, str] = None) -> dict[str, str]:
+    """
+    Builds complete table of language.
+    :param entries: Keyword -> text or % template, read from the file of the language
+    :param fallback: Table used for missing and broken texts, None for the default language
+    """
+    if fallback is None:
+        return dict(entries)
+    table = dict(fallback)
+    missing = sorted(fallback.keys() - entries.keys())
+    if missing:
+        logger.warning("Texts missing in %s, %s ones are used: %s", lang, DEFAULT_LANGUAGE, ", ".join(missing))
+    for keyword, text in entries.items():
+        if keyword in fallback and placeholders(text) != placeholders(fallback[keyword]):
+            logger.warning("Placeholders of %s in %s differ from %s, its text is used", keyword, lang,
+                           DEFAULT_LANGUAGE)
+            continue
+        table[keyword] = text
+    return table
+
+
+class Catalog:
+    def __init__(self, default: str = DEFAULT_LANGUAGE):
+        self.default = default
+        # Language -> table, replaced as a whole. Languages without a file share the default table
+        self.tables: dict[str, dict[str, str]] = {}
+        # Language -> modification time of its file when read, None without a file
+        self._mtimes: dict[str, int | None] = {}
+        self._lock = threading.Lock()
+        self._callbacks = []
+        # Languages being read in the background
+        self._pending: set[str] = set()
+
+    def load(self, lang: str) -> dict[str, str]:
+        """Returns table of language, reads it on first use. Malformed codes get the default table."""
+        with self._lock:
+            if self.default not in self.tables:
+                tables, mtimes = dict(self.tables), dict(self._mtimes)
+                self._read(self.default, tables, mtimes, {})
+                self.tables, self._mtimes = tables, mtimes
+            if not LANGUAGE.fullmatch(lang):
+                return self.tables[self.default]
+            if lang not in self.tables:
+                tables, mtimes = dict(self.tables), dict(self._mtimes)
+                self._read(lang, tables, mtimes, {})
+                self.tables, self._mtimes = tables, mtimes
+            return self.tables[lang]
+
+    def preload(self, languages) -> None:
+        """Reads languages not loaded yet and the default one, blocking."""
+        self.load(self.default)
+        for lang in languages:
+            self.load(lang)
+
+    def get(self, lang: str) -> dict[str, str]:
+        """
+        Returns table of language without reading files on the event loop, a language which is not
+        loaded yet gets the default table and is read in the background.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self.load(lang)
+        default = self.tables.get(self.default)
+        if default is None:
+            # Preloaded at start, only read here when the bot was not started
+            return self.load(lang)
+        if LANGUAGE.fullmatch(lang) and lang not in self._pending:
+            self._pending.add(lang)
+            loop.run_in_executor(None, self.load, lang).add_done_callback(functools.partial(self._loaded, lang))
+        return default
+
+    def _loaded(self, lang: str, future: asyncio.Future) -> None:
+        self._pending.discard(lang)
+        if future.cancelled() or future.exception() is not None:
+            return
+        # Texts cached elsewhere while the language was read were built from the default table
+        if future.result() is not self.tables.get(self.default):
+            for callback in self._callbacks:
+                callback()
+
+    def reload(self) -> list[str]:
+        """Reads loaded languages again and swaps their tables at once, returns languages with a file."""
+        with self._lock:
+            previous = self.tables
+            tables, mtimes = {}, {}
+            for lang in sorted(self._mtimes, key=lambda lang: lang != self.default):
+                self._read(lang, tables, mtimes, previous)
+            self.tables, self._mtimes = tables, mtimes
+        for callback in self._callbacks:
+            callback()
+        return [lang for lang, mtime in mtimes.items() if mtime is not None]
+
+    def changed(self) -> bool:
+        """Tells if a file of a loaded language was changed, created or removed since it was read."""
+        return any(self._mtime(lang) != mtime for lang, mtime in self._mtimes.items())
+
+    def on_reload(self, callback) -> None:
+        """
+        Calls callback() after every reload and once a language read in the background is ready,
+        e.g. to drop texts cached elsewhere.
+        """
+        self._callbacks.append(callback)
+
+    def _read(self, lang: str, tables: dict, mtimes: dict, previous: dict) -> None:
+        mtimes[lang] = self._mtime(lang)
+        fallback = None if lang == self.default else tables[self.default]
+        try:
+            entries = read_texts(lang)
+        except (OSError, ValueError) as e:
+            # Broken file, e.g. saved while being edited
+            if lang in previous:
+                logger.error("Failed to read texts of %s, loaded ones are kept: %s", lang, e)
+                tables[lang] = previous[lang]
+                return
+            if fallback is None:
+                raise
+            logger.error("Failed to read texts of %s, %s ones are used: %s", lang, self.default, e)
+            tables[lang] = fallback
+            return
+        if entries is None:
+            if fallback is None:
+                raise FileNotFoundError("Texts of %s not found in %s" % (lang, LOCALES_DIR))
+            tables[lang] = fallback
+            return
+        tables[lang] = complete_texts(lang, entries, fallback)
+
+    @staticmethod
+    def _mtime(lang: str) -> int | None:
+        try:
+            return os.stat(locale_path(lang)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+
+catalog = Catalog()
+# Unknown keywords, logged once
+_unknown: set[str] = set()
 
 
 def translate(keyword, lang, insert=None):
+    table = catalog.tables.get(lang) or catalog.get(lang)
     try:
-        if keyword == "starting_msg":
-            return starting_message
-        if lang not in ("lang_uk", "lang_ru", "lang_en"):
-            if insert:
-                return dictionary["lang_en"][keyword] % insert
-            return dictionary["lang_en"][keyword]
-        if insert:
-            return dictionary[lang][keyword] % insert
-        return dictionary[lang][keyword]
+        text = table[keyword]
     except KeyError:
-        print("Dictionary error occurred:", lang, keyword)
+        if keyword not in _unknown:
+            _unknown.add(keyword)
+            logger.error("Unknown text: %s", keyword)
         return keyword
+    if insert:
+        return text % insert
+    return text
+
+
+async def ensure_loaded(lang: str) -> None:
+    """Reads texts of language in a thread unless they are loaded."""
+    if lang not in catalog.tables:
+        await asyncio.to_thread(catalog.load, lang)
+
+
+async def watch(interval: float) -> None:
+    """Reloads texts when a file of a loaded language changes, files are checked every interval seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        if await asyncio.to_thread(catalog.changed):
+            languages = await asyncio.to_thread(catalog.reload)
+            logger.info("Texts reloaded: %s", ", ".join(languages))
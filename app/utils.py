@@ -7,8 +7,13 @@ from telegram import Update, _user
 from telegram.ext import ContextTypes
 
 from app import keyboards as kb
+from app.metrics import timed
+from app.dal import run_db
+from app.pagination import KeysetPaginator, FIRST, NEXT, PREVIOUS, page_label
+from app.session import get_session, load_user
 from app.translation import translate
-from app.models import User, Conversation, ConversationThrough, Message, Token
+from app.models import User, Conversation, Message, Token
+from app.write_behind import write_batch, message_row
 
 
 def generate_token(length=48):
@@ -52,6 +57,8 @@ def get_line_number() -> FrameType | None:
 def get_user(tg: int | Update, return_tg_data=False) -> User | _user.User:
     """
     Searches and returns User.
+    Users are cached(see :mod:`app.cache`), so repeated calls while handling one update are free.
+    Blocking unless return_tg_data is set, call it through :func:`app.dal.run_db`.
     :param tg: User Telegram ID(int) or Update
     :type tg: int | Update
     :param return_tg_data: If true, return as Telegram Data Dictionary
@@ -67,11 +74,10 @@ def get_user(tg: int | Update, return_tg_data=False) -> User | _user.User:
         if return_tg_data:
             user = tg_data
         else:
-
-            user = User.get_or_none(id=tg_data.id)
+            user = load_user(tg_data.id, tg.update_id)
 
     else:
-        user = User.get_or_none(id=tg)
+        user = load_user(tg)
 
     # # To print where database is involved
     # if isinstance(user, User):
@@ -79,247 +85,174 @@ def get_user(tg: int | Update, return_tg_data=False) -> User | _user.User:
     return user
 
 
-def check_callback_data(cd: str, to_inspect: tuple) -> bool:
+def add_message(conv_id: int, user: User, text: str, attachment: tuple[str, str] = None) -> None:
     """
-    Search inspect string in callback data
-    :param cd: Telegram callback data
-    :param to_inspect: Tuple of strings to search
-    :return: If found returns True, else False
+    Stores message in the conversation and updates conversation summary in the same transaction.
+    Blocking, call it through :func:`app.dal.run_db`.
+
+    :param conv_id: Conversation ID
+    :param user: Author of the message
+    :param text: Message text or caption
+    :param attachment: (type, file_id) of attachment, see :mod:`app.media`
     """
-    if any(s in cd for s in to_inspect):
-        return True
-    else:
-        return False
+    write_batch([message_row(conv_id, user.id, text, attachment)])
+
 
+def used_languages() -> list[str]:
+    """Returns languages chosen by users. Blocking, call it through :func:`app.dal.run_db`."""
+    return [language for language, in User.select(User.language).distinct().tuples()]
 
-def clear_context(context: ContextTypes.DEFAULT_TYPE, save: tuple = None, remove: tuple = None) -> None:
+
+def clear_context(context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Clears specific keys from the user data in the provided context.
+    Clears menu state of the user session: pending token or username reply, selected conversation
+    and pagination cursors. Language, role flags and open conversations are kept.
     :param context: (ContextTypes.DEFAULT_TYPE): The context object containing user data.
-    :param save: (tuple, optional): A tuple of keys to be excluded from removal. Default is None.
-    :param remove: A tuple of keys to be included in the cleanup.
+    """
+    get_session(context).reset_menu()
 
-    Default keys to remove:
 
-    "waiting_for_username_reply",
-    "waiting_for_token_reply",
-    "a_c_page_list",
-    "conversation_id",
-    "inspect_list_page",
-    "agent_list_page",
-    "token_page_list"
+token_pages = KeysetPaginator((Token.id,), per_page=5)
+conversation_pages = KeysetPaginator((Conversation.id,), per_page=1)
+message_pages = KeysetPaginator((Message.created_at, Message.id), per_page=5)
+agent_pages = KeysetPaginator((User.id,), per_page=5)
 
-    """
-    to_remove = ["waiting_for_username_reply", "a_c_page_list", "conversation_id", "inspect_list_page",
-                 "agent_list_page", "token_page_list", "waiting_for_token_reply"]
 
-    if save:
-        for item in save:
-            to_remove.pop(item)
-    if remove:
-        for item in remove:
-            to_remove.append(item)
-
-    for item in to_remove:
-        context.user_data.pop(item, None)
+def get_direction(callback_data: str, previous: str, next_: str) -> str:
+    """Maps previous/next button callback data to pagination direction, anything else opens first page."""
+    if callback_data == previous:
+        return PREVIOUS
+    if callback_data == next_:
+        return NEXT
+    return FIRST
 
 
+@timed
 async def paginate_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE, _user: User, lang: str, ):
     query = update.callback_query
     callback_data = update.callback_query.data
 
-    count = Token.filter(Token.is_activated == False).count()
-    if count == 0:
-        await query.answer(translate("no_active_tokens", lang), show_alert=True)
+    direction = get_direction(callback_data, "tokens_previous", "tokens_next")
+    state = get_session(context).pages.setdefault("token_page_list", {})
+    tokens = Token.select().where(Token.is_activated == False)
+    pagination = await run_db(token_pages.page, tokens, state, direction)
+    if pagination is None:
+        if direction == FIRST:
+            await query.answer(translate("no_active_tokens", lang), show_alert=True)
+        else:
+            await query.answer(translate("last_page", lang))
         return
-    max_q = get_pages(count)
-    context.user_data.setdefault("token_page_list", 1)
-
-    if callback_data == "token_list":
-        context.user_data["token_page_list"] = 1
-    elif callback_data == "tokens_previous":
-        context.user_data["token_page_list"] = max(1, context.user_data["token_page_list"] - 1)
-    elif callback_data == "tokens_next":
-        context.user_data["token_page_list"] = min(max_q, context.user_data["token_page_list"] + 1)
-
-    pagination = Token.select().where(Token.is_activated == False).paginate(
-        context.user_data["token_page_list"], 5)
+    max_q = await run_db(token_pages.pages, tokens)
 
     result = "".join(
         [f"```id:{token.id}\n{token.token}```\n\n" for token in pagination])
 
     try:
         await update.callback_query.message.edit_text(
-            f"{translate("pagination", lang)} {context.user_data["token_page_list"]} / {max_q}\n{result}",
+            f"{translate("pagination", lang)} {page_label(state, max_q)}\n{result}",
             parse_mode='MarkdownV2',
             reply_markup=kb.tokens_pagination(lang))
     except telegram.error.BadRequest:
         await query.answer(translate("last_page", lang))
-    pass
 
 
-async def paginate_active_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE, _user: User, lang: str, ):
+async def _paginate_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, convs, state_key: str,
+                                  direction: str, empty_msg: str, keyboard, *cache_key):
+    """Shared part of conversation list views, one conversation per page."""
     query = update.callback_query
-    callback_data = update.callback_query.data
-    count = Conversation.filter(Conversation.is_closed == False).count()
-    if count == 0:
-        await query.answer(translate("no_active_conv", lang), show_alert=True)
-        return
-    max_q = get_pages(count, max_q=1)
-    context.user_data.setdefault("a_c_page_list", 1)
-    if callback_data == "ag1":
-
-        context.user_data["a_c_page_list"] = 1
-    elif callback_data == "a_c_previous":
-        context.user_data["a_c_page_list"] = max(1, context.user_data[
-            "a_c_page_list"] - 1)
-    elif callback_data == "a_c_next":
-        context.user_data["a_c_page_list"] = min(max_q, context.user_data[
-            "a_c_page_list"] + 1)
-
-    conv = Conversation.select().where(Conversation.is_closed == False).paginate(
-        context.user_data["a_c_page_list"], 1).first()
-
-    first_msg = Message.select().join(ConversationThrough).where(
-        ConversationThrough.conversation == conv).order_by(Message.created_at).first()
-    msg_body = first_msg.body if isinstance(first_msg, Message) else None
-    context.user_data["conversation_id"] = conv.id
+    state = get_session(context).pages.setdefault(state_key, {})
+    page = await run_db(conversation_pages.page, convs, state, direction)
+    if page is None:
+        if direction == FIRST:
+            await query.answer(translate(empty_msg, lang), show_alert=True)
+        else:
+            await query.answer(translate("last_page", lang))
+        return None
+    conv = page[0]
+    max_q = await run_db(conversation_pages.pages, convs, state_key, *cache_key)
 
     result = "".join(f"ID: {conv.id}\n"
-                     f"{translate("msg", lang)} {msg_body}\n"
-                     f"{translate("name", lang)} {conv.customer.tg_name}\n\n ")
+                     f"{translate("msg", lang)} {conv.first_message_preview}\n"
+                     f"{translate("name", lang)} {conv.customer_name}\n\n ")
     try:
         await update.callback_query.edit_message_text(
-            f"{translate("pagination", lang)} {context.user_data["a_c_page_list"]} / "
-            f"{max_q}\n{result}", reply_markup=kb.a_c_pagination(lang, conv.id))
+            f"{translate("pagination", lang)} {page_label(state, max_q)}\n{result}",
+            reply_markup=keyboard(lang, conv.id))
     except telegram.error.BadRequest:
         await query.answer(translate("last_page", lang))
+    return conv
 
 
-async def paginate_joined_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, lang: str, ):
-    query = update.callback_query
-    callback_data = update.callback_query.data
+@timed
+async def paginate_active_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE, _user: User, lang: str, ):
+    direction = get_direction(update.callback_query.data, "a_c_previous", "a_c_next")
+    conv = await _paginate_conversations(update, context, lang, Conversation.select().where(
+        Conversation.is_closed == False), "a_c_page_list", direction, "no_active_conv", kb.a_c_pagination)
+    if conv:
+        get_session(context).listed_conversation_id = conv.id
 
-    count = Conversation.filter((Conversation.is_closed == False) & (Conversation.agent == user)).count()
-    if count == 0:
-        await query.answer(translate("no_active_conv", lang), show_alert=True)
-        return
-    max_q = get_pages(count, max_q=1)
-    context.user_data.setdefault("a_j_c_page_list", 1)
-    if callback_data == "ag2":
-        context.user_data["a_j_c_page_list"] = 1
-    elif callback_data == "a_j_c_previous":
-        context.user_data["a_j_c_page_list"] = max(1, context.user_data[
-            "a_j_c_page_list"] - 1)
-    elif callback_data == "a_j_c_next":
-        context.user_data["a_j_c_page_list"] = min(max_q, context.user_data[
-            "a_j_c_page_list"] + 1)
-
-    conv = Conversation.filter((Conversation.is_closed == False) & (Conversation.agent == user)).paginate(
-        context.user_data["a_j_c_page_list"], 1).first()
-
-    first_msg = Message.select().join(ConversationThrough).where(
-        ConversationThrough.conversation == conv).order_by(Message.created_at).first()
-    msg_body = first_msg.body if hasattr(first_msg, "__data__") else None
-    context.user_data["conversation_id"] = conv
 
-    result = "".join(f"ID: {conv.id}\n"
-                     f"{translate("msg", lang)} {msg_body}\n"
-                     f"{translate("name", lang)} {conv.customer.tg_name}\n\n ")
-    try:
-        await update.callback_query.edit_message_text(
-            f"{translate("pagination", lang)} {context.user_data["a_j_c_page_list"]} / "
-            f"{max_q}\n{result}", reply_markup=kb.a_j_c_pagination(lang, conv.id))
-    except telegram.error.BadRequest:
-        await query.answer(translate("last_page", lang))
+@timed
+async def paginate_joined_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, lang: str, ):
+    direction = get_direction(update.callback_query.data, "a_j_c_previous", "a_j_c_next")
+    conv = await _paginate_conversations(update, context, lang, Conversation.select().where(
+        (Conversation.is_closed == False) & (Conversation.agent == user)), "a_j_c_page_list", direction,
+        "no_active_conv", kb.a_j_c_pagination, user.id)
+    if conv:
+        get_session(context).listed_conversation_id = conv.id
 
 
+@timed
 async def paginate_closed_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, lang: str, ):
-    query = update.callback_query
-
-    callback_data = update.callback_query.data
-
-    count = Conversation.filter(Conversation.is_closed == True).count()
-    if count == 0:
-        await query.answer(translate("no_closed_conv", lang), show_alert=True)
-        return
-
-    max_q = get_pages(count, max_q=1)
-    context.user_data.setdefault("c_c_page_list", 1)
-
-    if callback_data in "ag3":
-        context.user_data["c_c_page_list"] = 1
-    elif callback_data == "c_c_previous":
-        context.user_data["c_c_page_list"] = max(1, context.user_data["c_c_page_list"] - 1)
-    elif callback_data == "c_c_next":
-        context.user_data["c_c_page_list"] = min(max_q, context.user_data["c_c_page_list"] + 1)
-
-    conv = Conversation.select().where(
-        Conversation.agent == user, Conversation.is_closed == True).paginate(
-        context.user_data["c_c_page_list"], 1).first()
-
+    direction = get_direction(update.callback_query.data, "c_c_previous", "c_c_next")
+    conv = await _paginate_conversations(update, context, lang, Conversation.select().where(
+        (Conversation.agent == user) & (Conversation.is_closed == True)), "c_c_page_list", direction,
+        "no_closed_conv", kb.c_c_pagination, user.id)
     if conv:
-        first_msg = Message.select().join(ConversationThrough).where(
-            ConversationThrough.conversation == conv).order_by(Message.created_at).first()
-        msg_body = first_msg.body if hasattr(first_msg, "__data__") else None
-        context.user_data["conversation_id"] = conv
-
-        result = "".join(f"ID: {conv.id}\n"
-                         f"{translate('msg', lang)} {msg_body}\n"
-                         f"{translate('name', lang)} {conv.customer.tg_name}\n\n ")
-
-        try:
-            await update.callback_query.edit_message_text(
-                f"{translate('pagination', lang)} {context.user_data['c_c_page_list']} / "
-                f"{max_q}\n{result}", reply_markup=kb.c_c_pagination(lang, conv.id))
-        except telegram.error.BadRequest:
-            await query.answer(translate("last_page", lang))
-    else:
-        await query.answer("No conversations found.")
+        get_session(context).listed_conversation_id = conv.id
 
 
+@timed
 async def paginate_inspect(update: Update, context: ContextTypes.DEFAULT_TYPE, _user: User, lang: str, data=None):
     query = update.callback_query
 
     callback_data = query.data if query else data
 
-    context.user_data.setdefault("inspect_list_page", 1)
-
     conv_id = int(callback_data.split("_")[-1]) if data else \
         int(update.callback_query.message.reply_markup.inline_keyboard[0][0].callback_data.split("_")[-1])
 
-    conv = Conversation.get_or_none(id=conv_id)
+    conv = await run_db(Conversation.get_or_none, id=conv_id)
     if not conv:
         await update.message.reply_text(translate("conv_not_exist", lang) % conv_id)
         return
-    max_q = Message.select().join(ConversationThrough).where(
-        ConversationThrough.conversation == conv).count()
 
-    max_q = get_pages(max_q)
-    current_page = context.user_data["inspect_list_page"]
-    if (max_q == current_page and callback_data == "inspect_next_page"
-            or current_page == 1 and callback_data == "inspect_previous_page"):
+    direction = FIRST if data else get_direction(callback_data, "inspect_previous_page", "inspect_next_page")
+    state = get_session(context).pages.setdefault("inspect_list_page", {})
+    if state.get("conversation") != conv_id:
+        # Cursors belong to previously inspected conversation
+        direction = FIRST
+        state.clear()
+        state["conversation"] = conv_id
+    # Authors are joined, so the page is read with a single statement
+    messages_query = Message.select(Message, User).join(User).where(Message.conversation == conv_id)
+    messages = await run_db(message_pages.page, messages_query, state, direction)
+    if messages is None and direction != FIRST:
         await query.answer(translate("last_page", lang))
         return
-    if callback_data == "inspect_list" or data:
-        context.user_data["inspect_list_page"] = 1
-    elif callback_data == "inspect_previous_page":
-        context.user_data["inspect_list_page"] = max(1, context.user_data["inspect_list_page"] - 1)
-    elif callback_data == "inspect_next_page":
-        context.user_data["inspect_list_page"] = min(max_q, context.user_data["inspect_list_page"] + 1)
-
-    messages = Message.select().join(ConversationThrough).where(
-        ConversationThrough.conversation == conv_id).paginate(
-        context.user_data["inspect_list_page"], 5).order_by(
-        Message.created_at)
-
-    text = (f"{translate('pagination', lang)} {context.user_data["inspect_list_page"]}/{max_q}\n\n" +
+    max_q = await run_db(message_pages.pages, messages_query, conv_id)
+    if messages is None:
+        messages = []
+        state["page"] = 1
+
+    text = (f"{translate('pagination', lang)} {page_label(state, max_q)}\n\n" +
             "".join(
-                f"{msg.author.tg_name}:\n{msg.body}\n\n" for msg in messages))
+                f"{msg.author.tg_name}:\n{f'📎 {msg.attachment_type} ' if msg.attachment_type else ''}{msg.body}\n\n"
+                for msg in messages))
 
     kwargs = {
         "text": text,
-        "reply_markup": kb.inspect_messages(lang, conv_id)
+        "reply_markup": kb.inspect_messages(lang, conv_id, attachments=[
+            (msg.id, msg.attachment_type) for msg in messages if msg.attachment_type])
     }
 
     if data:
@@ -327,25 +260,21 @@ async def paginate_inspect(update: Update, context: ContextTypes.DEFAULT_TYPE, _
     else:
         await update.callback_query.message.edit_text(**kwargs)
 
-    pass
-
 
+@timed
 async def paginate_agent_list(update: Update, context: ContextTypes.DEFAULT_TYPE, _user: User, lang: str):
     query = update.callback_query
     callback_data = update.callback_query.data
 
-    max_q = get_pages(User.filter(User.is_agent).count())
-
-    context.user_data.setdefault("agent_list_page", 1)
+    direction = get_direction(callback_data, "agent_previous_page", "agent_next_page")
+    state = get_session(context).pages.setdefault("agent_list_page", {})
+    agents = User.select().where(User.is_agent == True)
+    pagination = await run_db(agent_pages.page, agents, state, direction)
+    if pagination is None:
+        await query.answer(translate("last_page", lang))
+        return
+    max_q = await run_db(agent_pages.pages, agents)
 
-    if callback_data == "agent_list":
-        context.user_data["agent_list_page"] = 1
-    elif callback_data == "agent_previous_page":
-        context.user_data["agent_list_page"] = max(1, context.user_data["agent_list_page"] - 1)
-    elif callback_data == "agent_next_page":
-        context.user_data["agent_list_page"] = min(max_q, context.user_data["agent_list_page"] + 1)
-    pagination = User.select().where(User.is_agent).paginate(
-        context.user_data["agent_list_page"], 5)
     result = f"".join(
         [f"Telegram: [{agent.tg_name}](tg://user?id={agent.id})\n"
          f"{translate("agent_name", lang)} {agent.name}\n"
@@ -354,10 +283,8 @@ async def paginate_agent_list(update: Update, context: ContextTypes.DEFAULT_TYPE
          pagination])
     try:
         await update.callback_query.message.edit_text(
-            f"{translate("pagination", lang)} {context.user_data["agent_list_page"]} / {max_q}\n{result}",
+            f"{translate("pagination", lang)} {page_label(state, max_q)}\n{result}",
             parse_mode='MarkdownV2',
             reply_markup=kb.agents_pagination(lang))
-    except telegram.error.BadRequest as ex:
-        if "Message is not modified" in str(ex):
-            pass
+    except telegram.error.BadRequest:
         await query.answer(translate("last_page", lang))
@@ -0,0 +1,154 @@
+"""
+Write-behind stage for chat messages.
+
+When enabled(WRITE_BEHIND=1) handle_reply only queues message rows in memory. They are
+written with a single ``insert_many`` together with the conversation summary update every
+WRITE_BEHIND_INTERVAL_MS milliseconds, or as soon as WRITE_BEHIND_MAX_ROWS rows are queued.
+Batches are written one at a time in queue order, so messages of a conversation keep their
+order. Pending rows are written as soon as a conversation is ended, and on shutdown.
+
+A batch which fails is retried with the next one. After MAX_ATTEMPTS failures in a row the
+queued rows are written one by one and rows which still fail(e.g. of a deleted
+conversation) are dropped and logged, so one bad row neither blocks the queue nor lets it
+grow without bound.
+"""
+import asyncio
+import contextvars
+import logging
+from datetime import datetime
+
+from peewee import fn
+
+from app.dal import run_db, commit
+from app.models import db, Conversation, Message, PREVIEW_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# Failed writes of queued rows before they are written one by one
+MAX_ATTEMPTS = 3
+
+
+def message_row(conv_id: int, author_id: int, text: str, attachment: tuple[str, str] = None) -> dict:
+    attachment_type, file_id = attachment or (None, None)
+    return {
+        "conversation": conv_id,
+        "author": author_id,
+        "body": text,
+        "created_at": datetime.now(),
+        "attachment_type": attachment_type,
+        "file_id": file_id,
+    }
+
+
+def preview(row: dict) -> str:
+    """Conversation preview of message, attachment type for attachments without caption."""
+    return row["body"] or row["attachment_type"] or ""
+
+
+def write_batch(rows: list[dict]) -> None:
+    """
+    Inserts message rows and updates summaries of their conversations in one transaction.
+    Blocking, call it through :func:`app.dal.run_db`.
+    """
+    summaries = {}
+    for row in rows:
+        summary = summaries.setdefault(row["conversation"], {"count": 0, "first": preview(row)})
+        summary["count"] += 1
+        summary["last"] = row["created_at"]
+
+    with db.atomic():
+        Message.insert_many(rows).execute()
+        for conv_id, summary in summaries.items():
+            Conversation.update(
+                message_count=Conversation.message_count + summary["count"],
+                last_message_at=summary["last"],
+                first_message_preview=fn.COALESCE(Conversation.first_message_preview,
+                                                  summary["first"][:PREVIEW_LENGTH]),
+            ).where(Conversation.id == conv_id).execute()
+
+
+class MessageWriter:
+    def __init__(self, interval_ms: int, max_rows: int):
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._rows: list[dict] = []
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        # Failed writes since the last successful one
+        self._failures = 0
+        self.dropped = 0
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the background flush and writes everything still queued."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def add(self, conv_id: int, author_id: int, text: str, attachment: tuple[str, str] = None) -> None:
+        """Queues message, it is written with the next batch."""
+        self._rows.append(message_row(conv_id, author_id, text, attachment))
+        if len(self._rows) >= self.max_rows:
+            self._full.set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows)
+
+    async def flush(self) -> None:
+        """
+        Writes queued rows, waits for a batch being written by the background task. Handlers
+        can await it: their transaction is committed first, so they do not keep the database
+        lane the background task may be waiting for, and rows are written in a transaction of
+        their own.
+        """
+        await commit()
+        # Fresh context, so run_db does not join the unit of work of a calling handler
+        await asyncio.get_running_loop().create_task(self._flush(), context=contextvars.Context())
+
+    async def _flush(self) -> None:
+        async with self._flush_lock:
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, []
+            self._full.clear()
+            try:
+                await run_db(write_batch, rows)
+            except Exception:
+                self._failures += 1
+                if self._failures < MAX_ATTEMPTS:
+                    # Put rows back in front of newer ones and retry with the next batch
+                    self._rows[:0] = rows
+                    raise
+                logger.exception("Failed to write %s queued messages %s times, writing them one by one",
+                                 len(rows), self._failures)
+                await self._write_each(rows)
+            self._failures = 0
+
+    async def _write_each(self, rows: list[dict]) -> None:
+        for row in rows:
+            try:
+                await run_db(write_batch, [row])
+            except Exception as e:
+                self.dropped += 1
+                logger.error("Dropped message of user %s to conversation %s: %s", row["author"],
+                             row["conversation"], e)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Failed to write %s queued messages: %s", self.pending, e)
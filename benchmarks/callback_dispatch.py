@@ -0,0 +1,81 @@
+"""
+Callback dispatch cost.
+
+Resolves the callback data of every bot button with :class:`app.router.CallbackRouter`
+built from the routes of SupportBot, and with a copy of the matching conditions of the
+former if/elif chain in ``SupportBot.query``(exact comparisons and substring scans).
+Only matching is measured, handlers are not called.
+
+Usage:
+    python -m benchmarks.callback_dispatch
+"""
+import timeit
+
+from app.main import SupportBot
+from app.models import db
+
+ROUNDS = 20_000
+CALLBACKS = [
+    "lang_en", "lang_uk", "start1", "ag_token", "cancel", "agent_add", "ag1", "a_c_previous", "a_c_next", "ag2",
+    "a_j_c_previous", "a_j_c_next", "ag3", "c_c_previous", "c_c_next", "cancel_agent", "cancel_admin", "token_gen",
+    "token_list", "tokens_previous", "tokens_next", "inspect_id_1234", "inspect_previous_page", "inspect_next_page",
+    "agent_list", "agent_previous_page", "agent_next_page", "bot_shutdown", "join_conversation_1234",
+]
+
+
+def check_callback_data(cd: str, to_inspect: tuple) -> bool:
+    return any(s in cd for s in to_inspect)
+
+
+def if_chain(cd: str) -> str | None:
+    if cd in ("lang_en", "lang_uk"):
+        return "language"
+    check_callback_data(cd, ("page", "previous", "next"))
+    if cd == "start1":
+        return "start1"
+    elif cd == "ag_token":
+        return "ag_token"
+    elif cd == "cancel":
+        return "cancel"
+    elif cd == "agent_add":
+        return "agent_add"
+    elif cd in ("ag1", "a_c_previous", "a_c_next"):
+        return "ag1"
+    elif cd in ("ag2", "a_j_c_previous", "a_j_c_next"):
+        return "ag2"
+    elif cd in ("ag3", "c_c_previous", "c_c_next"):
+        return "ag3"
+    elif cd == "cancel_agent":
+        return "cancel_agent"
+    elif cd == "cancel_admin":
+        return "cancel_admin"
+    elif cd == "token_gen":
+        return "token_gen"
+    elif cd in ("token_list", "tokens_previous", "tokens_next"):
+        return "token_list"
+    elif check_callback_data(cd, ("inspect_list", "inspect_previous_page", "inspect_next_page", "inspect_id_")):
+        return "inspect"
+    elif cd in ("agent_list", "agent_previous_page", "agent_next_page"):
+        return "agent_list"
+    elif cd == "bot_shutdown":
+        return "bot_shutdown"
+    elif check_callback_data(cd, ("join_conversation",)):
+        return "join_conversation"
+    return None
+
+
+def main():
+    router = SupportBot(db_handler=db, token="1:benchmark", logger=False).router
+    assert all(router.resolve(cd) for cd in CALLBACKS)
+    assert all(if_chain(cd) for cd in CALLBACKS)
+
+    calls = ROUNDS * len(CALLBACKS)
+    print(f"{'dispatch':>9} {'ns/callback':>12} {'worst ns':>9}")
+    for name, match in (("if/elif", if_chain), ("router", router.resolve)):
+        total = timeit.timeit(lambda: [match(cd) for cd in CALLBACKS], number=ROUNDS)
+        worst = max(timeit.timeit(lambda: match(cd), number=ROUNDS) / ROUNDS for cd in CALLBACKS)
+        print(f"{name:>9} {total / calls * 1e9:>12.0f} {worst * 1e9:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
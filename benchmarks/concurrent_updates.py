@@ -0,0 +1,83 @@
+"""
+Load test of concurrent update processing.
+
+CHATS users send UPDATES_PER_CHAT messages each, arriving on a fixed schedule. Every
+handler waits for a Telegram request, one in SLOW_EVERY of them for a slow one(e.g. a
+customer whose chat is rate limited). Updates are processed one by one(the default, the
+way Application does it without concurrent_updates) and with
+:class:`app.processor.KeyedUpdateProcessor`. Latency is measured from the scheduled
+arrival. The test fails if updates of a user were handled out of order or locks were left
+behind.
+
+Usage:
+    python -m benchmarks.concurrent_updates
+"""
+import asyncio
+import statistics
+import time
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+from app.processor import KeyedUpdateProcessor
+
+CHATS = 50
+UPDATES_PER_CHAT = 20
+ARRIVAL_INTERVAL = 0.002
+TELEGRAM_RTT = 0.02
+# Coprime with CHATS, so slow requests are spread over all users
+SLOW_EVERY = 23
+SLOW_RTT = 0.5
+
+
+def make_update(n: int, chat_id: int) -> Update:
+    chat = Chat(chat_id, Chat.PRIVATE)
+    user = User(chat_id, f"User{chat_id}", False)
+    return Update(n, message=Message(n, datetime.now(), chat, from_user=user, text=f"message {n}"))
+
+
+async def handler(update: Update, arrived: float, handled: dict[int, list]) -> float:
+    handled.setdefault(update.effective_user.id, []).append(update.update_id)
+    await asyncio.sleep(SLOW_RTT if update.update_id % SLOW_EVERY == 0 else TELEGRAM_RTT)
+    return time.perf_counter() - arrived
+
+
+async def run(limit: int) -> tuple[float, list[float], dict[int, list]]:
+    processor = KeyedUpdateProcessor(limit) if limit > 1 else None
+    handled: dict[int, list] = {}
+    latencies = []
+    tasks = []
+
+    async def process(update: Update, arrived: float):
+        latencies.append(await handler(update, arrived, handled))
+
+    started = time.perf_counter()
+    for n in range(CHATS * UPDATES_PER_CHAT):
+        update = make_update(n, n % CHATS + 1)
+        arrived = started + n * ARRIVAL_INTERVAL
+        await asyncio.sleep(max(0.0, arrived - time.perf_counter()))
+        if processor:
+            tasks.append(asyncio.create_task(processor.process_update(update, process(update, arrived))))
+        else:
+            await process(update, arrived)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    if processor:
+        assert processor.locks == 0, "%s locks left" % processor.locks
+    return elapsed, latencies, handled
+
+
+def p(latencies: list[float], q: int) -> float:
+    return statistics.quantiles(latencies, n=100)[q - 1] * 1000
+
+
+async def main():
+    print(f"{'limit':>6} {'updates/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    for limit in (1, 8, 32, 128):
+        elapsed, latencies, handled = await run(limit)
+        assert all(ids == sorted(ids) for ids in handled.values()), "updates of a user reordered"
+        print(f"{limit:>6} {len(latencies) / elapsed:>10.0f} {p(latencies, 50):>9.1f} {p(latencies, 99):>9.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
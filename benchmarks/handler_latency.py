@@ -0,0 +1,105 @@
+"""
+Handler latency with a slow database.
+
+Simulates a mixed load where every tenth update queries the database and the rest only
+talk to Telegram. Updates arrive on a fixed schedule and latency is measured from the
+scheduled arrival, so time spent waiting for a blocked event loop is counted. Database
+calls are emulated with ``time.sleep`` and issued either inline(the old behaviour) or
+through :func:`app.dal.run_db`. With inline calls every update waits for the slow query in
+front of it; with the lanes only the updates which actually need the database do.
+
+The database is set up by the benchmark: a MySQL backend with LANES lanes, as in a
+deployment. Queries are emulated, so no server is needed and the lanes never connect.
+SQLite runs on a single lane, which would measure the queue of one connection instead of
+the event loop. The check passes when p99 of updates without queries stays within
+MAX_GROWTH of the run without delay, and updates with queries wait less than MAX_QUEUE
+for a lane on top of the delay.
+
+Usage:
+    python -m benchmarks.handler_latency
+"""
+import asyncio
+import os
+import statistics
+import time
+
+UPDATES = 500
+ARRIVAL_INTERVAL = 0.002
+DB_EVERY = 10
+TELEGRAM_RTT = 0.005
+DELAYS = (0.0, 0.01, 0.025, 0.05)
+LANES = 4
+MAX_GROWTH = 2
+MAX_QUEUE = 0.025
+
+
+def slow_query(delay: float) -> None:
+    time.sleep(delay)
+
+
+async def handler(n: int, arrived: float, delay: float, offload: bool) -> float:
+    from app.dal import run_db
+
+    if n % DB_EVERY == 0:
+        if offload:
+            await run_db(slow_query, delay)
+        else:
+            slow_query(delay)
+    await asyncio.sleep(TELEGRAM_RTT)
+    return time.perf_counter() - arrived
+
+
+async def run(delay: float, offload: bool) -> list[float]:
+    tasks = []
+    started = time.perf_counter()
+    for n in range(UPDATES):
+        arrived = started + n * ARRIVAL_INTERVAL
+        await asyncio.sleep(max(0.0, arrived - time.perf_counter()))
+        tasks.append(asyncio.create_task(handler(n, arrived, delay, offload)))
+    return await asyncio.gather(*tasks)
+
+
+def p(latencies: list[float], q: int) -> float:
+    return statistics.quantiles(latencies, n=100)[q - 1] * 1000
+
+
+async def measure() -> dict[float, tuple[float, float]]:
+    """Prints latencies of both modes, returns p99 of updates without and with queries of the lanes by delay."""
+    print(f"{'db delay':>9} {'mode':>8} {'p50 ms':>9} {'p99 ms':>9} {'no-db p99 ms':>13} {'db p99 ms':>10}")
+    results = {}
+    for delay in DELAYS:
+        for offload in (False, True):
+            latencies = await run(delay, offload)
+            no_db = [lat for n, lat in enumerate(latencies) if n % DB_EVERY]
+            with_db = [lat for n, lat in enumerate(latencies) if not n % DB_EVERY]
+            print(f"{delay * 1000:>7.0f}ms {'lanes' if offload else 'inline':>8} "
+                  f"{p(latencies, 50):>9.1f} {p(latencies, 99):>9.1f} {p(no_db, 99):>13.1f} {p(with_db, 99):>10.1f}")
+            if offload:
+                results[delay] = (p(no_db, 99), p(with_db, 99))
+    return results
+
+
+def main():
+    os.environ["DATABASE_URL"] = "mysql://bench@127.0.0.1/bench"
+    os.environ["DB_WORKERS"] = str(LANES)
+    os.environ["DB_POOL"] = "0"
+    # Configuration is read on import
+    from app import dal
+
+    # Emulated queries do not need a connection
+    dal._connect = lambda: None
+    try:
+        results = asyncio.run(measure())
+    finally:
+        dal.shutdown()
+
+    baseline = results[DELAYS[0]][0]
+    growth = max(no_db for no_db, _ in results.values()) / baseline
+    queue = max(with_db - delay * 1000 - TELEGRAM_RTT * 1000 for delay, (_, with_db) in results.items())
+    steady = growth <= MAX_GROWTH and queue <= MAX_QUEUE * 1000
+    print(f"lanes: p99 without queries grows {growth:.1f}x up to {DELAYS[-1] * 1000:.0f} ms delay, updates with "
+          f"queries wait up to {queue:.1f} ms for a lane ({'steady' if steady else 'not steady'})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Keyboard building cost with and without the keyboard cache.
+
+Builds the keyboards of a list view session: agent and admin menus, token and agent list
+pagination, and conversation list and message pages of CONVERSATIONS conversations, either
+with the memoized functions of :mod:`app.keyboards` or with the undecorated ones, which
+create every button and translate every label again. Reports time per keyboard and memory
+held per keyboard while the replies using them are in flight(KEPT keyboards).
+
+Usage:
+    python -m benchmarks.keyboards
+"""
+import time
+import tracemalloc
+
+import app.keyboards as kb
+
+ROUNDS = 20
+CONVERSATIONS = 200
+KEPT = 10_000
+LANGUAGES = ("lang_en", "lang_uk")
+
+
+def calls(cached: bool) -> list:
+    """Keyboard functions with their arguments, in the order of a session."""
+
+    def build(function):
+        return function if cached else function.__wrapped__
+
+    menus = [(build(function), (lang,)) for lang in LANGUAGES
+             for function in (kb.agent, kb.admin, kb.tokens_pagination, kb.agents_pagination)]
+    conversations = [(build(function), (lang, conv_id)) for lang in LANGUAGES for conv_id in range(CONVERSATIONS)
+                     for function in (kb.a_c_pagination, kb.a_j_c_pagination)]
+    # inspect_messages is not memoized itself, its rows are
+    pages = [(kb.inspect_messages if cached else kb._inspect_messages.__wrapped__, (lang, conv_id))
+             for lang in LANGUAGES for conv_id in range(CONVERSATIONS)]
+    return menus * (CONVERSATIONS // 4) + conversations + pages
+
+
+def per_keyboard(cached: bool) -> tuple[float, float]:
+    kb.clear()
+    work = calls(cached)
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        for function, args in work:
+            function(*args)
+    seconds = (time.perf_counter() - started) / ROUNDS / len(work)
+
+    kept = (work * (KEPT // len(work) + 1))[:KEPT]
+    tracemalloc.start()
+    keyboards = [function(*args) for function, args in kept]
+    held, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(keyboards) == KEPT
+    return seconds, held / KEPT
+
+
+def main():
+    for uncached, cached in zip(calls(False), calls(True)):
+        assert uncached[0](*uncached[1]) == cached[0](*cached[1])
+    print(f"{'keyboards':>9} {'us/keyboard':>12} {'bytes held':>11}")
+    for name, cached in (("built", False), ("cached", True)):
+        seconds, held = per_keyboard(cached)
+        print(f"{name:>9} {seconds * 1e6:>12.2f} {held:>11.0f}")
+    print("cache:", kb.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Media relay cost by file size.
+
+Relays a customer document of each size in SIZES to an agent against a local fake Bot API
+server, either with :func:`app.media.relay`(``copy_message``, the file stays on Telegram
+servers) or by downloading the file and uploading it again. The fake Telegram serves file
+downloads and reads uploads in full, like the real one, and runs in its own thread and
+event loop. Reports the average time per relay and bytes moved through the bot, which
+stays the same for every size with ``copy_message``.
+
+Usage:
+    python -m benchmarks.media_relay
+"""
+import asyncio
+import socket
+import statistics
+import threading
+import time
+
+import tornado.web
+from telegram import Bot, Message
+
+from app.media import relay
+
+SIZES = (64 * 1024, 1024 * 1024, 16 * 1024 * 1024)
+RELAYS = 10
+TOKEN = "1:benchmark"
+CUSTOMER, AGENT = 10, 20
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeTelegram(tornado.web.RequestHandler):
+    """Answers Bot API methods used by the benchmark."""
+
+    def initialize(self, traffic: dict):
+        self.traffic = traffic
+
+    def post(self, method: str):
+        self.traffic["bytes"] += len(self.request.body)
+        if method == "getFile":
+            file_id = self.get_body_argument("file_id")
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": "documents/" + file_id}
+        elif method in ("copyMessage", "sendDocument"):
+            result = {"message_id": 1, "date": int(time.time()), "chat": {"id": AGENT, "type": "private"}}
+        else:
+            result = {"id": 1, "is_bot": True, "first_name": "HelPy", "username": "helpy_bot"}
+        self.write({"ok": True, "result": result})
+
+
+class FakeFiles(tornado.web.RequestHandler):
+    """Serves file downloads, the size is the file_id."""
+
+    def initialize(self, traffic: dict):
+        self.traffic = traffic
+
+    def get(self, size: str):
+        self.traffic["bytes"] += int(size)
+        self.write(bytes(int(size)))
+
+
+async def telegram(port: int, traffic: dict, started: threading.Event, stop: threading.Event) -> None:
+    api = tornado.web.Application([
+        (r"/bot[^/]+/(\w+)", FakeTelegram, {"traffic": traffic}),
+        (r"/file/bot[^/]+/documents/(\d+)", FakeFiles, {"traffic": traffic}),
+    ], max_body_size=max(SIZES) * 2)
+    server = api.listen(port, "127.0.0.1", max_buffer_size=max(SIZES) * 2)
+    started.set()
+    await asyncio.to_thread(stop.wait)
+    server.stop()
+
+
+def document(bot: Bot, size: int) -> Message:
+    return Message.de_json({
+        "message_id": size, "date": int(time.time()), "chat": {"id": CUSTOMER, "type": "private"},
+        "from": {"id": CUSTOMER, "is_bot": False, "first_name": "User10"},
+        "document": {"file_id": str(size), "file_unique_id": str(size), "file_name": "report.pdf", "file_size": size},
+    }, bot)
+
+
+async def copy(_bot: Bot, message: Message) -> None:
+    await relay(message, AGENT, "User10\n#id10")
+
+
+async def reupload(bot: Bot, message: Message) -> None:
+    file = await bot.get_file(message.document.file_id)
+    data = await file.download_as_bytearray()
+    await bot.send_document(AGENT, bytes(data), filename=message.document.file_name, caption="User10\n#id10")
+
+
+async def main():
+    port = free_port()
+    traffic = {"bytes": 0}
+    started, stop = threading.Event(), threading.Event()
+    fake = threading.Thread(target=asyncio.run, args=(telegram(port, traffic, started, stop),))
+    fake.start()
+    started.wait()
+    bot = Bot(TOKEN, base_url=f"http://127.0.0.1:{port}/bot", base_file_url=f"http://127.0.0.1:{port}/file/bot")
+    try:
+        async with bot:
+            print(f"{'size':>8} {'mode':>9} {'ms/relay':>9} {'MB moved':>9}")
+            for size in SIZES:
+                message = document(bot, size)
+                for name, method in (("copy", copy), ("reupload", reupload)):
+                    traffic["bytes"] = 0
+                    durations = []
+                    for _ in range(RELAYS):
+                        relay_started = time.perf_counter()
+                        await method(bot, message)
+                        durations.append(time.perf_counter() - relay_started)
+                    print(f"{size // 1024:>6}KB {name:>9} {statistics.mean(durations) * 1000:>9.1f} "
+                          f"{traffic['bytes'] / RELAYS / 1024 / 1024:>9.2f}")
+    finally:
+        stop.set()
+        fake.join()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+"""
+Cost of recording metrics.
+
+Handles UPDATES updates one after another through :func:`app.dal.unit_of_work` on a
+temporary SQLite database, each reading QUERIES users, calling a :func:`app.metrics.timed`
+paginator and making API_CALLS Bot API requests through the rate limiter(answered
+instantly), once with metrics recorded and once with recording turned into no-ops. The
+time spent recording one update is also measured directly, since the difference between
+the two runs is close to the noise. Recording fails the check when it costs more than
+MAX_OVERHEAD of the update latency; real updates also wait for Telegram, so the share in
+production is lower.
+
+Usage:
+    python -m benchmarks.metrics
+"""
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import timeit
+
+UPDATES = 2000
+QUERIES = 3
+API_CALLS = 2
+MAX_OVERHEAD = 0.01
+
+
+def no_op(*_args, **_kwargs):
+    pass
+
+
+async def run(users: list[int]) -> list[float]:
+    from app.dal import run_db, unit_of_work
+    from app.metrics import timed
+    from app.models import User
+    from app.ratelimit import OutboundRateLimiter
+
+    limiter = OutboundRateLimiter()
+
+    async def api_call():
+        return True
+
+    @timed
+    async def paginate(n: int):
+        for i in range(QUERIES):
+            await run_db(User.get_by_id, users[(n + i) % len(users)])
+
+    @unit_of_work
+    async def handler(n: int):
+        await paginate(n)
+        for _ in range(API_CALLS):
+            await limiter.process_request(api_call, (), {}, "sendMessage", {}, None)
+
+    latencies = []
+    for n in range(UPDATES):
+        started = time.perf_counter()
+        await handler(n)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def recording() -> float:
+    """Seconds spent recording one update of the benchmark."""
+    from app import metrics
+
+    def record():
+        started = metrics.begin("handler")
+        for _ in range(QUERIES):
+            time.perf_counter()
+            time.perf_counter()
+        metrics.call_seconds.observe("paginate", 0.001)
+        for _ in range(API_CALLS):
+            time.perf_counter()
+            metrics.api_seconds.observe("sendMessage", 0.01)
+            time.perf_counter()
+        metrics.end(started, QUERIES, 0.001)
+
+    rounds = 100_000
+    return timeit.timeit(record, number=rounds) / rounds
+
+
+def main():
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    # Configuration is read on import
+    from app import metrics
+    from app.models import db, create_tables, User
+
+    try:
+        create_tables()
+        with db:
+            users = [User.create(id=n, tg_name=f"User{n}", language="lang_en").id for n in range(1, 101)]
+        recorded = statistics.median(asyncio.run(run(users)))
+        cost = recording()
+        metrics.Histogram.observe = metrics.Counter.inc = no_op
+        metrics.begin = metrics.end = no_op
+        bare = statistics.median(asyncio.run(run(users)))
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    print(f"{'metrics':>9} {'p50 us':>9}")
+    print(f"{'off':>9} {bare * 1e6:>9.1f}")
+    print(f"{'on':>9} {recorded * 1e6:>9.1f}")
+    share = cost / recorded
+    print(f"recording: {cost * 1e6:.2f} us per update, {share:.2%} of its latency "
+          f"({'ok' if share <= MAX_OVERHEAD else 'over'} the {MAX_OVERHEAD:.0%} budget)")
+
+
+if __name__ == "__main__":
+    main()
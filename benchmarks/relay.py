@@ -0,0 +1,110 @@
+"""
+Message relay latency with and without the conversation routing index.
+
+CONVERSATIONS customers have an open conversation joined by an agent, and MESSAGES
+messages are relayed between them, half from customers and half from agents. Each relay
+resolves the chat on the other end and the header shown to agents, the way handle_reply
+does, either by reading the conversation from the database(the old behaviour) or from
+:data:`app.routing.routing_index`. Messages are stored directly(a transaction per message)
+or only looked up, as with WRITE_BEHIND=1 where storing is just queueing the row. Reports
+relay latency and SQL statements per relay on a temporary SQLite database.
+
+Usage:
+    python -m benchmarks.relay
+"""
+import os
+import statistics
+import tempfile
+import time
+
+CONVERSATIONS = 200
+MESSAGES = 4000
+
+
+def relay_from_database(conv_id: int, user, text: str, store: bool) -> tuple[int, str]:
+    from app.models import Conversation
+    from app.utils import add_message
+
+    conv = Conversation.get_or_none(id=conv_id)
+    if store:
+        add_message(conv.id, user, text)
+        conv = Conversation.get_or_none(id=conv_id)
+    if user.id == conv.customer_id:
+        return conv.agent_chat, f"{conv.customer_name}\n#id{conv.customer_id}\n\n{text}"
+    return conv.customer_chat, text
+
+
+def relay_from_index(conv_id: int, user, text: str, store: bool) -> tuple[int, str]:
+    from app.routing import routing_index
+    from app.utils import add_message
+
+    route = routing_index.get(conv_id)
+    if store:
+        add_message(route.conversation_id, user, text)
+    if user.id == route.customer_id:
+        return route.agent_chat, f"{route.customer_name}\n#id{route.customer_id}\n\n{text}"
+    return route.customer_chat, text
+
+
+def measure(relay, conversations: list, store: bool, statements: list[int]) -> tuple[list[float], float]:
+    latencies = []
+    statements[0] = 0
+    for n in range(MESSAGES):
+        conv_id, customer, agent = conversations[n // 2 % len(conversations)]
+        user = agent if n % 2 else customer
+        started = time.perf_counter()
+        chat_id, _text = relay(conv_id, user, f"message {n}", store)
+        latencies.append(time.perf_counter() - started)
+        assert chat_id == (customer.id if n % 2 else agent.id)
+    return latencies, statements[0] / MESSAGES
+
+
+def main():
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    # Configuration is read on import
+    from app.models import db, create_tables, User, Conversation
+    from app.routing import routing_index
+
+    statements = [0]
+    execute_sql = db.execute_sql
+
+    def counted(*args, **kwargs):
+        statements[0] += 1
+        return execute_sql(*args, **kwargs)
+
+    try:
+        create_tables()
+        db.connect()
+        conversations = []
+        with db.atomic():
+            for n in range(1, CONVERSATIONS + 1):
+                customer = User.create(id=n, tg_name=f"User{n}", language="en")
+                agent = User.create(id=100000 + n, tg_name=f"Agent{n}", language="en", is_agent=True)
+                conv = Conversation.create(customer=customer, customer_chat=customer.id, customer_name=customer.tg_name)
+                conv.join_conv(agent, agent.id)
+                conversations.append((conv.id, customer, agent))
+        routing_index.clear()
+        started = time.perf_counter()
+        warmed = routing_index.warm()
+        print(f"index warmed with {warmed} conversations in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+        db.execute_sql = counted
+        print(f"{'store':>6} {'lookup':>9} {'p50 us':>9} {'p99 us':>9} {'statements':>11}")
+        for store in (False, True):
+            for name, relay in (("database", relay_from_database), ("index", relay_from_index)):
+                latencies, per_relay = measure(relay, conversations, store, statements)
+                quantiles = statistics.quantiles(latencies, n=100)
+                print(f"{'yes' if store else 'no':>6} {name:>9} {quantiles[49] * 1e6:>9.1f} "
+                      f"{quantiles[98] * 1e6:>9.1f} {per_relay:>11.1f}")
+    finally:
+        db.execute_sql = execute_sql
+        db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Memory held in user_data per user.
+
+Builds SESSIONS simulated users twice: with user_data holding live model instances the way
+handlers used to keep them(``user_context``, ``conversation_context`` and
+``customer_conversation_context``) and with a single :class:`app.session.Session` record.
+Both variants carry the same language and pagination cursors. Memory is measured with
+tracemalloc, no database is needed.
+
+Usage:
+    python -m benchmarks.session_memory
+"""
+import gc
+import tracemalloc
+from datetime import datetime
+
+from app.models import User, Conversation
+from app.session import Session, SESSION_KEY
+
+SESSIONS = 100_000
+
+
+def cursors(n: int) -> dict:
+    return {"a_c_page_list": {"page": 1, "first": [n], "last": [n]}}
+
+
+def model_user_data(n: int) -> dict:
+    user = User(id=n, tg_name=f"User{n}", tg_username=f"user{n}", language="lang_en")
+    conversation = Conversation(id=n, customer=user, customer_chat=n, customer_name=user.tg_name,
+                                created_at=datetime.now())
+    return {
+        "lang": "lang_en",
+        "user_context": user,
+        "customer_conversation_context": conversation,
+        "conversation_created": True,
+        **cursors(n),
+    }
+
+
+def session_user_data(n: int) -> dict:
+    return {SESSION_KEY: Session(user_id=n, lang="lang_en", customer_conversation_id=n,
+                                 conversation_created=True, pages=cursors(n))}
+
+
+def measure(factory) -> int:
+    gc.collect()
+    tracemalloc.start()
+    user_data = {n: factory(n) for n in range(1, SESSIONS + 1)}
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del user_data
+    return size
+
+
+def main():
+    print(f"{'user_data':>15} {'total MB':>9} {'per user B':>11}")
+    for name, factory in (("model instances", model_user_data), ("session", session_user_data)):
+        size = measure(factory)
+        print(f"{name:>15} {size / 2 ** 20:>9.1f} {size / SESSIONS:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Text lookup cost.
+
+Looks up the texts of a conversation list render(page label, preview labels, pagination
+buttons) and a welcome message with an inserted name, with :func:`app.translation.translate`
+and with a copy of the former function, which checked the keyword and the language on every
+call before the nested dictionary lookups(its dictionary is read from the locale files). Each
+call set is run for English, Ukrainian and an unknown language code, which falls back to
+English.
+
+A third column uses precompiled templates: texts with a single %s are split once and the
+inserted value is concatenated, the way :meth:`app.translation.Catalog` could store them.
+The last row times the welcome message alone, the only call of the set inserting a value.
+
+Usage:
+    python -m benchmarks.translation
+"""
+import timeit
+
+from app.translation import translate, read_texts, catalog, placeholders
+
+ROUNDS = 100_000
+LANGUAGES = ("lang_en", "lang_uk", "en")
+CALLS = [
+    ("pagination", None), ("msg", None), ("name", None), ("previous_page_b", None), ("next_page_b", None),
+    ("inspect_conv_b", None), ("return_b", None), ("welcome", "Mykola"),
+]
+dictionary = {lang: read_texts(lang) for lang in ("lang_en", "lang_uk")}
+starting_message = dictionary["lang_en"]["starting_msg"]
+
+
+def former_translate(keyword, lang, insert=None):
+    try:
+        if keyword == "starting_msg":
+            return starting_message
+        if lang not in ("lang_uk", "lang_ru", "lang_en"):
+            if insert:
+                return dictionary["lang_en"][keyword] % insert
+            return dictionary["lang_en"][keyword]
+        if insert:
+            return dictionary[lang][keyword] % insert
+        return dictionary[lang][keyword]
+    except KeyError:
+        print("Dictionary error occurred:", lang, keyword)
+        return keyword
+
+
+def precompile(table: dict[str, str]) -> dict[str, str | tuple[str, str]]:
+    """Splits texts with a single %s around it, other texts are kept."""
+    return {keyword: tuple(text.split("%s")) if placeholders(text) == ["%s"] and "%%" not in text else text
+            for keyword, text in table.items()}
+
+
+precompiled = {lang: precompile(catalog.load(lang)) for lang in ("lang_en", "lang_uk")}
+
+
+def precompiled_translate(keyword, lang, insert=None):
+    table = precompiled.get(lang) or precompiled["lang_en"]
+    try:
+        text = table[keyword]
+    except KeyError:
+        return keyword
+    if insert:
+        if type(text) is tuple:
+            return text[0] + str(insert) + text[1]
+        return text % insert
+    return text if type(text) is str else "%s".join(text)
+
+
+def measure(function, lang: str, calls: list) -> float:
+    """Nanoseconds per call."""
+    total = timeit.timeit(lambda: [function(keyword, lang, insert) for keyword, insert in calls], number=ROUNDS)
+    return total / ROUNDS / len(calls) * 1e9
+
+
+def main():
+    functions = (former_translate, translate, precompiled_translate)
+    for lang in LANGUAGES:
+        expected = [former_translate(keyword, lang, insert) for keyword, insert in CALLS]
+        for function in functions[1:]:
+            assert [function(keyword, lang, insert) for keyword, insert in CALLS] == expected
+
+    print(f"{'calls':>9} {'former ns':>10} {'catalog ns':>11} {'precompiled ns':>15}")
+    rows = [(lang, lang, CALLS) for lang in LANGUAGES] + [("welcome", "lang_en", CALLS[-1:])]
+    for name, lang, calls in rows:
+        results = [measure(function, lang, calls) for function in functions]
+        print(f"{name:>9} {results[0]:>10.0f} {results[1]:>11.0f} {results[2]:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Webhook mode against a local fake Telegram.
+
+Starts a fake Bot API server and the bot in webhook mode on localhost, both configured
+through the same environment variables as a deployment(TELEGRAM_API_URL, WEBHOOK_*).
+The fake Telegram then posts UPDATES synthetic /start messages from different users over
+WEBHOOK_MAX_CONNECTIONS parallel connections, the way Telegram delivers them, and counts
+the replies the bot sends back. The fake Telegram runs in its own thread and event loop,
+so it does not compete with the bot for the event loop. Reports how fast updates are
+accepted(HTTP 200) and handled(reply received), and webhook response latency. Uses a
+temporary SQLite database.
+
+Usage:
+    python -m benchmarks.webhook
+    CONCURRENT_UPDATES=32 python -m benchmarks.webhook
+"""
+import asyncio
+import json
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+import httpx
+import tornado.web
+
+UPDATES = 2000
+TOKEN = "1:benchmark"
+SECRET = "benchmark-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeTelegram(tornado.web.RequestHandler):
+    """Answers Bot API methods used by the benchmark, counts sent messages."""
+
+    def initialize(self, replies: dict):
+        self.replies = replies
+
+    def post(self, method: str):
+        try:
+            params = json.loads(self.request.body or b"{}")
+        except ValueError:
+            params = {key: self.get_body_argument(key) for key in self.request.body_arguments}
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "HelPy", "username": "helpy_bot"}
+        elif method == "sendMessage":
+            self.replies["count"] += 1
+            if self.replies["count"] == UPDATES:
+                self.replies["done"].set()
+            chat = {"id": int(params["chat_id"]), "type": "private"}
+            result = {"message_id": self.replies["count"], "date": int(time.time()), "chat": chat,
+                      "text": params.get("text", "")}
+        else:
+            result = True
+        self.write({"ok": True, "result": result})
+
+
+def update(n: int) -> dict:
+    user = {"id": 1000 + n, "is_bot": False, "first_name": f"User{n}"}
+    return {"update_id": n, "message": {
+        "message_id": n, "date": int(time.time()), "chat": {"id": user["id"], "type": "private"}, "from": user,
+        "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    }}
+
+
+async def post_updates(url: str, connections: int) -> list[float]:
+    latencies = []
+    numbers = iter(range(1, UPDATES + 1))
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    limits = httpx.Limits(max_connections=connections)
+    async with httpx.AsyncClient(limits=limits) as client:
+        wrong = await client.post(url, json=update(0), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        assert wrong.status_code == 403, wrong.status_code
+
+        async def connection():
+            for n in numbers:
+                started = time.perf_counter()
+                response = await client.post(url, json=update(n), headers=headers)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(connection() for _ in range(connections)))
+    return latencies
+
+
+async def telegram(api_port: int, url: str, connections: int, bot_started: threading.Event) -> tuple:
+    """Serves the Bot API, posts updates once the bot is started and waits for all replies."""
+    replies = {"count": 0, "done": asyncio.Event()}
+    api = tornado.web.Application([(r"/bot[^/]+/(\w+)", FakeTelegram, {"replies": replies})])
+    server = api.listen(api_port, "127.0.0.1")
+    try:
+        await asyncio.to_thread(bot_started.wait)
+        started = time.perf_counter()
+        latencies = await post_updates(url, connections)
+        accepted = time.perf_counter() - started
+        await asyncio.wait_for(replies["done"].wait(), 60)
+        handled = time.perf_counter() - started
+        return latencies, accepted, handled
+    finally:
+        server.stop()
+
+
+async def main():
+    api_port, webhook_port = free_port(), free_port()
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    os.environ.update({
+        "DATABASE_URL": "sqlite:///" + path,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}/bot",
+        "WEBHOOK_URL": f"http://127.0.0.1:{webhook_port}/telegram",
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(webhook_port),
+        "WEBHOOK_SECRET": SECRET,
+        # Measure the bot, not the outbound limits of Telegram
+        "OUTBOUND_GLOBAL_RATE": "100000",
+    })
+    # Configuration is read on import
+    from app import dal
+    from app.config import WEBHOOK_MAX_CONNECTIONS, WEBHOOK_URL, CONCURRENT_UPDATES
+    from app.main import SupportBot
+    from app.models import create_tables
+
+    bot_started = threading.Event()
+    fake = asyncio.create_task(asyncio.to_thread(
+        asyncio.run, telegram(api_port, WEBHOOK_URL, WEBHOOK_MAX_CONNECTIONS, bot_started)))
+    await asyncio.sleep(0.5)
+    create_tables()
+    bot = SupportBot(db_handler=None, token=TOKEN, logger=False)
+    try:
+        await bot.app.initialize()
+        await bot.app.updater.start_webhook(**bot.webhook_options())
+        await bot.app.start()
+        bot_started.set()
+        latencies, accepted, handled = await fake
+
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(f"updates: {UPDATES}, connections: {WEBHOOK_MAX_CONNECTIONS}, concurrent updates: {CONCURRENT_UPDATES}")
+        print(f"accepted: {UPDATES / accepted:.0f} updates/s, handled: {UPDATES / handled:.0f} updates/s")
+        print(f"webhook response p50: {quantiles[49] * 1000:.1f} ms, p99: {quantiles[98] * 1000:.1f} ms")
+    finally:
+        await bot.app.updater.stop()
+        await bot.app.stop()
+        await bot.app.shutdown()
+        dal.shutdown()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,221 @@
+"""
+Throughput of sharded worker processes by worker count.
+
+Runs the bot(run.py) in webhook mode with each number of WORKERS in WORKER_COUNTS against a
+local fake Bot API server, configured through the same environment variables as a
+deployment. Once every worker has answered a first update, the fake Telegram posts UPDATES
+updates over WEBHOOK_MAX_CONNECTIONS parallel connections and waits until the bot has
+answered all of them. Two workloads are measured: customers sending /start(a reply, no
+queries) and agents opening the list of active conversations(queries, model instances and
+keyboards), which is where a single process runs out of CPU first. Reports handled updates
+per second. Uses a temporary SQLite database with CONVERSATIONS open conversations; worker
+counts above the number of cores only add overhead.
+
+Usage:
+    python -m benchmarks.workers
+    CONCURRENT_UPDATES=8 python -m benchmarks.workers
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import tornado.web
+
+WORKER_COUNTS = (1, 2, 4)
+UPDATES = 2000
+CONVERSATIONS = 500
+AGENTS = 100
+CUSTOMERS = 1000
+TOKEN = "1:benchmark"
+SECRET = "benchmark-secret"
+RUN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "run.py")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Replies:
+    """Counts requests of one Bot API method made by the bot."""
+
+    def __init__(self):
+        self.method = None
+        self.count = 0
+        self.expected = 0
+        self.done = asyncio.Event()
+
+    def expect(self, method: str, expected: int) -> None:
+        self.method = method
+        self.count = 0
+        self.expected = expected
+        self.done = asyncio.Event()
+
+    def add(self, method: str) -> None:
+        if method == self.method:
+            self.count += 1
+            if self.count == self.expected:
+                self.done.set()
+
+
+class FakeTelegram(tornado.web.RequestHandler):
+    """Answers Bot API methods used by the benchmark."""
+
+    def initialize(self, replies: Replies):
+        self.replies = replies
+
+    def post(self, method: str):
+        try:
+            params = json.loads(self.request.body or b"{}")
+        except ValueError:
+            params = {key: self.get_body_argument(key) for key in self.request.body_arguments}
+        self.replies.add(method)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "HelPy", "username": "helpy_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            chat = {"id": int(params["chat_id"]), "type": "private"}
+            result = {"message_id": 1, "date": int(time.time()), "chat": chat, "text": params.get("text", "")}
+        else:
+            result = True
+        self.write({"ok": True, "result": result})
+
+
+def start(n: int, user_id: int) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {"update_id": n, "message": {
+        "message_id": n, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": user,
+        "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    }}
+
+
+def active_list(n: int, user_id: int) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"Agent{user_id}"}
+    message = {"message_id": n, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": "Menu"}
+    return {"update_id": n, "callback_query": {
+        "id": str(n), "from": user, "chat_instance": str(user_id), "data": "ag1", "message": message,
+    }}
+
+
+# Workload -> (update factory, user IDs, method answering each update)
+WORKLOADS = {
+    "start": (start, range(1, CUSTOMERS + 1), "sendMessage"),
+    "lists": (active_list, range(100001, 100001 + AGENTS), "answerCallbackQuery"),
+}
+
+
+def seed(path: str) -> None:
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    # Configuration is read on import
+    from app.models import db, create_tables, User, Conversation
+
+    create_tables()
+    with db:
+        with db.atomic():
+            for n in range(1, CONVERSATIONS + 1):
+                customer = User.create(id=n, tg_name=f"User{n}", language="lang_en")
+                Conversation.create(customer=customer, customer_chat=customer.id, customer_name=customer.tg_name,
+                                    first_message_preview=f"Question {n}", message_count=1)
+            for user_id in WORKLOADS["lists"][1]:
+                User.create(id=user_id, tg_name=f"Agent{user_id}", language="lang_en", is_agent=True)
+
+
+async def post(client: httpx.AsyncClient, url: str, updates: list[dict], connections: int) -> None:
+    pending = iter(updates)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+    async def connection():
+        for update in pending:
+            response = await client.post(url, json=update, headers=headers)
+            response.raise_for_status()
+
+    await asyncio.gather(*(connection() for _ in range(connections)))
+
+
+async def warm_up(client: httpx.AsyncClient, url: str, replies: Replies, workers: int) -> None:
+    """Waits until the bot accepts updates and every worker has answered one."""
+    replies.expect("sendMessage", workers)
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            # User IDs modulo the worker count reach every worker
+            await post(client, url, [start(n, 900000 + n) for n in range(workers)], workers)
+            break
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+    await asyncio.wait_for(replies.done.wait(), 60)
+
+
+async def measure(client: httpx.AsyncClient, url: str, replies: Replies, workload: str, connections: int) -> float:
+    factory, users, method = WORKLOADS[workload]
+    updates = [factory(n, users[n % len(users)]) for n in range(1, UPDATES + 1)]
+    replies.expect(method, UPDATES)
+    started = time.perf_counter()
+    await post(client, url, updates, connections)
+    await asyncio.wait_for(replies.done.wait(), 300)
+    return UPDATES / (time.perf_counter() - started)
+
+
+async def main():
+    api_port = free_port()
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    seed(path)
+    replies = Replies()
+    api = tornado.web.Application([(r"/bot[^/]+/(\w+)", FakeTelegram, {"replies": replies})])
+    server = api.listen(api_port, "127.0.0.1")
+    connections = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+    concurrent_updates = os.getenv("CONCURRENT_UPDATES", "32")
+    print(f"updates: {UPDATES}, connections: {connections}, concurrent updates per worker: {concurrent_updates}, "
+          f"cores: {os.cpu_count()}")
+    print(f"{'workers':>8} {'workload':>9} {'updates/s':>10}")
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            async with httpx.AsyncClient(limits=httpx.Limits(max_connections=connections)) as client:
+                for workers in WORKER_COUNTS:
+                    webhook_port = free_port()
+                    url = f"http://127.0.0.1:{webhook_port}/telegram"
+                    env = dict(os.environ, **{
+                        "TOKEN": TOKEN,
+                        "DATABASE_URL": "sqlite:///" + path,
+                        "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}/bot",
+                        "WEBHOOK_URL": url,
+                        "WEBHOOK_LISTEN": "127.0.0.1",
+                        "WEBHOOK_PORT": str(webhook_port),
+                        "WEBHOOK_SECRET": SECRET,
+                        "WORKERS": str(workers),
+                        "CONCURRENT_UPDATES": concurrent_updates,
+                        # Measure the bot, not the outbound limits of Telegram
+                        "OUTBOUND_GLOBAL_RATE": "100000",
+                        "OUTBOUND_CHAT_RATE": "100000",
+                        "OUTBOUND_CHAT_BURST": "100000",
+                    })
+                    # Logs of the bot are written to the temporary directory
+                    bot = await asyncio.create_subprocess_exec(sys.executable, RUN, env=env, cwd=workdir,
+                                                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    try:
+                        await warm_up(client, url, replies, workers)
+                        for workload in WORKLOADS:
+                            rate = await measure(client, url, replies, workload, connections)
+                            print(f"{workers:>8} {workload:>9} {rate:>10.0f}")
+                    finally:
+                        bot.send_signal(signal.SIGTERM)
+                        await bot.wait()
+    finally:
+        server.stop()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,95 @@
+"""
+Message write throughput, per message vs write-behind batches.
+
+Stores the same stream of messages spread over a few conversations twice: once the way
+handle_reply does it without write-behind (a transaction per message with the message
+insert, conversation summary update and ``user.save``) and once in batches written by
+:func:`app.write_behind.write_batch`. Runs against a temporary SQLite file, so commits
+are flushed to disk like on a real server, only faster.
+
+Usage:
+    python -m benchmarks.write_behind
+"""
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from peewee import SqliteDatabase, fn
+
+from app import write_behind
+from app.migrations import MODELS
+from app.models import User, Conversation
+
+MESSAGES = 2000
+CONVERSATIONS = 20
+
+
+def setup(database: SqliteDatabase) -> tuple[list[User], list[int]]:
+    database.create_tables(MODELS)
+    users = [User.create(id=n, tg_name=f"User{n}", language="en") for n in range(1, CONVERSATIONS + 1)]
+    convs = [Conversation.create(customer=user, customer_chat=user.id, customer_name=user.tg_name).id
+             for user in users]
+    return users, convs
+
+
+def rows(users: list[User], convs: list[int]):
+    for n in range(MESSAGES):
+        i = n % CONVERSATIONS
+        yield users[i], {"conversation": convs[i], "author": users[i].id, "body": f"message {n}",
+                         "created_at": datetime.now()}
+
+
+def per_message(database: SqliteDatabase, users: list[User], convs: list[int]) -> None:
+    for user, row in rows(users, convs):
+        with database.atomic():
+            write_behind.write_batch([row])
+            user.last_conversation = row["conversation"]
+            user.save()
+
+
+def batched(batch_size: int):
+    def run(database: SqliteDatabase, users: list[User], convs: list[int]) -> None:
+        batch = []
+        for _user, row in rows(users, convs):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                write_behind.write_batch(batch)
+                batch = []
+        if batch:
+            write_behind.write_batch(batch)
+
+    return run
+
+
+def measure(mode) -> float:
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    database = SqliteDatabase(path)
+    try:
+        with database.bind_ctx(MODELS):
+            # write_batch opens its transaction on the module level database
+            write_behind.db = database
+            users, convs = setup(database)
+            started = time.perf_counter()
+            mode(database, users, convs)
+            elapsed = time.perf_counter() - started
+            stored = Conversation.select(fn.SUM(Conversation.message_count)).scalar()
+            assert stored == MESSAGES, stored
+        return MESSAGES / elapsed
+    finally:
+        database.close()
+        os.remove(path)
+
+
+def main():
+    print(f"{'mode':>14} {'rows/s':>10}")
+    baseline = measure(per_message)
+    print(f"{'per message':>14} {baseline:>10.0f}")
+    for batch_size in (10, 100, 500):
+        rate = measure(batched(batch_size))
+        print(f"{'batch ' + str(batch_size):>14} {rate:>10.0f} ({rate / baseline:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Test fixtures.
+
+Tests run against a temporary SQLite database and a fake Bot API which records requests
+instead of sending them. Configuration is read on import, so the environment is prepared
+here before any app module is imported. QUERY_AUDIT=strict makes handlers issuing N+1
+queries or more statements than their budget fail the test driving them.
+
+pytest-asyncio is not needed: tests run their scenario with ``asyncio.run``.
+"""
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import tempfile
+
+import pytest
+
+_fd, DATABASE = tempfile.mkstemp(suffix=".db")
+os.close(_fd)
+os.environ["DATABASE_URL"] = "sqlite:///" + DATABASE
+os.environ["TOKEN"] = "1:abc"
+os.environ.setdefault("QUERY_AUDIT", "strict")
+os.environ.setdefault("WRITE_BEHIND", "")
+os.environ.setdefault("WORKERS", "1")
+# Requests pass the rate limiter without waiting
+os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "100000")
+os.environ.setdefault("OUTBOUND_CHAT_RATE", "100000")
+os.environ.setdefault("OUTBOUND_CHAT_BURST", "100000")
+
+from telegram import Update  # noqa: E402
+from telegram.ext import ExtBot  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+from app import dal, keyboards as kb  # noqa: E402
+from app.cache import user_cache  # noqa: E402
+from app.models import db, create_tables  # noqa: E402
+from app.routing import routing_index  # noqa: E402
+
+BOT = {"id": 999, "is_bot": True, "first_name": "HelPy", "username": "helpy_bot"}
+TRUE_RESULT = ("answerCallbackQuery", "setWebhook", "deleteWebhook", "deleteMessage")
+
+
+class FakeTelegram(BaseRequest):
+    """Bot API answering requests like Telegram would, records them instead of sending."""
+
+    def __init__(self, delay: float = 0):
+        """:param delay: Seconds every request takes"""
+        self.delay = delay
+        self.requests: list[tuple[str, dict]] = []
+        self._message_ids = itertools.count(10_000)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, *_args, **_kwargs) -> tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        data = request_data.parameters if request_data else {}
+        self.requests.append((endpoint, dict(data)))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if endpoint == "getMe":
+            result = BOT
+        elif endpoint in TRUE_RESULT:
+            result = True
+        else:
+            chat_id = data.get("chat_id", 1)
+            result = {"message_id": next(self._message_ids), "date": 0, "chat": {"id": chat_id, "type": "private"},
+                      "text": data.get("text") or data.get("caption") or ""}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class FakeBot(ExtBot):
+    """Bot talking to :class:`FakeTelegram`, requests pass the rate limiter like in production."""
+
+    def __init__(self, *args, delay: float = 0, **kwargs):
+        """:param delay: Seconds every request takes"""
+        telegram = FakeTelegram(delay)
+        super().__init__(*args, request=telegram, get_updates_request=FakeTelegram(), **kwargs)
+        # Bot objects are frozen, only protected attributes can be set
+        self._telegram = telegram
+
+    @property
+    def telegram(self) -> FakeTelegram:
+        return self._telegram
+
+    @property
+    def requests(self) -> list[tuple[str, dict]]:
+        """(endpoint, data) of every request."""
+        return self._telegram.requests
+
+    def texts(self, chat_id: int = None) -> list[str]:
+        """Texts sent or edited in chat, in all chats by default."""
+        return [data.get("text") or data.get("caption") for endpoint, data in self.requests
+                if endpoint in ("sendMessage", "editMessageText", "copyMessage", "sendPhoto", "sendDocument")
+                and (chat_id is None or data.get("chat_id") == chat_id)]
+
+
+class Telegram:
+    """Builds updates the way Telegram sends them to the bot."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "User%s" % user_id, "username": "user%s" % user_id}
+
+    def message(self, user_id: int, text: str = None, **fields) -> dict:
+        message = {"message_id": next(self._message_ids), "date": 0, "chat": {"id": user_id, "type": "private"},
+                   "from": self.user(user_id), **fields}
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback(self, user_id: int, data: str, markup_data: str = None) -> dict:
+        """:param markup_data: Callback data of the first button of the message with the pressed button"""
+        message = {"message_id": next(self._message_ids), "date": 0, "chat": {"id": user_id, "type": "private"},
+                   "text": "menu"}
+        if markup_data:
+            message["reply_markup"] = {"inline_keyboard": [[{"text": "button", "callback_data": markup_data}]]}
+        return {"update_id": next(self._update_ids),
+                "callback_query": {"id": str(next(self._message_ids)), "from": self.user(user_id),
+                                   "chat_instance": "chat", "data": data, "message": message}}
+
+
+class Harness:
+    """SupportBot wired to a :class:`FakeBot`, use it as an async context manager."""
+
+    def __init__(self, delay: float = 0):
+        from app.main import SupportBot
+
+        self.support = SupportBot(db_handler=db, token="1:abc", logger=False)
+        # Log files are not written by tests
+        self.support.logger = None
+        app = self.support.app
+        self.bot = FakeBot("1:abc", delay=delay, rate_limiter=app.bot.rate_limiter)
+        app.bot = self.bot
+        app.updater = None
+        app.add_error_handler(self._error)
+        self.errors: list[Exception] = []
+        self.telegram = Telegram()
+
+    async def __aenter__(self):
+        await self.support.app.initialize()
+        await self.support.post_init(self.support.app)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.support.post_shutdown(self.support.app)
+        await self.support.app.shutdown()
+
+    async def feed(self, *updates: dict) -> None:
+        """Handles updates one by one, raises the first exception of a handler."""
+        for update in updates:
+            await self.support.app.process_update(Update.de_json(update, self.bot))
+            if self.errors:
+                raise self.errors.pop(0)
+
+    async def customer(self, user_id: int, question: str) -> None:
+        """Registers customer and opens a conversation with question."""
+        telegram = self.telegram
+        await self.feed(telegram.message(user_id, "/start"), telegram.callback(user_id, "lang_en"),
+                        telegram.callback(user_id, "start1"), telegram.message(user_id, question))
+
+    async def agent(self, user_id: int) -> None:
+        """Registers user as agent and admin."""
+        telegram = self.telegram
+        await self.feed(telegram.message(user_id, "/start"), telegram.callback(user_id, "lang_en"),
+                        telegram.message(user_id, "/agent"), telegram.callback(user_id, "ag_token"),
+                        telegram.message(user_id, "ADMIN_QWERTY"))
+
+    async def join(self, agent_id: int, conv_id: int) -> None:
+        await self.feed(self.telegram.callback(agent_id, "join_conversation_%s" % conv_id))
+
+    async def _error(self, _update, context) -> None:
+        self.errors.append(context.error)
+
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch):
+    """Empty database with the latest schema, caches of its rows are dropped."""
+    # post_init installs signal handlers of the bot process
+    monkeypatch.setattr("app.lifecycle.GracefulShutdown.install_signal_handlers", lambda self: None)
+    with db.connection_context():
+        db.pragma("foreign_keys", 0)
+        for table in db.get_tables():
+            db.execute_sql('DROP TABLE "%s"' % table)
+    create_tables()
+    user_cache.clear()
+    routing_index.clear()
+    kb.clear()
+    from app import utils
+
+    for paginator in (utils.token_pages, utils.conversation_pages, utils.message_pages, utils.agent_pages):
+        paginator.invalidate()
+    yield db
+
+
+class Statements(list):
+    """SQL statements executed inside :meth:`recording`, on database lanes or directly."""
+
+    def __init__(self, monkeypatch):
+        super().__init__()
+        self._monkeypatch = monkeypatch
+
+    @contextlib.contextmanager
+    def recording(self):
+        execute_sql = dal._execute_sql
+
+        def record(sql, params=None, *args, **kwargs):
+            self.append(sql)
+            return execute_sql(sql, params, *args, **kwargs)
+
+        with self._monkeypatch.context() as patch:
+            patch.setattr(dal, "_execute_sql", record)
+            yield self
+
+
+@pytest.fixture
+def statements(monkeypatch):
+    """Records SQL of the code run inside ``with statements.recording():``."""
+    return Statements(monkeypatch)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    from app.dal import shutdown
+
+    shutdown()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(DATABASE + suffix):
+            os.remove(DATABASE + suffix)
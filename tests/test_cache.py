@@ -0,0 +1,83 @@
+import asyncio
+
+import peewee
+import pytest
+
+from app.cache import UserCache, user_cache
+from app.dal import run_db, unit_of_work
+from app.models import User
+from app.session import load_user
+
+
+def create_user(user_id: int = 1) -> User:
+    return User.create(id=user_id, tg_name="User%s" % user_id, language="lang_en")
+
+
+def test_identity_map_returns_same_instance_within_update():
+    create_user()
+    first = load_user(1, update_id=10)
+    assert load_user(1, update_id=10) is first
+    assert load_user(1, update_id=11) is not first
+    assert user_cache.stats()["identity_hits"] == 1
+
+
+def test_changes_of_returned_user_do_not_reach_cache():
+    create_user()
+    user = load_user(1, update_id=10)
+    user.is_admin = True
+    assert load_user(1).is_admin is False
+    assert load_user(1, update_id=11).is_admin is False
+
+
+def test_failed_save_keeps_cached_roles(monkeypatch):
+    create_user()
+    user = load_user(1, update_id=10)
+
+    def fail(*_args, **_kwargs):
+        raise peewee.OperationalError("database is locked")
+
+    monkeypatch.setattr(peewee.Model, "save", fail)
+    user.is_agent = True
+    user.is_admin = True
+    with pytest.raises(peewee.OperationalError):
+        user.save()
+    cached = load_user(1, update_id=11)
+    assert (cached.is_agent, cached.is_admin) == (False, False)
+
+
+def test_saved_roles_are_visible_to_other_updates():
+    create_user()
+    user = load_user(1, update_id=10)
+    user.is_agent = True
+    user.save()
+    assert load_user(1, update_id=10).is_agent is True
+    assert load_user(1, update_id=11).is_agent is True
+    # Written through on create and save, never read from the database
+    assert user_cache.stats()["misses"] == 0
+
+
+def test_rolled_back_save_is_dropped_from_cache():
+    create_user()
+
+    @unit_of_work
+    async def handler():
+        user = await run_db(load_user, 1)
+        user.is_admin = True
+        await run_db(user.save)
+        raise RuntimeError("handler failed")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(handler())
+    assert load_user(1).is_admin is False
+
+
+def test_expired_and_evicted_users_are_read_again():
+    cache = UserCache(maxsize=2, ttl=60)
+    users = [User(id=user_id, tg_name="User", language="lang_en") for user_id in (1, 2, 3)]
+    for user in users:
+        cache.set(user)
+    assert cache.get(1) is None
+    assert cache.get(3).id == 3
+    expired = UserCache(ttl=-1)
+    expired.set(users[0])
+    assert expired.get(1) is None
@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import pytest
+
+from app.dal import run_db, unit_of_work, commit, current_unit, LANES
+from app.models import User
+from app.ratelimit import OutboundRateLimiter
+
+
+def create_user(user_id: int) -> User:
+    return User.create(id=user_id, tg_name="User%s" % user_id, language="lang_en")
+
+
+def test_queries_run_off_the_event_loop():
+    async def scenario():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        await run_db(time.sleep, 0.2)
+        ticker.cancel()
+        return ticks
+
+    assert asyncio.run(scenario()) >= 10
+
+
+def test_unit_of_work_rolls_back_when_handler_raises():
+    @unit_of_work
+    async def handler():
+        await run_db(create_user, 1)
+        raise RuntimeError("handler failed")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(handler())
+    assert asyncio.run(run_db(User.get_or_none, id=1)) is None
+
+
+def test_commit_releases_lane_before_bot_api_request():
+    limiter = OutboundRateLimiter(global_rate=10_000)
+    updates = 50
+    delay = 0.02
+
+    async def send_message():
+        await asyncio.sleep(delay)
+
+    @unit_of_work
+    async def handler(user_id: int):
+        await run_db(create_user, user_id)
+        await commit()
+        await limiter.process_request(send_message, (), {}, "sendMessage", {"chat_id": user_id}, None)
+        await run_db(User.get_by_id, user_id)
+        return current_unit().commits
+
+    async def scenario():
+        started = time.perf_counter()
+        commits = await asyncio.gather(*(handler(user_id) for user_id in range(1, updates + 1)))
+        return time.perf_counter() - started, commits
+
+    elapsed, commits = asyncio.run(scenario())
+    # Holding the lane during the request would serialise the updates: updates * delay / LANES
+    assert elapsed < updates * delay / LANES / 2
+    # Committed before the request, the last query runs in a transaction of its own
+    assert commits == [1] * updates
+
+
+def test_handler_raising_after_bot_api_request_leaves_no_rows():
+    limiter = OutboundRateLimiter()
+
+    async def send_message():
+        return True
+
+    @unit_of_work
+    async def handler():
+        await run_db(create_user, 1)
+        await limiter.process_request(send_message, (), {}, "sendMessage", {"chat_id": 1}, None)
+        await run_db(create_user, 2)
+        raise RuntimeError("handler failed")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(handler())
+    assert asyncio.run(run_db(User.get_or_none, id=1)) is None
+    assert asyncio.run(run_db(User.get_or_none, id=2)) is None
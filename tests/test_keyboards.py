@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from app import keyboards as kb
+from app.translation import catalog, translate
+
+
+def test_keyboards_are_built_once_per_language():
+    assert kb.agent("lang_en") is kb.agent("lang_en")
+    assert kb.agent("lang_uk") is not kb.agent("lang_en")
+    assert kb.agent("lang_uk").inline_keyboard[0][0].text == translate("ag_b1", "lang_uk")
+    assert kb.a_c_pagination("lang_en", 1) is kb.a_c_pagination("lang_en", 1)
+    assert kb.a_c_pagination("lang_en", 2) is not kb.a_c_pagination("lang_en", 1)
+    # Two menus and two conversation keyboards were built
+    assert (kb.stats()["size"], kb.stats()["misses"]) == (4, 4)
+
+
+def test_shared_keyboards_can_not_be_changed():
+    markup = kb.admin("lang_en")
+    with pytest.raises(AttributeError):
+        markup.inline_keyboard = ()
+    with pytest.raises(AttributeError):
+        markup.inline_keyboard[0][0].text = "changed"
+    # Attachment buttons are added to a new keyboard
+    plain = kb.inspect_messages("lang_en", 1)
+    with_attachment = kb.inspect_messages("lang_en", 1, attachments=[(5, "photo")])
+    assert len(with_attachment.inline_keyboard) == len(plain.inline_keyboard) + 1
+    assert kb.inspect_messages("lang_en", 1) is plain
+
+
+def test_conversation_keyboards_are_bounded_and_dropped_on_reload():
+    assert kb.a_c_pagination.cache_info().maxsize == kb.CONVERSATIONS
+    menu = kb.agent("lang_en")
+    catalog.reload()
+    assert kb.stats()["size"] == 0
+    assert kb.agent("lang_en") is not menu
+
+
+def test_keyboards_built_while_language_is_read_are_rebuilt(monkeypatch):
+    catalog.load("lang_en")
+    # Switched to a language which was not preloaded
+    monkeypatch.setattr(catalog, "tables", {lang: table for lang, table in catalog.tables.items() if lang != "lang_uk"})
+    kb.clear()
+
+    async def scenario():
+        pending = kb.agent("lang_uk")
+        while "lang_uk" in catalog._pending:
+            await asyncio.sleep(0.01)
+        return pending, kb.agent("lang_uk")
+
+    pending, menu = asyncio.run(scenario())
+    assert pending.inline_keyboard[0][0].text == translate("ag_b1", "lang_en")
+    assert menu.inline_keyboard[0][0].text == catalog.tables["lang_uk"]["ag_b1"]
+    assert menu.inline_keyboard[0][0].text != translate("ag_b1", "lang_en")
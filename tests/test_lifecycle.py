@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+from conftest import Harness
+
+from app.lifecycle import GracefulShutdown, notify_customers
+from app.translation import translate
+
+
+async def open_conversations(bot: Harness) -> None:
+    """Customers 1 and 3 have open conversations, 3 speaks Ukrainian, 5 closed theirs."""
+    telegram = bot.telegram
+    await bot.customer(1, "question")
+    await bot.feed(telegram.message(3, "/start"), telegram.callback(3, "lang_uk"), telegram.callback(3, "start1"),
+                   telegram.message(3, "питання"))
+    await bot.customer(5, "solved")
+    await bot.agent(100)
+    await bot.join(100, 3)
+    await bot.feed(telegram.message(100, "/end"))
+
+
+def test_customers_of_open_conversations_are_notified():
+    async def scenario():
+        async with Harness() as bot:
+            await open_conversations(bot)
+            everyone = await notify_customers(bot.support.app)
+            owned = await notify_customers(bot.support.app, owns=lambda customer_id: customer_id == 3)
+            return everyone, owned, bot.bot.texts(1), bot.bot.texts(3), bot.bot.texts(5)
+
+    everyone, owned, first, second, closed = asyncio.run(scenario())
+    assert (everyone, owned) == (2, 1)
+    assert first.count(translate("support_offline", "lang_en")) == 1
+    assert second.count(translate("support_offline", "lang_uk")) == 2
+    assert translate("support_offline", "lang_en") not in closed
+
+
+def test_shutdown_stops_at_deadline():
+    async def scenario():
+        async with Harness() as bot:
+            await open_conversations(bot)
+            app = bot.support.app
+            stopped = []
+            app.stop_running = lambda: stopped.append(time.monotonic())
+            # Telegram answers too slowly for the deadline
+            bot.bot.telegram.delay = 1
+            shutdown = GracefulShutdown(app, timeout=0.2)
+            started = time.monotonic()
+            shutdown.request()
+            await shutdown._task
+            # A second request stops without waiting
+            shutdown.request()
+            bot.bot.telegram.delay = 0
+            return [at - started for at in stopped]
+
+    stopped = asyncio.run(scenario())
+    assert len(stopped) == 2 and stopped[0] < 0.5
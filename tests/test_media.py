@@ -0,0 +1,44 @@
+import asyncio
+
+from conftest import Harness
+
+from app.media import CAPTION_LENGTH
+from app.models import Message
+
+PHOTO = [{"file_id": "small", "file_unique_id": "s", "width": 90, "height": 90},
+         {"file_id": "large", "file_unique_id": "l", "width": 1280, "height": 1280}]
+HEADER = "User1\n#id1"
+
+
+def relay(caption: str, **fields) -> list[tuple[str, dict]]:
+    """Requests sent to the agent when the customer sends a photo with caption."""
+
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "help me please")
+            await bot.agent(2)
+            await bot.join(2, 1)
+            sent = len(bot.bot.requests)
+            await bot.feed(bot.telegram.message(1, photo=PHOTO, caption=caption, **fields))
+            return [(endpoint, data) for endpoint, data in bot.bot.requests[sent:] if data.get("chat_id") == 2]
+
+    return asyncio.run(scenario())
+
+
+def test_caption_gets_header_and_shifted_entities():
+    requests = relay("see bold", caption_entities=[{"type": "bold", "offset": 4, "length": 4}])
+    assert [endpoint for endpoint, _ in requests] == ["copyMessage"]
+    data = requests[0][1]
+    assert data["caption"] == HEADER + "\n\nsee bold"
+    assert data["caption_entities"][0]["offset"] == len(HEADER) + 2 + 4
+    stored = Message.get(Message.attachment_type == "photo")
+    assert (stored.file_id, stored.body) == ("large", "see bold")
+
+
+def test_caption_limit_counts_utf16_code_units():
+    # Fits in CAPTION_LENGTH characters, emoji take two UTF-16 code units each
+    caption = "😀" * (CAPTION_LENGTH - len(HEADER) - 2)
+    requests = relay(caption)
+    assert [endpoint for endpoint, _ in requests] == ["sendMessage", "copyMessage"]
+    assert requests[0][1]["text"] == HEADER
+    assert "caption" not in requests[1][1]
@@ -0,0 +1,59 @@
+import asyncio
+
+from conftest import Harness
+
+from app.maintenance import backfill_message_conversation
+from app.models import db, User, Conversation, Message, ConversationThrough
+from app.utils import add_message
+
+
+def create_conversation(customer_id: int) -> Conversation:
+    customer = User.create(id=customer_id, tg_name="Customer%s" % customer_id, language="lang_en")
+    return Conversation.create(customer=customer, customer_name=customer.tg_name, customer_chat=customer_id)
+
+
+def test_messages_are_linked_by_foreign_key_with_index(statements):
+    conversation = create_conversation(1)
+    with statements.recording():
+        add_message(conversation.id, conversation.customer, "question")
+    # One INSERT of the message, the summary is updated in the same transaction
+    assert [sql.split()[0] for sql in statements] == ["BEGIN", "INSERT", "UPDATE"]
+    assert list(conversation.messages) == [Message.get()]
+    indexes = {tuple(index.columns) for index in db.get_indexes("message")}
+    assert ("conversation_id", "created_at") in indexes
+
+
+def test_backfill_links_messages_of_former_through_table():
+    if not ConversationThrough.table_exists():
+        ConversationThrough.create_table()
+    conversations = [create_conversation(1), create_conversation(2)]
+    for n in range(5):
+        conversation = conversations[n % 2]
+        message = Message.create(author=conversation.customer, body="message %s" % n)
+        ConversationThrough.create(conversation=conversation, message=message)
+    # Linked by the bot after the migration
+    add_message(conversations[0].id, conversations[0].customer, "new")
+
+    assert backfill_message_conversation(batch_size=2) == 5
+    assert [message.conversation_id for message in Message.select().order_by(Message.id)] == [1, 2, 1, 2, 1, 1]
+    # Restarted after it finished
+    assert backfill_message_conversation(batch_size=2) == 0
+
+
+def test_transcript_page_is_read_with_authors(statements):
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "question")
+            for agent_id in (100, 101, 102):
+                await bot.agent(agent_id)
+                await bot.join(agent_id, 1)
+                await bot.feed(bot.telegram.message(agent_id, "answer of %s" % agent_id))
+            with statements.recording():
+                await bot.feed(bot.telegram.message(100, "/inspect 1"))
+            return bot.bot.texts(100)[-1]
+
+    transcript = asyncio.run(scenario())
+    assert all("User%s:\n" % author_id in transcript for author_id in (1, 100, 101, 102))
+    # Authors are not loaded one by one
+    assert [sql for sql in statements if sql.startswith('SELECT "t1"."id", "t1"."tg_name"')] == []
+    assert len([sql for sql in statements if 'FROM "message"' in sql]) == 2
@@ -0,0 +1,74 @@
+import asyncio
+import re
+import socket
+
+import httpx
+import pytest
+from conftest import Harness
+
+from app import metrics
+from app.dal import unit_of_work
+
+
+def sample(text: str, name: str, **labels) -> float:
+    """Value of the series of name with labels in Prometheus text, 0 if there is none."""
+    pairs = ",".join('%s="%s"' % pair for pair in labels.items())
+    found = re.search(r"^%s\{%s\} (\S+)$" % (re.escape(name), re.escape(pairs)), text, re.MULTILINE)
+    return float(found.group(1)) if found else 0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_handlers_queries_and_requests_are_served():
+    port = free_port()
+
+    async def scenario():
+        async with Harness() as bot:
+            server = metrics.serve("127.0.0.1", port, metrics.render)
+            try:
+                async with httpx.AsyncClient(base_url="http://127.0.0.1:%s" % port) as client:
+                    before = (await client.get("/metrics")).text
+                    await bot.customer(1, "question")
+                    await bot.feed(bot.telegram.message(1, "more"))
+                    response = await client.get("/metrics")
+            finally:
+                server.stop()
+            return before, response
+
+    before, response = asyncio.run(scenario())
+    after = response.text
+    assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+    for name in ("helpy_update_seconds_count", "helpy_update_queries_count"):
+        assert sample(after, name, handler="handle_reply") - sample(before, name, handler="handle_reply") == 2
+    # Callback queries are labelled with the handler of their route
+    assert sample(after, "helpy_update_seconds_count", handler="start_conversation") > \
+           sample(before, "helpy_update_seconds_count", handler="start_conversation")
+    assert sample(after, "helpy_update_queries_sum", handler="handle_reply") > \
+           sample(before, "helpy_update_queries_sum", handler="handle_reply")
+    assert sample(after, "helpy_api_seconds_count", method="sendMessage") > \
+           sample(before, "helpy_api_seconds_count", method="sendMessage")
+    assert re.search(r"^helpy_user_cache_hits \d+$", after, re.MULTILINE)
+
+
+def test_errors_are_counted_by_handler():
+    @unit_of_work
+    async def failing_handler():
+        raise ValueError("broken")
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            asyncio.run(failing_handler())
+    text = metrics.render()
+    assert sample(text, "helpy_update_errors_total", handler="failing_handler", error="ValueError") == 2
+
+
+def test_worker_snapshots_are_labelled():
+    snapshot = metrics.snapshot()
+    snapshot["stats"]["custom"] = {"depth": 3, "name": "ignored"}
+    text = metrics.render({"0": snapshot, "1": snapshot})
+    assert sample(text, "helpy_custom_depth", worker="0") == sample(text, "helpy_custom_depth", worker="1") == 3
+    assert "helpy_custom_name" not in text
@@ -0,0 +1,67 @@
+import itertools
+
+from app.migrations import check_pagination_queries
+from app.models import Token
+from app.pagination import KeysetPaginator, FIRST, NEXT, PREVIOUS, page_label
+
+_tokens = itertools.count()
+
+
+def create_tokens(count: int) -> list[int]:
+    return [Token.create(token="token%s" % next(_tokens)).id for _ in range(count)]
+
+
+def unused():
+    return Token.select().where(Token.is_activated == False)
+
+
+def test_pages_follow_cursors():
+    ids = create_tokens(12)
+    paginator = KeysetPaginator((Token.id,), per_page=5)
+    state = {}
+    assert [token.id for token in paginator.page(unused(), state)] == ids[:5]
+    assert [token.id for token in paginator.page(unused(), state, NEXT)] == ids[5:10]
+    assert [token.id for token in paginator.page(unused(), state, NEXT)] == ids[10:]
+    assert paginator.page(unused(), state, NEXT) is None
+    assert state["page"] == 3
+    assert [token.id for token in paginator.page(unused(), state, PREVIOUS)] == ids[5:10]
+    assert page_label(state, paginator.pages(unused())) == "2 / 3"
+    assert [token.id for token in paginator.page(unused(), state, FIRST)] == ids[:5]
+
+
+def test_pages_do_not_shift_when_rows_are_inserted_before_cursor():
+    free, *ids = create_tokens(7)
+    Token.delete_by_id(free)
+    paginator = KeysetPaginator((Token.id,), per_page=3)
+    state = {}
+    assert [token.id for token in paginator.page(unused(), state)] == ids[:3]
+    # Sorts ahead of the first page, an offset would show its last row again
+    Token.create(id=free, token="token%s" % next(_tokens))
+    assert [token.id for token in paginator.page(unused(), state, NEXT)] == ids[3:]
+
+
+def test_counts_are_cached_until_they_expire():
+    create_tokens(6)
+    paginator = KeysetPaginator((Token.id,), per_page=5, count_ttl=60)
+    assert paginator.pages(unused()) == 2
+    create_tokens(5)
+    assert paginator.pages(unused()) == 2
+    expired = KeysetPaginator((Token.id,), per_page=5, count_ttl=-1)
+    assert expired.pages(unused()) == 3
+    create_tokens(5)
+    assert expired.pages(unused()) == 4
+
+
+def test_cached_counts_are_bounded():
+    create_tokens(1)
+    paginator = KeysetPaginator((Token.id,), max_counts=3)
+    for agent_id in range(10):
+        paginator.pages(unused(), agent_id)
+    # Hit moves the count of agent 7 to the end, agent 8 is the least recently used one
+    paginator.pages(unused(), 7)
+    paginator.pages(unused(), 10)
+    assert list(paginator._counts) == [(9,), (7,), (10,)]
+
+
+def test_pagination_queries_use_indexes():
+    assert check_pagination_queries() == {}
@@ -0,0 +1,52 @@
+import asyncio
+
+from conftest import Harness
+
+from app import persistence
+from app.persistence import DatabasePersistence, USER
+from app.session import SESSION_KEY, Session
+
+
+def test_sessions_survive_restart():
+    async def first_run():
+        async with Harness() as bot:
+            await bot.customer(1, "question")
+            await bot.agent(2)
+            await bot.join(2, 1)
+
+    async def second_run():
+        async with Harness() as bot:
+            # Nothing is read before the first update of a user
+            assert not bot.support.app.user_data
+            await bot.feed(bot.telegram.message(1, "still there?"), bot.telegram.message(2, "yes"))
+            return bot.bot.texts(1)[-1], bot.bot.texts(2)[-1]
+
+    asyncio.run(first_run())
+    assert asyncio.run(second_run()) == ("yes", "User1\n#id1\n\nstill there?")
+
+
+def test_changes_are_coalesced_into_one_write(monkeypatch):
+    writes = []
+    store_data = persistence.store_data
+
+    def record(rows):
+        writes.append(sorted(rows))
+        store_data(rows)
+
+    monkeypatch.setattr(persistence, "store_data", record)
+
+    async def scenario():
+        store = DatabasePersistence()
+        for user_id in (1, 2, 3):
+            await store.update_user_data(user_id, {SESSION_KEY: Session(user_id=user_id)})
+        await store.update_user_data(1, {SESSION_KEY: Session(user_id=1, lang="lang_uk")})
+        # Empty data of users without a row is not written
+        await store.update_user_data(4, {})
+        await store.flush()
+        loaded = {}
+        await DatabasePersistence().refresh_user_data(1, loaded)
+        return loaded
+
+    loaded = asyncio.run(scenario())
+    assert writes == [[(USER, 1), (USER, 2), (USER, 3)]]
+    assert loaded[SESSION_KEY].lang == "lang_uk"
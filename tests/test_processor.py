@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+from conftest import Telegram
+from telegram import Update
+
+from app.processor import KeyedUpdateProcessor
+
+
+def test_updates_of_user_keep_order_and_users_run_in_parallel():
+    telegram = Telegram()
+    handled = []
+    running = 0
+    most_running = 0
+
+    async def handle(user_id: int, n: int, delay: float):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(delay)
+        handled.append((user_id, n))
+        running -= 1
+
+    async def scenario():
+        processor = KeyedUpdateProcessor(4)
+        tasks = []
+        started = time.perf_counter()
+        for user_id in range(1, 9):
+            for n in range(3):
+                update = Update.de_json(telegram.message(user_id, "message %s" % n), None)
+                # Earlier updates take longer, they still finish first
+                tasks.append(processor.process_update(update, handle(user_id, n, 0.03 - n * 0.01)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started, processor.locks
+
+    elapsed, locks = asyncio.run(scenario())
+    for user_id in range(1, 9):
+        assert [n for handled_user, n in handled if handled_user == user_id] == [0, 1, 2]
+    assert most_running == 4
+    # 8 users with 60 ms of updates each, 4 at a time
+    assert elapsed < 8 * 0.06 / 2
+    # Locks of idle users are dropped
+    assert locks == 0
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+from conftest import Harness
+
+from app import query_audit
+from app.config import QUERY_BUDGET
+from app.dal import run_db, unit_of_work
+from app.models import User, Conversation, Message
+from app.query_audit import QueryAudit, QueryBudgetExceeded
+
+
+def test_handlers_stay_within_their_budgets():
+    """Runs the handlers with own budgets in strict mode, a statement over the budget fails the update."""
+
+    async def scenario():
+        async with Harness() as bot:
+            telegram = bot.telegram
+            for customer_id in range(1, 8):
+                await bot.customer(customer_id, "question %s" % customer_id)
+            await bot.agent(100)
+            for data in ("ag1", "a_c_next", "ag2", "ag3"):
+                await bot.feed(telegram.callback(100, data, markup_data=data))
+            await bot.join(100, 1)
+            for n in range(8):
+                await bot.feed(telegram.message(1, "question %s" % n), telegram.message(100, "answer %s" % n))
+            await bot.feed(telegram.message(100, "/inspect 1"),
+                           telegram.callback(100, "inspect_next_page", markup_data="inspect_id_1"),
+                           telegram.message(100, "/end"), telegram.callback(5, "lang_uk"),
+                           telegram.message(100, "/agent"))
+
+    before = query_audit.stats()
+    asyncio.run(scenario())
+    after = query_audit.stats()
+    assert after["updates"] > before["updates"]
+    assert (after["over_budget"], after["n_plus_one"]) == (before["over_budget"], before["n_plus_one"])
+    for handler in ("handle_reply", "inspect_messages", "join_conversation", "set_language", "end_conv"):
+        assert QueryAudit(handler).budget < QUERY_BUDGET
+
+
+def test_lazy_foreign_key_per_row_fails_in_strict_mode():
+    customer = User.create(id=1, tg_name="Customer", language="lang_en")
+    conversation = Conversation.create(customer=customer, customer_name="Customer", customer_chat=1)
+    for n in range(query_audit.N_PLUS_ONE):
+        author = User.create(id=10 + n, tg_name="Author%s" % n, language="lang_en")
+        Message.create(conversation=conversation, author=author, body="message %s" % n)
+
+    @unit_of_work
+    async def transcript():
+        messages = await run_db(list, Message.select().where(Message.conversation == conversation.id))
+        return await run_db(lambda: [message.author.tg_name for message in messages])
+
+    with pytest.raises(QueryBudgetExceeded, match="N\\+1 query in transcript"):
+        asyncio.run(transcript())
+
+
+def test_statements_over_budget_fail_in_strict_mode():
+    @query_audit.budget(2)
+    async def handler():
+        for model in (User, Conversation, Message):
+            await run_db(model.select().count)
+
+    with pytest.raises(QueryBudgetExceeded, match="handler issued more than 2 statements"):
+        asyncio.run(unit_of_work(handler)())
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from app.ratelimit import OutboundRateLimiter, HIGH, LOW
+
+
+def send(limiter: OutboundRateLimiter, sent: list, chat_id: int, text: str, priority: int = None, failures=()):
+    """Request of text to chat through limiter, failing with the given errors first."""
+    failures = list(failures)
+
+    async def callback():
+        if failures:
+            raise failures.pop(0)
+        sent.append(text)
+        return text
+
+    return limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": chat_id}, priority)
+
+
+def test_chat_bucket_spaces_requests_in_order():
+    limiter = OutboundRateLimiter(chat_rate=20, chat_burst=2)
+    sent = []
+
+    async def scenario():
+        started = time.monotonic()
+        await asyncio.gather(*(send(limiter, sent, 1, "message %s" % n) for n in range(5)))
+        return time.monotonic() - started
+
+    # Two requests of the burst, the other three wait for a token each
+    assert asyncio.run(scenario()) >= 3 / 20 * 0.9
+    assert sent == ["message %s" % n for n in range(5)]
+    assert limiter.stats()["sent"] == 5
+
+
+def test_customer_replies_go_before_list_views():
+    limiter = OutboundRateLimiter(global_rate=20)
+    sent = []
+
+    async def scenario():
+        # Empties the global bucket
+        await asyncio.gather(*(send(limiter, sent, chat_id, "burst") for chat_id in range(100, 120)))
+        await asyncio.gather(send(limiter, sent, 1, "list view", LOW), send(limiter, sent, 2, "list view", LOW),
+                             send(limiter, sent, 3, "reply", HIGH))
+
+    asyncio.run(scenario())
+    assert sent[20:] == ["reply", "list view", "list view"]
+
+
+def test_retry_after_pauses_and_retries():
+    limiter = OutboundRateLimiter(max_retries=1)
+    sent = []
+
+    async def scenario():
+        started = time.monotonic()
+        await send(limiter, sent, 1, "retried", failures=[RetryAfter(0.1)])
+        elapsed = time.monotonic() - started
+        with pytest.raises(RetryAfter):
+            await send(limiter, sent, 2, "failed", failures=[RetryAfter(0.01), RetryAfter(0.01)])
+        return elapsed
+
+    assert asyncio.run(scenario()) >= 0.09
+    assert sent == ["retried"]
+    assert limiter.stats()["retries"] == 2
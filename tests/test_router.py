@@ -0,0 +1,52 @@
+import asyncio
+
+from conftest import Harness
+
+from app.models import User
+from app.router import CallbackRouter, AGENT, ADMIN
+from app.translation import translate
+
+
+async def handler(*_args):
+    pass
+
+
+async def other(*_args):
+    pass
+
+
+def test_exact_names_and_longest_prefix():
+    router = CallbackRouter()
+    router.add(("ag1", "a_c_next"), handler)
+    router.add("inspect_", other, prefix=True)
+    router.add("inspect_id_", handler, prefix=True)
+    assert router.resolve("ag1").handler is handler
+    assert router.resolve("a_c_next").handler is handler
+    assert router.resolve("inspect_id_12").handler is handler
+    assert router.resolve("inspect_list").handler is other
+    assert router.resolve("ag") is None
+    assert router.resolve("unknown") is None
+
+
+def test_roles_require_user():
+    router = CallbackRouter()
+    router.add("public", handler, needs_user=False)
+    router.add("admin", handler, roles=(ADMIN,), needs_user=False)
+    assert router.resolve("public").needs_user is False
+    assert router.resolve("admin").needs_user is True
+    agent = User(id=1, is_agent=True, is_admin=False)
+    assert router.allowed(router.resolve("public"), agent)
+    assert not router.allowed(router.resolve("admin"), agent)
+    router.add("agent", handler, roles=(AGENT,))
+    assert router.allowed(router.resolve("agent"), agent)
+
+
+def test_denied_route_of_customer():
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "help me please")
+            await bot.feed(bot.telegram.callback(1, "ag1"))
+            return bot.bot.texts(1)[-1]
+
+    # Customers get the start message instead of the conversation list
+    assert asyncio.run(scenario()) == translate("starting_msg", "lang_en")
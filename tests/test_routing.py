@@ -0,0 +1,54 @@
+import asyncio
+
+from conftest import Harness
+
+from app.models import Conversation, Message
+from app.routing import routing_index
+from app.translation import translate
+
+
+def test_messages_are_relayed_through_index():
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "help me please")
+            await bot.agent(2)
+            await bot.join(2, 1)
+            misses = routing_index.stats()["misses"]
+            await bot.feed(bot.telegram.message(1, "question"), bot.telegram.message(2, "answer"))
+            assert routing_index.stats()["misses"] == misses
+            return bot.bot.texts(1)[-1], bot.bot.texts(2)[-1]
+
+    assert asyncio.run(scenario()) == ("answer", "User1\n#id1\n\nquestion")
+
+
+def test_warm_indexes_open_conversations():
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "first")
+            await bot.customer(3, "second")
+            await bot.agent(2)
+            await bot.join(2, 1)
+            await bot.feed(bot.telegram.message(2, "/end"))
+
+    asyncio.run(scenario())
+    routing_index.clear()
+    assert routing_index.warm() == 1
+    route = routing_index.get(2)
+    assert (route.conversation_id, route.customer_name, route.agent_chat) == (2, "User3", None)
+    assert routing_index.get(1) is None
+
+
+def test_agent_message_to_deleted_conversation():
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "help me please")
+            await bot.agent(2)
+            await bot.join(2, 1)
+            Message.delete().execute()
+            Conversation.get_by_id(1).delete_instance()
+            await bot.feed(bot.telegram.message(2, "answer"))
+            return bot.bot.texts(2)[-1], bot.bot.texts(1)
+
+    last, customer_texts = asyncio.run(scenario())
+    assert last == translate("starting_msg", "lang_en")
+    assert "answer" not in customer_texts
@@ -0,0 +1,34 @@
+import asyncio
+
+from conftest import Harness
+
+from app.models import Conversation
+from app.session import Session, SESSION_KEY
+
+
+def test_user_data_holds_only_session_records():
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "question")
+            await bot.agent(2)
+            await bot.join(2, 1)
+            return bot.support.app.user_data
+
+    user_data = asyncio.run(scenario())
+    customer, agent = user_data[1][SESSION_KEY], user_data[2][SESSION_KEY]
+    assert set(user_data[1]) == set(user_data[2]) == {SESSION_KEY}
+    assert not hasattr(customer, "__dict__")
+    assert (customer.user_id, customer.customer_conversation_id, customer.lang) == (1, 1, "lang_en")
+    assert (agent.user_id, agent.conversation_id, agent.is_agent, agent.is_admin) == (2, 1, True, True)
+
+
+def test_conversation_is_read_when_needed():
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "question")
+            session = bot.support.app.user_data[1][SESSION_KEY]
+            Conversation.update(is_closed=True).execute()
+            return await session.customer_conversation()
+
+    assert asyncio.run(scenario()).is_closed is True
+    assert asyncio.run(Session().conversation()) is None
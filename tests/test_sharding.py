@@ -0,0 +1,68 @@
+import asyncio
+import multiprocessing
+
+from conftest import FakeBot, Telegram
+from telegram import Update
+from telegram.ext import Updater
+
+from app.cache import user_cache
+from app.models import User, Conversation
+from app import sharding
+from app.routing import routing_index
+from app.sharding import Supervisor, Shard, ShardUpdater, CountingQueue, ROUTE, USER
+
+WORKERS = 3
+
+
+def test_updates_of_user_go_to_the_worker_owning_them():
+    telegram = Telegram()
+    supervisor = Supervisor(Updater(FakeBot("1:abc"), asyncio.Queue()), WORKERS, shutdown_timeout=1)
+    shards = [Shard(index, WORKERS, None) for index in range(WORKERS)]
+    for user_id in range(1, 20):
+        updates = [Update.de_json(telegram.message(user_id, "message"), None),
+                   Update.de_json(telegram.callback(user_id, "ag1"), None)]
+        workers = {supervisor.worker_of(update).index for update in updates}
+        assert workers == {index for index, shard in enumerate(shards) if shard.owns(user_id)}
+    # Updates without a user go to the workers in turn
+    assert [supervisor.worker_of(object()).index for _ in range(WORKERS * 2)] == list(range(WORKERS)) * 2
+
+
+def test_saved_rows_are_broadcast_to_the_other_workers(monkeypatch):
+    supervisor_end, worker_end = multiprocessing.Pipe()
+    monkeypatch.setattr(sharding, "_shard", Shard(0, WORKERS, worker_end))
+    customer = User.create(id=1, tg_name="Customer", language="lang_en")
+    conversation = Conversation.create(customer=customer, customer_name="Customer", customer_chat=1)
+    assert [supervisor_end.recv(), supervisor_end.recv()] == [("invalidate", USER, 1),
+                                                              ("invalidate", ROUTE, conversation.id)]
+
+
+def test_worker_reads_updates_and_invalidations_from_the_pipe():
+    customer = User.create(id=1, tg_name="Customer", language="lang_en")
+    conversation = Conversation.create(customer=customer, customer_name="Customer", customer_chat=1)
+    routing_index.load(conversation.id)
+    assert user_cache.get(1) is not None
+    supervisor_end, worker_end = multiprocessing.Pipe()
+    telegram = Telegram()
+
+    async def scenario():
+        bot = FakeBot("1:abc")
+        queue = CountingQueue()
+        updater = ShardUpdater(bot, queue, Shard(0, WORKERS, worker_end), on_stop=lambda: None)
+        await updater.start_polling()
+        supervisor_end.send([("update", telegram.message(1, "question")), ("invalidate", ROUTE, conversation.id),
+                             ("invalidate", USER, 1)])
+        update = await asyncio.wait_for(queue.get(), 1)
+        queue.task_done()
+        await updater.stop()
+        await updater.shutdown()
+        return update, queue.handled
+
+    update, handled = asyncio.run(scenario())
+    assert (update.message.text, handled) == ("question", 1)
+    assert routing_index.get(conversation.id) is None
+    assert user_cache.get(1) is None
+    # Heartbeat and the last status on shutdown
+    statuses = []
+    while supervisor_end.poll():
+        statuses.append(supervisor_end.recv())
+    assert statuses and statuses[-1][0] == "status" and statuses[-1][1]["handled"] == 1
@@ -0,0 +1,43 @@
+import asyncio
+
+from conftest import Harness
+
+from app.maintenance import repair_conversation_summaries
+from app.models import Conversation, Message
+
+
+def test_summary_is_kept_with_messages_and_renders_list_card(statements):
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "first question")
+            await bot.feed(bot.telegram.message(1, "second question"))
+            await bot.agent(100)
+            with statements.recording():
+                await bot.feed(bot.telegram.callback(100, "ag1", markup_data="ag1"))
+            return bot.bot.texts(100)[-1]
+
+    card = asyncio.run(scenario())
+    assert "first question" in card and "User1" in card
+    # Rendered from the conversation row alone
+    assert any('FROM "conversation"' in sql for sql in statements)
+    assert not [sql for sql in statements if 'FROM "message"' in sql or 'FROM "user"' in sql]
+    conversation = Conversation.get()
+    last = Message.select().order_by(Message.id.desc()).get()
+    assert (conversation.customer_name, conversation.first_message_preview, conversation.message_count,
+            conversation.last_message_at) == ("User1", "first question", 2, last.created_at)
+
+
+def test_repair_recomputes_summaries_from_messages():
+    async def scenario():
+        async with Harness() as bot:
+            await bot.customer(1, "question")
+            await bot.customer(2, "📎")
+
+    asyncio.run(scenario())
+    Conversation.update(customer_name=None, first_message_preview=None, message_count=0,
+                        last_message_at=None).execute()
+    assert repair_conversation_summaries(batch_size=1) == 2
+    assert [(conversation.customer_name, conversation.first_message_preview, conversation.message_count)
+            for conversation in Conversation.select().order_by(Conversation.id)] == \
+           [("User1", "question", 1), ("User2", "📎", 1)]
+    assert all(conversation.last_message_at for conversation in Conversation.select())
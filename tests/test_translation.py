@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+import threading
+
+import pytest
+
+from app import translation
+from app.translation import Catalog, DEFAULT_LANGUAGE, ensure_loaded, translate
+
+
+@pytest.fixture
+def locales(tmp_path, monkeypatch):
+    """Writes texts of languages into a temporary LOCALES_DIR."""
+    monkeypatch.setattr(translation, "LOCALES_DIR", str(tmp_path))
+
+    def write(lang: str, texts: dict[str, str]) -> None:
+        path = tmp_path / (lang + ".json")
+        path.write_text(json.dumps(texts), encoding="utf-8")
+        # Modification time changes even when rewritten within the same tick
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    write(DEFAULT_LANGUAGE, {"hello": "Hello", "greet": "Hi, %s", "bye": "Bye"})
+    return write
+
+
+def test_missing_and_broken_texts_fall_back_to_default_language(locales):
+    locales("lang_uk", {"hello": "Привіт", "greet": "Привіт, %s %s"})
+    table = Catalog().load("lang_uk")
+    assert table == {"hello": "Привіт", "greet": "Hi, %s", "bye": "Bye"}
+
+
+def test_unknown_and_malformed_languages_get_default_table(locales):
+    catalog = Catalog()
+    default = catalog.load(DEFAULT_LANGUAGE)
+    assert catalog.load("lang_xx") is default
+    assert catalog.load("../secrets") is default
+    assert "../secrets" not in catalog.tables
+
+
+def test_reload_swaps_tables_of_loaded_languages(locales):
+    locales("lang_uk", {"hello": "Привіт"})
+    catalog = Catalog()
+    previous = catalog.load("lang_uk")
+    reloaded = []
+    catalog.on_reload(lambda: reloaded.append(True))
+    assert not catalog.changed()
+    locales("lang_uk", {"hello": "Вітаю"})
+    assert catalog.changed()
+    assert catalog.reload() == [DEFAULT_LANGUAGE, "lang_uk"]
+    assert catalog.load("lang_uk")["hello"] == "Вітаю"
+    assert previous["hello"] == "Привіт"
+    assert reloaded == [True]
+
+
+def test_broken_file_keeps_loaded_texts(locales, tmp_path):
+    locales("lang_uk", {"hello": "Привіт"})
+    catalog = Catalog()
+    catalog.load("lang_uk")
+    (tmp_path / "lang_uk.json").write_text("{", encoding="utf-8")
+    catalog.reload()
+    assert catalog.load("lang_uk")["hello"] == "Привіт"
+
+
+def test_files_are_not_read_on_event_loop(locales, monkeypatch):
+    locales("lang_uk", {"hello": "Привіт"})
+    catalog = Catalog()
+    catalog.load(DEFAULT_LANGUAGE)
+    monkeypatch.setattr(translation, "catalog", catalog)
+    read = translation.read_texts
+    readers = []
+
+    def read_texts(lang):
+        readers.append(threading.current_thread())
+        return read(lang)
+
+    monkeypatch.setattr(translation, "read_texts", read_texts)
+
+    async def scenario():
+        # Not loaded yet: default texts now, the language is read in the background
+        first = translate("hello", "lang_uk")
+        while "lang_uk" not in catalog.tables:
+            await asyncio.sleep(0.01)
+        return first, translate("hello", "lang_uk")
+
+    assert asyncio.run(scenario()) == ("Hello", "Привіт")
+    assert readers and threading.main_thread() not in readers
+
+
+def test_ensure_loaded_reads_language_in_thread(locales, monkeypatch):
+    locales("lang_uk", {"hello": "Привіт"})
+    catalog = Catalog()
+    monkeypatch.setattr(translation, "catalog", catalog)
+    asyncio.run(ensure_loaded("lang_uk"))
+    assert catalog.tables["lang_uk"]["hello"] == "Привіт"
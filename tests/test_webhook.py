@@ -0,0 +1,48 @@
+import asyncio
+import socket
+
+import httpx
+from conftest import FakeBot, Telegram
+from telegram.ext import Updater
+
+from app import main
+from app.main import SupportBot
+
+SECRET = "webhook-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_webhook_registers_options_and_checks_secret(monkeypatch):
+    port = free_port()
+    monkeypatch.setattr(main, "WEBHOOK_URL", "https://bot.example.com/telegram")
+    monkeypatch.setattr(main, "WEBHOOK_LISTEN", "127.0.0.1")
+    monkeypatch.setattr(main, "WEBHOOK_PORT", port)
+    monkeypatch.setattr(main, "WEBHOOK_PATH", "telegram")
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", SECRET)
+    monkeypatch.setattr(main, "WEBHOOK_MAX_CONNECTIONS", 80)
+    update = Telegram().message(1, "/start")
+
+    async def scenario():
+        bot = FakeBot("1:abc")
+        queue = asyncio.Queue()
+        async with Updater(bot, queue) as updater:
+            await updater.start_webhook(**SupportBot.webhook_options())
+            async with httpx.AsyncClient(base_url="http://127.0.0.1:%s" % port) as client:
+                accepted = await client.post("/telegram", json=update,
+                                              headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                denied = await client.post("/telegram", json=update,
+                                           headers={"X-Telegram-Bot-Api-Secret-Token": "guess"})
+            await updater.stop()
+        return accepted.status_code, denied.status_code, queue.qsize(), bot.requests
+
+    accepted, denied, queued, requests = asyncio.run(scenario())
+    # Nothing handles the queue, Telegram is answered once the update is queued
+    assert (accepted, denied, queued) == (200, 403, 1)
+    registered = next(data for endpoint, data in requests if endpoint == "setWebhook")
+    assert (registered["url"], registered["secret_token"], registered["max_connections"]) == \
+           ("https://bot.example.com/telegram", SECRET, 80)
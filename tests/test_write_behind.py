@@ -0,0 +1,63 @@
+import asyncio
+
+from conftest import Harness
+
+from app.models import User, Conversation, Message
+from app.write_behind import MessageWriter, message_row, write_batch, MAX_ATTEMPTS
+
+
+def create_conversation(customer_id: int = 1) -> Conversation:
+    customer = User.create(id=customer_id, tg_name="Customer", language="lang_en")
+    return Conversation.create(customer=customer, customer_chat=customer_id)
+
+
+def test_batch_updates_conversation_summary():
+    conversation = create_conversation()
+    write_batch([message_row(conversation.id, 1, "first"), message_row(conversation.id, 1, "", ("photo", "file"))])
+    conversation = Conversation.get_by_id(conversation.id)
+    assert (conversation.message_count, conversation.first_message_preview) == (2, "first")
+    assert [(message.body, message.attachment_type) for message in Message.select().order_by(Message.id)] == \
+           [("first", None), ("", "photo")]
+
+
+def test_failing_row_is_dropped_after_retries():
+    conversation = create_conversation()
+
+    async def scenario():
+        writer = MessageWriter(interval_ms=1000, max_rows=100)
+        writer.add(conversation.id, 1, "before")
+        # Conversation does not exist, the foreign key fails the whole batch
+        writer.add(conversation.id + 1, 1, "lost")
+        writer.add(conversation.id, 1, "after")
+        for _ in range(MAX_ATTEMPTS - 1):
+            try:
+                await writer.flush()
+            except Exception:
+                pass
+            assert writer.pending == 3
+        await writer.flush()
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert (writer.pending, writer.dropped) == (0, 1)
+    assert [message.body for message in Message.select().order_by(Message.id)] == ["before", "after"]
+    assert Conversation.get_by_id(conversation.id).message_count == 2
+
+
+def test_ending_conversation_writes_queued_messages():
+    async def scenario():
+        async with Harness() as bot:
+            bot.support.message_writer = MessageWriter(interval_ms=60_000, max_rows=100)
+            await bot.support.message_writer.start()
+            await bot.customer(1, "help me please")
+            await bot.agent(2)
+            await bot.join(2, 1)
+            await bot.feed(bot.telegram.message(1, "second"), bot.telegram.message(2, "answer"))
+            assert bot.support.message_writer.pending == 3
+            await bot.feed(bot.telegram.message(2, "/end"))
+            assert bot.support.message_writer.pending == 0
+            conversation = Conversation.get_by_id(1)
+            assert conversation.is_closed
+            assert conversation.message_count == 3
+
+    asyncio.run(scenario())